@@ -16,21 +16,217 @@
 # the License.
 
 # Imports:
+from check_growth.collectors import COLLECTOR_TIMEOUT, CollectorRegistry
+from check_growth.collectors import run_collectors
+from check_growth.columns import CompactSeries
+from check_growth.dirscan import DirectoryScanCache
+from check_growth.exporters import write_prometheus_textfile
+from check_growth.exporters import write_status_sidecar
+from check_growth.fsutils import FileLock, FileLockTimeout, append_record
+from check_growth.fsutils import read_records, write_atomically
+from check_growth.histio import FORMATS, dump_datapoints, filter_datapoints
+from check_growth.histio import load_datapoints, stream_history
+from check_growth.outliers import RollingMedianFilter
+from check_growth.profiling import profiled
+from check_growth.trend import remove_seasonality, theil_sen_slope
+from check_growth.trend import SEASONALITY_PERIODS
 from pymisc.monitoring import ScriptStatus
-from pymisc.script import RecoverableException, ScriptConfiguration, ScriptLock
+from pymisc.script import RecoverableException, ScriptConfiguration
 import argparse
+import bisect
+import collections
+import fnmatch
+import heapq
+import json
 import logging
 import logging.handlers as lh
-import numpy
+import math
 import os
+import re
+import socket
 import sys
 import time
-import yaml
 
 # Defaults:
 LOCKFILE_LOCATION = './'+os.path.basename(__file__)+'.lock'
 CONFIGFILE_LOCATION = './'+os.path.basename(__file__)+'.conf'
 
+# Calculation based on 'free' source:
+# used = MemTotal - MemFree - Cached - Slab - Buffers
+# total = MemTotal
+MEMORY_USAGE_EXPRESSION = 'MemTotal - MemFree - Cached - Slab - Buffers'
+
+# Supported methods of growth ratio estimation:
+ESTIMATORS = ['lstsq', 'theil-sen']
+
+# Supported resource types:
+RESOURCE_TYPES = ['memory', 'disk', 'directory', 'meminfo', 'collector']
+
+# Least squares fits of series with up to this many datapoints are done in
+# pure Python, which is cheaper than importing numpy:
+PURE_PYTHON_MAX_DATAPOINTS = 2000
+
+# Number of records in the write-ahead log of the history file which triggers
+# its compaction:
+HISTORY_WAL_MAX_RECORDS = 50
+
+# Number of the most recent datapoints of a series its sampling interval is
+# adapted to, see HistoryFile.adapt_sampling_interval():
+ADAPTIVE_SAMPLING_DATAPOINTS = 10
+
+# Ordering of the states used when looking for the worst series:
+STATUS_SEVERITY = {'ok': 0, 'unknown': 1, 'warn': 2, 'crit': 3}
+
+# Keys allowed in the threshold_overrides entries:
+THRESHOLD_OVERRIDE_KEYS = ['match', 'resource', 'warn_reduction',
+                           'crit_reduction', 'timeframe']
+
+_MEMINFO_TERM_RE = re.compile(r'\s*([+-])?\s*([A-Za-z_][A-Za-z0-9_()]*)\s*')
+
+
+class PerfData():
+    """
+    Performance data gathered during the check run.
+
+    Attributes:
+        _data: a list of (label, value, warn, crit) tuples
+    """
+    _data = []
+
+    @classmethod
+    def init(cls):
+        """
+        Remove all performance data gathered so far.
+        """
+        cls._data = []
+
+    @classmethod
+    def add(cls, label, value, warn=None, crit=None):
+        """
+        Add a performance data point.
+
+        Args:
+            label: name of the metric
+            value: value of the metric
+            warn: warning threshold, if any
+            crit: critical threshold, if any
+        """
+        cls._data.append((label, value, warn, crit))
+
+    @classmethod
+    def get(cls):
+        """
+        Return all the performance data gathered so far.
+        """
+        return cls._data
+
+    @classmethod
+    def render(cls):
+        """
+        Format the performance data according to Nagios plugin guidelines.
+        """
+        ret = []
+        for label, value, warn, crit in cls._data:
+            thresholds = ['' if x is None else str(x) for x in (warn, crit)]
+            ret.append("'{0}'={1};{2}".format(label, value,
+                                              ';'.join(thresholds)))
+        return ' '.join(ret)
+
+
+class Host():
+    """
+    The clock and the system interfaces the resource usage is collected from.
+
+    By default the real ones are used. A simulation replaces them with a
+    virtual clock, a directory playing the role of / (holding i.e. a scripted
+    proc/meminfo) and a fake statvfs(), so that months of runs of the check
+    can be replayed in seconds, see test/benchmarks/simulate.py.
+
+    Attributes:
+        _clock: callable returning current UNIX timestamp, None means
+            time.time()
+        _root: directory which files like /proc/meminfo and the monitored
+            mountpoints are looked up in
+        _statvfs: callable with the same interface as os.statvfs(), called
+            with paths not prefixed with the root. None means os.statvfs()
+            called with the prefixed path.
+    """
+    _clock = None
+    _root = '/'
+    _statvfs = None
+
+    @classmethod
+    def init(cls, clock=None, root='/', statvfs=None):
+        """
+        Set up the clock and the system interfaces, see class attributes.
+        Calling it without arguments restores the real ones.
+        """
+        cls._clock = clock
+        cls._root = root
+        cls._statvfs = statvfs
+
+    @classmethod
+    def time(cls):
+        """
+        Return current UNIX timestamp.
+        """
+        if cls._clock is None:
+            return time.time()
+        return cls._clock()
+
+    @classmethod
+    def path(cls, path):
+        """
+        Return the location of the given absolute path within the root.
+        """
+        if cls._root == '/':
+            return path
+        return os.path.join(cls._root, path.lstrip('/'))
+
+    @classmethod
+    def statvfs(cls, path):
+        """
+        Return filesystem statistics for the given path, see os.statvfs().
+        """
+        if cls._statvfs is None:
+            return os.statvfs(cls.path(path))
+        return cls._statvfs(path)
+
+
+class SampleCache():
+    """
+    Samples of the resources collected during the check run.
+
+    When several configurations are evaluated in a single run, a resource
+    monitored by more than one of them (i.e. the same mountpoint) is sampled
+    only once and all of them get the same value.
+
+    Attributes:
+        _data: a hash with the samples, keyed by resource
+    """
+    _data = {}
+
+    @classmethod
+    def init(cls):
+        """
+        Remove all samples collected so far.
+        """
+        cls._data = {}
+
+    @classmethod
+    def get(cls, key, fetcher, *args):
+        """
+        Return the sample of the resource, collecting it if necessary.
+
+        Args:
+            key: hashable identifier of the resource
+            fetcher: function used to collect the sample
+            args: arguments passed to the fetcher
+        """
+        if key not in cls._data:
+            cls._data[key] = fetcher(*args)
+        return cls._data[key]
+
 
 class HistoryFile():
     """
@@ -44,48 +240,363 @@ class HistoryFile():
         _location: location of the file where data is stored betwean script runs
         _max_averaging_window: please see class's init() method
         _min_averaging_window: please see class's init() method
+        _max_datapoints: please see class's init() method
+        _lock_location: please see class's init() method
+        _wal_location: location of the write-ahead log of the history file
+        _wal_max_records: please see class's init() method
+        _shard_period: please see class's init() method, in seconds
+        _shard_dir: location of the directory with the shards of the history
+            file
+        _compact: please see class's init() method
+        _changes: a list of all the changes done to the data since it was
+            loaded, see _apply_change() method
     """
     _data = {}
     _location = None
     _max_averaging_window = None
     _min_averaging_window = None
+    _max_datapoints = None
+    _lock_location = None
+    _wal_location = None
+    _wal_max_records = HISTORY_WAL_MAX_RECORDS
+    _shard_period = None
+    _shard_dir = None
+    _compact = False
+    _changes = []
 
     @classmethod
-    def _remove_old_datapoints(cls):
+    def _averaging_border(cls):
+        return Host.time() - cls._max_averaging_window * 3600 * 24
+
+    @staticmethod
+    def _remove_old_outliers(data, border):
         """
-        Remove all the datapoints older than cls._max_averaging_window from
-        the internal storage.
+        Remove the outlier flags of the datapoints not newer than border.
+
+        Datapoints themselves are never expired point by point - the old ones
+        are skipped while the history is loaded and when the changes are
+        applied, see _load() and _apply_change() methods.
         """
-        cur_time = time.time()
-        averaging_border = cur_time - cls._max_averaging_window * 3600 * 24
-        cur_dict = cls._data['datapoints']['memory']
-        cls._data['datapoints']['memory'] = {x: cur_dict[x] for x in
-                                             cur_dict.keys() if x >
-                                             averaging_border}
-        for mountpoint in cls._data['datapoints']['disk'].keys():
-            for data_type in cls._data['datapoints']['disk'][mountpoint].keys():
-                cur_dict = cls._data['datapoints']['disk'][mountpoint][data_type]
-                cls._data['datapoints']['disk'][mountpoint][data_type] = \
-                    {x: cur_dict[x] for x in cur_dict.keys()
-                        if x > averaging_border}
+        for series_id in data['outliers'].keys():
+            data['outliers'][series_id] = \
+                [x for x in data['outliers'][series_id] if x > border]
 
     @classmethod
     def _verify_resource_types(cls, prefix=None, path=None, data_type=None):
-        if prefix is None or prefix not in ['disk', 'memory']:
+        if prefix is None or prefix not in RESOURCE_TYPES:
             raise ValueError('Not supported prefix during datapoint addition')
         if prefix == 'disk':
-            if path is None or not os.path.exists(path) or \
+            if path is None or not os.path.exists(Host.path(path)) or \
                     data_type not in ['inode', 'space']:
                 raise ValueError('data_type and path params are required for' +
                                  ' "disk" prefix')
+        if prefix == 'directory':
+            if path is None or not os.path.exists(Host.path(path)):
+                raise ValueError('path param is required for "directory" ' +
+                                 'prefix')
+        if prefix in ['meminfo', 'collector']:
+            if path is None:
+                raise ValueError('path param (series name) is required for ' +
+                                 '"{0}" prefix'.format(prefix))
+
+    @classmethod
+    def _get_series(cls, prefix, path=None, data_type=None, data=None,
+                    create=False):
+        """
+        Return the dictionary holding datapoints of the given resource.
+
+        Args:
+            data: the data to look into, defaults to the data of the class
+            create: create the series if it does not exist yet
+        """
+        if data is None:
+            data = cls._data
+        if create and prefix != 'memory' and \
+                path not in data['datapoints'][prefix]:
+            if prefix == 'disk':
+                data['datapoints'][prefix][path] = {
+                    'inode': cls._new_series(), 'space': cls._new_series()}
+            else:
+                data['datapoints'][prefix][path] = cls._new_series()
+        if prefix == 'memory':
+            return data['datapoints'][prefix]
+        elif prefix == 'disk':
+            return data['datapoints'][prefix][path][data_type]
+        else:
+            return data['datapoints'][prefix][path]
+
+    @classmethod
+    def _new_series(cls):
+        """
+        Return an empty series, in the format selected by init() method.
+        """
+        return CompactSeries() if cls._compact else {}
+
+    @staticmethod
+    def _map_series(datapoints, func):
+        """
+        Return a copy of the datapoints section with func applied to every
+        series.
+        """
+        ret = {}
+        for prefix, series_group in datapoints.items():
+            if prefix == 'memory':
+                ret[prefix] = func(series_group)
+            elif prefix == 'disk':
+                ret[prefix] = {x: {y: func(z) for y, z in types.items()}
+                               for x, types in series_group.items()}
+            else:
+                ret[prefix] = {x: func(y) for x, y in series_group.items()}
+        return ret
+
+    @classmethod
+    def _empty(cls):
+        """
+        Return empty storage.
+        """
+        datapoints = {x: {} for x in RESOURCE_TYPES}
+        datapoints['memory'] = cls._new_series()
+        return {'datapoints': datapoints,
+                'outliers': {},
+                'limits': {},
+                'intervals': {}}
+
+    @classmethod
+    def _load(cls, location, border=None):
+        """
+        Load the data from the file, or create empty storage if the file
+        does not exist.
+
+        The file is streamed (see histio.stream_history()) and datapoints
+        not newer than border are dropped while it is being read, so even
+        histories much bigger than what is kept are loaded with little
+        memory. Series are converted to the format selected by init() method,
+        so history files can be moved between the compact and the plain
+        storage freely.
+
+        Args:
+            location: path of the history file or of one of its shards
+            border: UNIX timestamp, None keeps all the datapoints
+
+        Raises:
+            RecoverableException: the file exists, but can not be read or is
+                malformed. Starting with an empty history instead would make
+                the next save overwrite it.
+        """
+        data = cls._empty()
+        try:
+            with open(location, 'r') as fh:
+                for keys, value in stream_history(fh):
+                    if keys[0] != 'datapoints':
+                        # Sections which are no longer used, i.e. windows of
+                        # the outlier filters kept by older versions, are
+                        # dropped:
+                        if keys[0] in data:
+                            data[keys[0]] = value
+                        continue
+                    if keys[1] not in RESOURCE_TYPES or \
+                            (keys[1] == 'disk' and
+                             keys[3] not in ['inode', 'space']):
+                        raise ValueError('unsupported series {0}'.format(
+                            '/'.join(str(x) for x in keys[1:])))
+                    series = cls._get_series(*keys[1:], data=data,
+                                             create=True)
+                    for timestamp, datapoint in value:
+                        if border is None or timestamp > border:
+                            series[timestamp] = datapoint
+        except FileNotFoundError:
+            return cls._empty()
+        except (OSError, ValueError, TypeError, OverflowError) as e:
+            raise RecoverableException(
+                'History file {0} could not be loaded: {1}'.format(
+                    location, e))
+        for section in ['outliers', 'limits', 'intervals']:
+            if not isinstance(data[section], dict):
+                data[section] = {}
+        return data
+
+    @classmethod
+    def _dump(cls, data):
+        """
+        Serialize the data into YAML, series in compact format are written
+        as little-endian columns.
+        """
+        import yaml
+
+        def convert(series):
+            if isinstance(series, CompactSeries):
+                return series.encode()
+            return series
+
+        data = dict(data, datapoints=cls._map_series(data['datapoints'],
+                                                     convert))
+        return yaml.dump(data, default_flow_style=False)
+
+    @classmethod
+    def _apply_change(cls, data, change, border=None):
+        """
+        Apply a single change to the data.
+
+        All the modifications of the data are expressed as changes, which are
+        applied to the data of the class immediately and recorded. When the
+        data is saved, the recorded changes are re-applied to the most recent
+        content of the file, so concurrent runs which update different
+        series do not overwrite each other's datapoints.
+
+        Args:
+            data: the data to modify, in place
+            border: UNIX timestamp, datapoints not newer than it are not
+                added. None adds all the datapoints.
+            change: one of:
+                ('add', prefix, path, data_type, timestamp, value)
+                ('outlier', series_id, timestamp)
+                ('limit', series_id, max usage, units)
+                ('interval', series_id, sampling interval)
+                ('clear',)
+                Changes of other types, i.e. the 'filter' ones logged by
+                older versions, are ignored.
+        """
+        if change[0] == 'add':
+            _, prefix, path, data_type, timestamp, value = change
+            if border is not None and timestamp <= border:
+                return
+            series = cls._get_series(prefix, path, data_type, data=data,
+                                     create=True)
+            series[timestamp] = value
+            if cls._max_datapoints is not None:
+                removed = cls._thin_series(series, cls._max_datapoints)
+                series_id = get_series_id(prefix, path, data_type)
+                if removed and series_id in data['outliers']:
+                    removed = set(removed)
+                    data['outliers'][series_id] = \
+                        [x for x in data['outliers'][series_id]
+                            if x not in removed]
+        elif change[0] == 'outlier':
+            outliers = data['outliers'].setdefault(change[1], [])
+            if change[2] not in outliers:
+                outliers.append(change[2])
+        elif change[0] == 'limit':
+            data['limits'][change[1]] = [change[2], change[3]]
+        elif change[0] == 'interval':
+            data['intervals'][change[1]] = change[2]
+        elif change[0] == 'clear':
+            data['datapoints'] = cls._empty()['datapoints']
+            data['outliers'] = dict()
+            data['limits'] = dict()
+            data['intervals'] = dict()
+
+    @classmethod
+    def _replay(cls, data, wal_location, border=None):
+        """
+        Apply all the valid records of the write-ahead log to the data,
+        skipping datapoints not newer than border.
+
+        Changes are idempotent, so replaying records which were already
+        compacted into the history file (i.e. when the run was killed after
+        the history file was replaced, but before the log was removed) is
+        harmless.
+        """
+        for record in read_records(wal_location):
+            for change in record:
+                cls._apply_change(data, change, border)
+        return data
+
+    @classmethod
+    def _list_shards(cls, shard_dir=None):
+        """
+        Return a list of (start, end, file name) tuples describing all the
+        shards of the history file, oldest first.
+
+        Args:
+            shard_dir: directory with the shards, defaults to the one of the
+                history file set by init() method
+        """
+        try:
+            names = os.listdir(shard_dir or cls._shard_dir)
+        except OSError:
+            return []
+        shards = []
+        for name in names:
+            span = cls._parse_shard_name(name)
+            if span is not None:
+                shards.append(span + (name,))
+        return sorted(shards)
+
+    @staticmethod
+    def _parse_shard_name(name):
+        """
+        Return (start, end) tuple of the shard or None if the name is not a
+        name of a shard.
+        """
+        match = re.match(r'^(\d+)-(\d+)\.yml$', name)
+        if match is None:
+            return None
+        return (int(match.group(1)), int(match.group(2)))
+
+    @classmethod
+    def _shard_name(cls, timestamp):
+        start = int(timestamp - timestamp % cls._shard_period)
+        return '{0}-{1}.yml'.format(start, start + cls._shard_period)
+
+    @classmethod
+    def _load_shards(cls, data, border):
+        """
+        Merge datapoints from all the shards which are not older than border
+        into the data.
+
+        Returns:
+            A hash with file names of the loaded shards as keys and numbers of
+            their datapoints as values.
+        """
+        loaded = {}
+        for _, end, name in cls._list_shards():
+            if end <= border:
+                continue
+            shard = cls._load(os.path.join(cls._shard_dir, name), border)
+            loaded[name] = 0
+            for prefix, path, data_type, timestamp, value in \
+                    cls._iter_datapoints(shard):
+                cls._get_series(prefix, path, data_type, data=data,
+                                create=True)[timestamp] = value
+                loaded[name] += 1
+        return loaded
+
+    @classmethod
+    def _split_shards(cls, data):
+        """
+        Split datapoints into shards.
+
+        Returns:
+            A hash with shard file names as keys and shards, in the same
+            format as the data, as values.
+        """
+        shards = {}
+        for prefix, path, data_type, timestamp, value in \
+                cls._iter_datapoints(data):
+            name = cls._shard_name(timestamp)
+            if name not in shards:
+                shards[name] = {'datapoints': cls._empty()['datapoints']}
+            cls._get_series(prefix, path, data_type, data=shards[name],
+                            create=True)[timestamp] = value
+        return shards
 
     @classmethod
-    def init(cls, location, max_averaging_window, min_averaging_window):
+    def _record_change(cls, change):
+        cls._apply_change(cls._data, change, cls._averaging_border())
+        cls._changes.append(change)
+
+    @classmethod
+    def init(cls, location, max_averaging_window, min_averaging_window,
+             max_datapoints=None, lock_location=None,
+             wal_max_records=HISTORY_WAL_MAX_RECORDS, shard_period=None,
+             compact=False):
         """
         Initialize HistoryFIle class.
 
         Class either fetches stored datapoints from the file or creates empty
-        storage. It takes care of setting some internal fields as well.
+        storage. Changes saved by previous runs to the write-ahead log (see
+        save() method) are applied on top of them. It takes care of setting
+        some internal fields as well.
 
         Args:
             location: location of the file where data is stored or should be
@@ -95,18 +606,108 @@ class HistoryFile():
                 taken into consideration.
             min_averaging_window: minimum time span betwean the oldest and newest
                 datapoint which permits calculation of the growth ratio.
+            max_datapoints: maximum number of datapoints kept for a single
+                series, see _thin_series() method. None means no limit.
+            lock_location: location of the lock file which guards updates of
+                the history file, defaults to location + '.lock'. The lock is
+                held only while the file is being saved, and shared with
+                other readers while it is being loaded, so a concurrent
+                compaction can not make init() miss records of the log.
+            wal_max_records: number of records in the write-ahead log which
+                triggers its compaction into the history file.
+            shard_period: if set, datapoints are stored in shards - one file
+                per shard_period days, in location + '.d' directory - instead
+                of the history file itself. Only the shards which are not
+                older than max_averaging_window are loaded. None disables
+                sharding, see save() method for details.
+            compact: keep the series in memory and in the files as columns of
+                32 bit time offsets and 32 bit values, see CompactSeries
+                class. Otherwise, series are hashes with timestamps as keys.
         """
         cls._max_averaging_window = max_averaging_window
         cls._min_averaging_window = min_averaging_window
+        cls._max_datapoints = max_datapoints
         cls._location = location
+        cls._lock_location = lock_location or location + '.lock'
+        cls._wal_location = location + '.wal'
+        cls._wal_max_records = wal_max_records
+        cls._shard_period = None
+        if shard_period is not None:
+            cls._shard_period = int(shard_period * 3600 * 24)
+        cls._shard_dir = location + '.d'
+        cls._compact = compact
+        cls._changes = []
+
+        border = cls._averaging_border()
+        with FileLock(cls._lock_location, shared=True):
+            data = cls._load(location, border)
+            cls._load_shards(data, border)
+            cls._replay(data, cls._wal_location, border)
+        cls._remove_old_outliers(data, border)
+        cls._data = data
+
+    @staticmethod
+    def _thin_series(series, max_datapoints):
+        """
+        Remove datapoints from the series until at most max_datapoints are
+        left.
+
+        The oldest and the newest datapoints are always kept. Out of the
+        remaining ones, the datapoint whose neighbours are closest to each
+        other is removed first, so the datapoints are taken away from the
+        densest parts of the series and the rest keeps covering the whole
+        time span as uniformly as possible. For a series which grows
+        linearly, least squares fit of such subset is an unbiased estimate of
+        the same slope, only with a somewhat bigger variance. Candidates are
+        kept in a heap, so the cost is O(n log n) even if many datapoints have
+        to be removed at once (i.e. after the limit has been lowered). Ties
+        are broken by the timestamp, so the result is deterministic. Series
+        within the limit are not even sorted, so adding a datapoint stays
+        cheap, and the candidates are removed from the series at once, after
+        all of them have been chosen.
 
-        try:
-            with open(location, 'r') as fh:
-                cls._data = yaml.load(fh)
-        except (IOError, yaml.YAMLError):
-            cls._data = {'datapoints': {'memory': {}, 'disk': {}}}
+        Args:
+            series: a hash with timestamps as keys and datapoints as values,
+                modified in place
+            max_datapoints: maximum number of datapoints, at least 2
+
+        Returns:
+            A list with timestamps of the removed datapoints.
+        """
+        if len(series) <= max_datapoints:
+            return []
+        timestamps = sorted(series)
+        n = len(timestamps)
+
+        preceding = list(range(-1, n - 1))
+        following = list(range(1, n + 1))
+        heap = [(timestamps[i + 1] - timestamps[i - 1], timestamps[i], i)
+                for i in range(1, n - 1)]
+        heapq.heapify(heap)
+        removed = []
+        while n - len(removed) > max_datapoints:
+            gap, timestamp, i = heapq.heappop(heap)
+            if following[i] is None or \
+                    timestamps[following[i]] - timestamps[preceding[i]] != gap:
+                # Datapoint is already gone or one of its neighbours has been
+                # removed in the meantime and there is a newer entry for it:
+                continue
+            p, q = preceding[i], following[i]
+            following[p], preceding[q] = q, p
+            following[i] = None
+            removed.append(timestamp)
+            for j in (p, q):
+                if 0 < j < n - 1:
+                    heapq.heappush(heap, (timestamps[following[j]] -
+                                          timestamps[preceding[j]],
+                                          timestamps[j], j))
+
+        if isinstance(series, CompactSeries):
+            series.remove_all(removed)
         else:
-            cls._remove_old_datapoints()
+            for timestamp in removed:
+                del series[timestamp]
+        return removed
 
     @classmethod
     def add_datapoint(cls, prefix, datapoint, path=None, data_type=None):
@@ -114,34 +715,368 @@ class HistoryFile():
         Add a datapoint to the internal store.
 
         This method takes care of some simple sanity-checking and addition of
-        the new datapoints.
+        the new datapoints. If the series has more datapoints than permitted
+        by the max_datapoints param of init() method, it is thinned.
 
         Args:
-            prefix: either 'disk' or 'memory' - whether a datapoint is actually
-                a disk usage or memory usage
+            prefix: one of RESOURCE_TYPES - whether a datapoint is actually a
+                disk usage, memory usage, the size of a directory tree, a
+                derived /proc/meminfo series or a series of a collector plugin
             datapoint: current value of the resource
             path: in case of the 'disk' resource - the path where device
-                relevant to the datapoint is mounted.
+                relevant to the datapoint is mounted, in case of the
+                'directory' resource - the root of the directory tree, in case
+                of the 'meminfo' resource - the name of the series, in case of
+                the 'collector' resource - the name of the collector and the
+                name of the series, separated by a slash.
             data_type: in case of the 'disk' respource - whether it is an inode
                 usage or disk space usage
 
+        Returns:
+            Timestamp of the datapoint.
+
         Raises:
             ValueError: input data is invalid
         """
         cls._verify_resource_types(prefix, path, data_type)
         float(datapoint)
-        cur_time = round(time.time())
-        if prefix == 'memory':
-            cls._data['datapoints'][prefix][cur_time] = datapoint
-        else:
-            if path not in cls._data['datapoints'][prefix].keys():
-                cls._data['datapoints'][prefix][path] = dict()
-                cls._data['datapoints'][prefix][path]['inode'] = dict()
-                cls._data['datapoints'][prefix][path]['space'] = dict()
-            cls._data['datapoints'][prefix][path][data_type][cur_time] = datapoint
+        cur_time = round(Host.time())
+        cls._record_change(('add', prefix, path, data_type, cur_time,
+                            datapoint))
+
+        return cur_time
+
+    @classmethod
+    def set_limit(cls, prefix, max_usage, units=None, path=None,
+                  data_type=None):
+        """
+        Store the max usage of the resource and the units it is measured in.
+
+        They are needed to evaluate the series without sampling the resource,
+        see get_last_sample() method.
+
+        Args:
+            prefix, path, data_type: same as for add_datapoint() method
+            max_usage: how much of the resource there is in general
+            units: units of the resource, if not the default ones
+        """
+        cls._verify_resource_types(prefix, path, data_type)
+        series_id = get_series_id(prefix, path, data_type)
+        if cls._data['limits'].get(series_id) != [max_usage, units]:
+            cls._record_change(('limit', series_id, max_usage, units))
+
+    @classmethod
+    def is_sample_due(cls, prefix, path=None, data_type=None, tolerance=0):
+        """
+        Check if the sampling interval of the series, see
+        adapt_sampling_interval() method, has passed since its most recent
+        datapoint.
+
+        Args:
+            prefix, path, data_type: same as for add_datapoint() method
+            tolerance: number of seconds the interval may be cut short by, so
+                that the jitter of the scheduler running the check does not
+                delay the sample by a whole run
+        """
+        cls._verify_resource_types(prefix, path, data_type)
+        interval = cls._data['intervals'].get(get_series_id(prefix, path,
+                                                            data_type))
+        try:
+            series = cls._get_series(prefix, path, data_type)
+        except KeyError:
+            return True
+        if interval is None or not series:
+            return True
+        return Host.time() + tolerance >= max(series) + interval
+
+    @classmethod
+    def adapt_sampling_interval(cls, prefix, max_usage, min_interval,
+                                max_interval, resolution, path=None,
+                                data_type=None):
+        """
+        Adjust the sampling interval of the series to how fast it changes.
+
+        The rate of change is estimated from the most recent
+        ADAPTIVE_SAMPLING_DATAPOINTS datapoints of the series as the absolute
+        least squares slope plus the standard deviation of the residuals per
+        average gap between the datapoints - the trend of a noisy series
+        needs more datapoints to be estimated, just like the one of a series
+        which grows fast. The interval is the time the series needs to change
+        by resolution times max_usage at this rate. It is shortened
+        immediately, but it grows at most twofold at a time, so a single
+        quiet period does not make the check miss a series which starts to
+        grow.
+
+        Args:
+            prefix, path, data_type: same as for add_datapoint() method
+            max_usage: how much of the resource there is in general
+            min_interval, max_interval: bounds of the interval, in seconds
+            resolution: fraction of max_usage
+
+        Returns:
+            The interval, in seconds.
+        """
+        cls._verify_resource_types(prefix, path, data_type)
+        series_id = get_series_id(prefix, path, data_type)
+        series = cls._get_series(prefix, path, data_type)
+        timestamps = sorted(series)[-ADAPTIVE_SAMPLING_DATAPOINTS:]
+        n = len(timestamps)
+
+        interval = min_interval
+        if n >= 3:
+            values = [series[x] for x in timestamps]
+            slope = _lstsq_slope(timestamps, values)
+            mean_x = sum(x - timestamps[0] for x in timestamps) / n
+            mean_y = sum(values) / n
+            noise = math.sqrt(sum(
+                (y - mean_y - slope * (x - timestamps[0] - mean_x)) ** 2
+                for x, y in zip(timestamps, values)) / (n - 2))
+            rate = abs(slope) + noise * (n - 1) / (timestamps[-1] -
+                                                   timestamps[0])
+            interval = max_interval
+            if rate > 0:
+                interval = min(interval, resolution * max_usage / rate)
+            previous = cls._data['intervals'].get(series_id, min_interval)
+            interval = int(max(min_interval, min(interval, 2 * previous)))
+
+        if cls._data['intervals'].get(series_id) != interval:
+            cls._record_change(('interval', series_id, interval))
+        return interval
+
+    @classmethod
+    def get_last_sample(cls, prefix, path=None, data_type=None):
+        """
+        Get the most recent sample of the resource.
+
+        Args:
+            prefix, path, data_type: same as for add_datapoint() method
+
+        Returns:
+            A tuple (timestamp, current usage, max usage, units), or None if
+            the resource has not been sampled yet.
+        """
+        cls._verify_resource_types(prefix, path, data_type)
+        limit = cls._data['limits'].get(get_series_id(prefix, path,
+                                                      data_type))
+        try:
+            series = cls._get_series(prefix, path, data_type)
+        except KeyError:
+            return None
+        if not series or limit is None:
+            return None
+        timestamp = max(series)
+        return timestamp, series[timestamp], limit[0], limit[1]
+
+    @classmethod
+    def count_datapoints(cls, prefix, path=None, data_type=None):
+        """
+        Get the number of datapoints of the series, 0 if it does not exist.
+
+        Args:
+            prefix, path, data_type: same as for add_datapoint() method
+        """
+        cls._verify_resource_types(prefix, path, data_type)
+        try:
+            return len(cls._get_series(prefix, path, data_type))
+        except KeyError:
+            return 0
+
+    @classmethod
+    def import_datapoint(cls, prefix, path, data_type, timestamp, datapoint):
+        """
+        Add a datapoint with the given timestamp to the internal store.
+
+        Unlike add_datapoint(), paths are not required to exist, so
+        datapoints exported on a different host can be imported.
+
+        Args:
+            prefix, path, data_type: same as for add_datapoint() method
+            timestamp: time the datapoint was collected at
+            datapoint: value of the resource
+
+        Raises:
+            ValueError: input data is invalid
+        """
+        if prefix not in RESOURCE_TYPES:
+            raise ValueError('Not supported prefix: {0}'.format(prefix))
+        if prefix == 'disk' and data_type not in ['inode', 'space']:
+            raise ValueError('data_type should be either "inode" or "space" ' +
+                             'for "disk" prefix')
+        if prefix != 'memory' and path is None:
+            raise ValueError('path is required for "{0}" prefix'.format(prefix))
+        float(datapoint)
+        cls._record_change(('add', prefix, path, data_type, int(timestamp),
+                            datapoint))
 
     @classmethod
-    def verify_dataspan(cls, prefix, path=None, data_type=None):
+    def iter_datapoints(cls):
+        """
+        Iterate over all the stored datapoints.
+
+        Yields:
+            (prefix, path, data_type, timestamp, value) tuples, grouped by
+            series and ordered by timestamp within each series.
+        """
+        return cls._iter_datapoints(cls._data)
+
+    @classmethod
+    def stream_datapoints(cls, location, max_averaging_window,
+                          lock_location=None):
+        """
+        Iterate over the datapoints stored in the history file, its shards
+        and its write-ahead log without loading them.
+
+        Unlike init() and iter_datapoints() methods, the history file and the
+        shards are streamed (see histio.stream_history()), so the memory
+        needed does not depend on their size - only the write-ahead log,
+        which is compacted once it has wal_max_records records, is read as a
+        whole. All the files are opened and the log is read under a shared
+        lock, so a concurrent compaction can not make the iteration miss or
+        repeat datapoints. The class is not initialized by this method.
+
+        Datapoints from the files come first, grouped by file, and the ones
+        from the log follow. A datapoint overwritten by the log is yielded
+        only once, with the value from the log. Datapoints added by the log
+        are not thinned, see _thin_series() method.
+
+        Args:
+            location: location of the history file
+            max_averaging_window: datapoints older than this are skipped
+            lock_location: location of the lock file, defaults to location +
+                '.lock'
+
+        Yields:
+            (prefix, path, data_type, timestamp, value) tuples
+
+        Raises:
+            RecoverableException: the history file or one of the shards can
+                not be read or is malformed.
+        """
+        border = Host.time() - max_averaging_window * 3600 * 24
+        shard_dir = location + '.d'
+        wal = cls._empty()
+        handles = []
+        try:
+            with FileLock(lock_location or location + '.lock', shared=True):
+                cleared = False
+                for record in read_records(location + '.wal'):
+                    for change in record:
+                        cls._apply_change(wal, change, border)
+                        cleared = cleared or change[0] == 'clear'
+                if not cleared:
+                    names = [location]
+                    names.extend(os.path.join(shard_dir, x[2])
+                                 for x in cls._list_shards(shard_dir)
+                                 if x[1] > border)
+                    for name in names:
+                        try:
+                            handles.append((name, open(name, 'r')))
+                        except FileNotFoundError:
+                            continue
+            for name, fh in handles:
+                try:
+                    for keys, series in stream_history(fh):
+                        if keys[0] != 'datapoints':
+                            continue
+                        if keys[1] not in RESOURCE_TYPES or \
+                                (keys[1] == 'disk' and
+                                 keys[3] not in ['inode', 'space']):
+                            raise ValueError('unsupported series {0}'.format(
+                                '/'.join(str(x) for x in keys[1:])))
+                        prefix, path, data_type = (keys[1:] + (None, None))[:3]
+                        try:
+                            overwritten = cls._get_series(prefix, path,
+                                                          data_type, data=wal)
+                        except KeyError:
+                            overwritten = {}
+                        for timestamp, value in series:
+                            if timestamp > border and \
+                                    timestamp not in overwritten:
+                                yield (prefix, path, data_type, timestamp,
+                                       value)
+                except (OSError, ValueError, TypeError, OverflowError) as e:
+                    raise RecoverableException(
+                        'History file {0} could not be loaded: {1}'.format(
+                            name, e))
+        finally:
+            for _, fh in handles:
+                fh.close()
+        yield from cls._iter_datapoints(wal)
+
+    @staticmethod
+    def _iter_datapoints(data):
+        datapoints = data['datapoints']
+        for timestamp in sorted(datapoints['memory']):
+            yield ('memory', None, None, timestamp,
+                   datapoints['memory'][timestamp])
+        for path in sorted(datapoints['disk']):
+            for data_type in ['inode', 'space']:
+                series = datapoints['disk'][path][data_type]
+                for timestamp in sorted(series):
+                    yield ('disk', path, data_type, timestamp,
+                           series[timestamp])
+        for prefix in ['directory', 'meminfo', 'collector']:
+            for path in sorted(datapoints[prefix]):
+                series = datapoints[prefix][path]
+                for timestamp in sorted(series):
+                    yield (prefix, path, None, timestamp, series[timestamp])
+
+    @classmethod
+    def filter_datapoint(cls, prefix, datapoint, timestamp, path=None,
+                         data_type=None, window=60, threshold=5):
+        """
+        Pass a datapoint through the outlier filter of its series.
+
+        The window of the filter is made of the datapoints of the series which
+        precede the new one, so no state other than the series itself is kept
+        betwean runs. Outliers are not removed from the store, they are
+        flagged instead and can be fetched using get_outliers() method.
+
+        Args:
+            prefix: same as for add_datapoint() method
+            datapoint: value of the datapoint
+            timestamp: timestamp of the datapoint, as returned by
+                add_datapoint()
+            path: same as for add_datapoint() method
+            data_type: same as for add_datapoint() method
+            window: number of recent datapoints the filter takes into account
+            threshold: see RollingMedianFilter class
+
+        Returns:
+            True if the datapoint was flagged as an outlier, False otherwise.
+        """
+        cls._verify_resource_types(prefix, path, data_type)
+        series_id = get_series_id(prefix, path, data_type)
+        series = cls._get_series(prefix, path, data_type)
+        recent = heapq.nlargest(window, (x for x in series if x < timestamp))
+        rfilter = RollingMedianFilter(window, threshold,
+                                      [series[x] for x in reversed(recent)])
+        is_outlier = rfilter.update(datapoint)
+        if is_outlier:
+            cls._record_change(('outlier', series_id, timestamp))
+
+        return is_outlier
+
+    @classmethod
+    def get_outliers(cls, prefix, path=None, data_type=None):
+        """
+        Get timestamps of all the datapoints flagged as outliers.
+
+        Args:
+            prefix: same as for add_datapoint() method
+            path: same as for add_datapoint() method
+            data_type: same as for add_datapoint() method
+
+        Returns:
+            A list of timestamps.
+        """
+        cls._verify_resource_types(prefix, path, data_type)
+        return cls._data['outliers'].get(get_series_id(prefix, path, data_type),
+                                         [])
+
+    @classmethod
+    def verify_dataspan(cls, prefix, path=None, data_type=None,
+                        outliers=None):
         """
         Check whether we have enough data to calculate growth ratio.
 
@@ -153,17 +1088,18 @@ class HistoryFile():
             prefix: same as for add_datapoint() method
             path: same as for add_datapoint() method
             data_type: same as for add_datapoint() method
+            outliers: same as for get_dataspan() method
 
         Returns:
             Difference expressed in number of days. If it is negative then
             there is not enough data to process.
         """
         cls._verify_resource_types(prefix, path, data_type)
-        dataspan = cls.get_dataspan(prefix, path, data_type)
+        dataspan = cls.get_dataspan(prefix, path, data_type, outliers)
         return (dataspan - cls._min_averaging_window)
 
     @classmethod
-    def get_dataspan(cls, prefix, path=None, data_type=None):
+    def get_dataspan(cls, prefix, path=None, data_type=None, outliers=None):
         """
         Return the difference (in days) betwean oldest and latest data sample
         for given reource type
@@ -172,15 +1108,20 @@ class HistoryFile():
             prefix: same as for add_datapoint() method
             path: same as for add_datapoint() method
             data_type: same as for add_datapoint() method
+            outliers: timestamps of datapoints which are ignored, as they will
+                be by the estimators
 
         Returns:
-            Data span for given rousource type expressed in days.
+            Data span for given rousource type expressed in days, 0 if there
+            are no datapoints.
         """
         cls._verify_resource_types(prefix, path, data_type)
-        if prefix == 'memory':
-            timestamps = cls._data['datapoints'][prefix].keys()
-        else:
-            timestamps = cls._data['datapoints'][prefix][path][data_type].keys()
+        timestamps = cls._get_series(prefix, path, data_type).keys()
+        if outliers:
+            outliers = set(outliers)
+            timestamps = [x for x in timestamps if x not in outliers]
+        if not timestamps:
+            return 0
         dataspan = round((max(timestamps) - min(timestamps))/(3600*24), 2)
         return dataspan
 
@@ -189,8 +1130,8 @@ class HistoryFile():
         """
         Get all datapoints for given data type.
 
-        This method ensures that all datapoints not older than averaging
-        window are returned for the given resource type.
+        Datapoints older than max_averaging_window are dropped once, when the
+        history is loaded or saved, so the stored series is returned as it is.
 
         Args:
             prefix: same as for add_datapoint() method
@@ -204,34 +1145,227 @@ class HistoryFile():
             ValueError: input data is invalid
         """
         cls._verify_resource_types(prefix, path, data_type)
-        cls._remove_old_datapoints()
-        if prefix == 'disk':
-            datapoints = cls._data['datapoints'][prefix][path][data_type]
+        return cls._get_series(prefix, path, data_type)
+
+    @classmethod
+    def clear_history(cls):
+        """
+        Remove all datapoints.
+        """
+        cls._record_change(('clear',))
+
+    @classmethod
+    def save(cls, compact=False):
+        """
+        Save all the datapoints.
+
+        The changes done during this run are appended as a single
+        checksummed record to the write-ahead log, which is much cheaper than
+        rewriting the whole history file. A run killed in the middle of the
+        append leaves behind a torn record, which is skipped by init().
+
+        Once the log grows to wal_max_records records, if the history was
+        cleared or if compact is set, the log is compacted: the history file is read again, all
+        the records of the log and the changes done by this run are applied
+        on top of it, datapoints older than max_averaging_window are removed
+        and the result replaces the history file atomically. The log is
+        removed afterwards.
+
+        With sharding enabled (see init() method), only the shards whose
+        content has changed - normally just the newest one - are written
+        during the compaction, and the history file keeps everything but the
+        datapoints. Shards older than max_averaging_window are removed as a
+        whole, without being read. Datapoints saved before sharding was
+        enabled or with a different shard_period are moved to the shards, and
+        vice versa - all the shards are merged back into the history file
+        once sharding is disabled.
+
+        The lock is held only for the duration of the append or the
+        compaction - runs which update different series never wait for each
+        other for longer than that, and none of the updates is lost.
+        """
+        with FileLock(cls._lock_location):
+            records = list(read_records(cls._wal_location))
+            if not compact and len(records) + 1 < cls._wal_max_records and \
+                    ('clear',) not in cls._changes:
+                if cls._changes:
+                    append_record(cls._wal_location, cls._changes)
+                cls._changes = []
+                return
+
+            changes = [x for record in records for x in record] + cls._changes
+            cls._changes = []
+            border = cls._averaging_border()
+            data = cls._load(cls._location, border)
+            if cls._shard_period is None:
+                cls._load_shards(data, border)
+                for change in changes:
+                    cls._apply_change(data, change, border)
+                cls._remove_old_outliers(data, border)
+                cls._data = data
+                write_atomically(cls._location, cls._dump(cls._data))
+                for _, _, name in cls._list_shards():
+                    os.unlink(os.path.join(cls._shard_dir, name))
+            else:
+                cls._compact_shards(data, changes)
+            try:
+                os.unlink(cls._wal_location)
+            except OSError:
+                pass
+
+    @classmethod
+    def _compact_shards(cls, data, changes):
+        """
+        Apply the changes to the data and save it into the shards.
+
+        Args:
+            data: the content of the history file
+            changes: changes to apply, see _apply_change() method
+        """
+        border = cls._averaging_border()
+        # Datapoints stored in the history file itself are moved to shards:
+        touched = set(cls._shard_name(x[3])
+                      for x in cls._iter_datapoints(data))
+        if ('clear',) in changes:
+            loaded = {}
         else:
-            datapoints = cls._data['datapoints'][prefix]
-        return datapoints
+            loaded = cls._load_shards(data, border)
+        for change in changes:
+            cls._apply_change(data, change, border)
+            if change[0] == 'add':
+                touched.add(cls._shard_name(change[4]))
+        shards = cls._split_shards(data)
+        for name, shard in shards.items():
+            if loaded.get(name) != sum(1 for _ in cls._iter_datapoints(shard)):
+                # Datapoints were added, thinned out or moved from a shard
+                # with a different shard_period:
+                touched.add(name)
+
+        # Shards are written before the history file and the obsolete ones
+        # are removed last, so no datapoint is lost if the run is killed in
+        # the middle:
+        os.makedirs(cls._shard_dir, exist_ok=True)
+        for name in sorted(touched & set(shards)):
+            if cls._parse_shard_name(name)[1] > border:
+                write_atomically(os.path.join(cls._shard_dir, name),
+                                 cls._dump(shards[name]))
+        cls._remove_old_outliers(data, border)
+        cls._data = data
+        data = dict(cls._data, datapoints=cls._empty()['datapoints'])
+        write_atomically(cls._location, cls._dump(data))
+        for _, end, name in cls._list_shards():
+            if end <= border or name not in shards:
+                os.unlink(os.path.join(cls._shard_dir, name))
+
+
+def compile_meminfo_series(series_conf):
+    """
+    Prepare derived /proc/meminfo series for evaluation.
+
+    Each series is defined by two expressions - one for the current usage and
+    one for the max usage. An expression is a sum/difference of
+    /proc/meminfo field names, i.e. "SwapTotal - SwapFree". All the fields
+    referenced by the series are assigned a slot in the field table, which
+    is filled during a single pass over /proc/meminfo.
+
+    Args:
+        series_conf: a hash with series names as keys and hashes with 'usage'
+            and (optionally) 'max' expressions as values. Max usage defaults to
+            'MemTotal'.
+
+    Returns:
+        A tuple (field index, compiled series). Field index is a hash mapping
+        field names to table slots, compiled series is a hash mapping series
+        names to tuples (usage terms, max terms), where terms are lists of
+        (sign, slot) tuples.
+
+    Raises:
+        ValueError: one of the expressions is malformed
+    """
+    field_index = {}
+
+    def compile_expression(expression):
+        terms = []
+        pos = 0
+        expression = str(expression)
+        while pos < len(expression):
+            match = _MEMINFO_TERM_RE.match(expression, pos)
+            if match is None or match.end() == pos or \
+                    (terms and match.group(1) is None):
+                raise ValueError('Malformed meminfo expression: ' +
+                                 '"{0}"'.format(expression))
+            sign = -1 if match.group(1) == '-' else 1
+            slot = field_index.setdefault(match.group(2), len(field_index))
+            terms.append((sign, slot))
+            pos = match.end()
+        if not terms:
+            raise ValueError('Empty meminfo expression')
+        return terms
+
+    compiled = {}
+    for name, conf in series_conf.items():
+        if not isinstance(conf, dict) or 'usage' not in conf:
+            raise ValueError('Meminfo series {0} '.format(name) +
+                             'does not define "usage" expression')
+        compiled[name] = (compile_expression(conf['usage']),
+                          compile_expression(conf.get('max', 'MemTotal')))
+
+    return field_index, compiled
+
+
+def fetch_meminfo_usage(field_index, compiled):
+    """
+    Fetch current values of derived /proc/meminfo series.
 
-    @classmethod
-    def clear_history(cls):
-        """
-        Remove all datapoints.
-        """
-        for res_type in cls._data['datapoints'].keys():
-            cls._data['datapoints'][res_type] = dict()
+    /proc/meminfo is read and parsed exactly once, only the lines which are
+    referenced by the series are converted. Fields expressed in kB are
+    converted to megabytes, others (i.e. HugePages_*) are used as-is.
 
-    @classmethod
-    def save(cls):
-        """
-        Save all the datapoints.
+    Args:
+        field_index, compiled: see compile_meminfo_series()
 
-        This method saves all datapoints not older than
-        (max_averaging_window - 1) * 3600 * 24 seconds to the the file provided
-        in init() call.
-        """
-        cls._remove_old_datapoints()
-        with open(cls._location, 'w') as fh:
-            data = yaml.dump(cls._data, default_flow_style=False)
-            fh.write(data)
+    Returns:
+        A hash with series names as keys and tuples (current usage,
+        max usage, units) as values.
+
+    Raises:
+        RecoverableException: a field is missing from /proc/meminfo or
+            a series mixes fields with different units
+    """
+    table = [None] * len(field_index)
+    in_kb = [False] * len(field_index)
+
+    with open(Host.path('/proc/meminfo'), 'r') as fh:
+        data = fh.read()
+    # Using fh.readlines() would be more convinient but it makes testing difficult
+    for line in data.split('\n'):
+        name, _, value = line.partition(':')
+        slot = field_index.get(name)
+        if slot is None:
+            continue
+        value = value.split()
+        table[slot] = int(value[0])
+        in_kb[slot] = len(value) > 1 and value[1] == 'kB'
+
+    missing = [x for x in field_index if table[field_index[x]] is None]
+    if missing:
+        raise RecoverableException('Fields missing from /proc/meminfo: ' +
+                                   ', '.join(sorted(missing)))
+
+    ret = {}
+    for name, (usage_terms, max_terms) in compiled.items():
+        units = set(in_kb[slot] for _, slot in usage_terms + max_terms)
+        if len(units) > 1:
+            raise RecoverableException('Meminfo series {0} '.format(name) +
+                                       'mixes fields with different units')
+        cur_u = sum(sign * table[slot] for sign, slot in usage_terms)
+        max_u = sum(sign * table[slot] for sign, slot in max_terms)
+        if units.pop():
+            ret[name] = (round(cur_u/1024, 2), round(max_u/1024, 2), 'MB')
+        else:
+            ret[name] = (cur_u, max_u, 'pages')
+
+    return ret
 
 
 def fetch_memory_usage():
@@ -241,25 +1375,12 @@ def fetch_memory_usage():
     Returns:
     A tuple: (memory used, memory total), in megabytes.
     """
-    # Calculation based on 'free' source:
-    # used = MemTotal - MemFree - Cached - Slab - Buffers
-    # total = MemTotal
-    with open('/proc/meminfo', 'r') as fh:
-        data = fh.read()
-    used = 0
-    total = 0
-    # Using fh.readlines() would be more convinient but it makes testing difficult
-    for line in data.split('\n'):
-        if line == '':
-            continue
-        tmp = line.split()
-        if tmp[0][:-1] in ['MemFree', 'Cached', 'Slab', 'Buffers']:
-            used -= int(tmp[1])
-        elif tmp[0][:-1] == 'MemTotal':
-            used += int(tmp[1])
-            total = int(tmp[1])
+    field_index, compiled = compile_meminfo_series(
+        {'memory': {'usage': MEMORY_USAGE_EXPRESSION, 'max': 'MemTotal'}})
+    cur_u, max_u, _ = fetch_meminfo_usage(field_index, compiled)['memory']
+
+    return cur_u, max_u
 
-    return round(used/1024, 2), round(total/1024, 2)
 
 def fetch_disk_usage(mountpoint):
     """
@@ -272,7 +1393,7 @@ def fetch_disk_usage(mountpoint):
     Returns:
     A tuple: (disk usage, total disk space available), in megabytes.
     """
-    statvfs = os.statvfs(mountpoint)
+    statvfs = Host.statvfs(mountpoint)
     cur_u = round(statvfs.f_frsize * (statvfs.f_blocks-statvfs.f_bavail)/1024**2, 2)
     max_u = round(statvfs.f_frsize * statvfs.f_blocks/1024**2, 2)
 
@@ -290,13 +1411,41 @@ def fetch_inode_usage(mountpoint):
     Returns:
     A tuple: (inode usage, total inodes available).
     """
-    statvfs = os.statvfs(mountpoint)
+    statvfs = Host.statvfs(mountpoint)
     cur_u = statvfs.f_files - statvfs.f_ffree
     max_u = statvfs.f_files
 
     return cur_u, max_u
 
 
+def fetch_directory_usage(path, time_budget, rescan_interval):
+    """
+    Fetch current size of a directory tree.
+
+    The tree is scanned incrementally, see DirectoryScanCache class for
+    details.
+
+    Args:
+        path: root of the directory tree for which current usage data should
+            be fetched.
+        time_budget: maximum number of seconds which can be spent on scanning
+        rescan_interval: see DirectoryScanCache.scan() method
+
+    Returns:
+    A tuple: (directory tree size, total space available on the filesystem),
+    in megabytes. Directory tree size is None if the tree has not been fully
+    scanned yet.
+    """
+    cur_u = DirectoryScanCache.scan(path, time_budget, rescan_interval,
+                                    clock=Host.time, location=Host.path(path))
+    if cur_u is not None:
+        cur_u = round(cur_u/1024**2, 2)
+    statvfs = Host.statvfs(path)
+    max_u = round(statvfs.f_frsize * statvfs.f_blocks/1024**2, 2)
+
+    return cur_u, max_u
+
+
 def find_planned_grow_ratio(cur_usage, max_usage, timeframe):
     """
     Calculate 'ideal' growth ratio for a resource.
@@ -315,7 +1464,32 @@ def find_planned_grow_ratio(cur_usage, max_usage, timeframe):
     return round(max_usage/timeframe, 2)
 
 
-def find_current_grow_ratio(datapoints):
+def _lstsq_slope(x, y):
+    """
+    Closed-form least squares slope of y = ax + b, in pure Python.
+
+    Coordinates are taken relative to the last datapoint, which keeps the sums
+    small and the result numerically stable.
+    """
+    x0, y0 = x[-1], y[-1]
+    n = len(x)
+    sx = sy = sxx = sxy = 0.0
+    for xi, yi in zip(x, y):
+        xi -= x0
+        yi -= y0
+        sx += xi
+        sy += yi
+        sxx += xi * xi
+        sxy += xi * yi
+    denominator = n * sxx - sx * sx
+    if denominator == 0:
+        return 0.0
+    return (n * sxy - sx * sy) / denominator
+
+
+def find_current_grow_ratio(datapoints, estimator='lstsq', seasonality=None,
+                            outliers=None,
+                            pure_python_limit=PURE_PYTHON_MAX_DATAPOINTS):
     """
     Find current grow ratio of the resource.
 
@@ -331,21 +1505,152 @@ def find_current_grow_ratio(datapoints):
     Args:
     datapoints: a dictionary with timestamps as keys and resource usages as
         values.
+    estimator: 'lstsq' for least squares, 'theil-sen' for the robust Theil-Sen
+        estimator which ignores short spikes (see trend.theil_sen_slope())
+    seasonality: list of names of periodic components (see
+        SEASONALITY_PERIODS) to remove before the slope is estimated, see
+        trend.remove_seasonality()
+    outliers: timestamps of datapoints which should be ignored
+    pure_python_limit: least squares fits of series with up to this many
+        datapoints are done without numpy
 
     Returns:
-        resource-units/day with 2 digit precision.
+        resource-units/day with 2 digit precision, or None if less than two
+        datapoints are left once the outliers are ignored.
     """
     sorted_x = sorted(datapoints.keys())
-    y = numpy.array([datapoints[x] for x in sorted_x])
-    x = numpy.array(sorted_x)
+    if outliers:
+        outliers = set(outliers)
+        sorted_x = [x for x in sorted_x if x not in outliers]
+    if len(sorted_x) < 2:
+        return None
+
+    if estimator == 'lstsq' and not seasonality and \
+            len(sorted_x) <= pure_python_limit:
+        slope = _lstsq_slope(sorted_x, [datapoints[x] for x in sorted_x])
+        return round(slope*3600*24, 2)
+
+    import numpy
+    y = numpy.array([datapoints[x] for x in sorted_x], dtype=numpy.float64)
+    x = numpy.array(sorted_x, dtype=numpy.float64)
+
+    if seasonality:
+        y = remove_seasonality(x, y, [SEASONALITY_PERIODS[p]
+                                      for p in seasonality])
+    # Fitting against raw UNIX timestamps squares numbers of the order of
+    # 1e9, which loses most of the precision of float64. Timestamps and
+    # values are taken relative to the newest datapoint instead, just like in
+    # _lstsq_slope():
+    x = x - x[-1]
+    y = y - y[-1]
+
+    if estimator == 'theil-sen':
+        slope = theil_sen_slope(x, y)
+    else:
+        A = numpy.vstack([x, numpy.ones(len(x))]).T
+        slope, intercept = numpy.linalg.lstsq(A, y, rcond=-1)[0]
 
-    A = numpy.vstack([x, numpy.ones(len(x))]).T
+    return round(slope*3600*24, 2)
 
-    m, c = numpy.linalg.lstsq(A, y)[0]
 
-    slope, intercept = numpy.linalg.lstsq(A, y)[0]
+def find_window_grow_ratios(datapoints, windows, estimator='lstsq',
+                            seasonality=None, outliers=None,
+                            pure_python_limit=PURE_PYTHON_MAX_DATAPOINTS):
+    """
+    Find current grow ratios of the resource for several averaging windows.
 
-    return round(slope*3600*24, 2)
+    All the windows are evaluated in a single pass over the datapoints. The
+    least squares slope of y = ax + b over the points [i, n) is
+
+        a = (N*Sxy - Sx*Sy) / (N*Sxx - Sx^2)
+
+    and all the sums can be obtained for any i by subtracting prefix sums
+    from their totals, so computing another window costs only a binary search
+    and a few subtractions. Timestamps and values are taken relative to the
+    newest datapoint, which keeps the sums small and the result numerically
+    stable.
+
+    Theil-Sen estimator can not be decomposed this way, so if it is
+    requested, each window is fitted separately.
+
+    Args:
+        datapoints: same as for find_current_grow_ratio()
+        windows: a hash with window names as keys and tuples
+            (averaging window, min averaging window), both in days, as values.
+        estimator: same as for find_current_grow_ratio()
+        seasonality: same as for find_current_grow_ratio(), periodic
+            components are removed once, from the whole series
+        outliers: same as for find_current_grow_ratio()
+        pure_python_limit: same as for find_current_grow_ratio()
+
+    Returns:
+        A hash with window names as keys and resource-units/day with 2 digit
+        precision as values. If there is not enough data in the given window
+        (less than 3 datapoints or time span shorter than min averaging
+        window), the value is None.
+    """
+    sorted_x = sorted(datapoints.keys())
+    if outliers:
+        outliers = set(outliers)
+        sorted_x = [t for t in sorted_x if t not in outliers]
+    if not sorted_x:
+        return {name: None for name in windows}
+
+    if estimator == 'lstsq' and not seasonality and \
+            len(sorted_x) <= pure_python_limit:
+        x0, y0 = sorted_x[-1], datapoints[sorted_x[-1]]
+        x = [(t - x0) / (3600 * 24) for t in sorted_x]
+        prefix_sums = [(0, 0.0, 0.0, 0.0, 0.0)]
+        for xi, t in zip(x, sorted_x):
+            yi = datapoints[t] - y0
+            n, sx, sy, sxx, sxy = prefix_sums[-1]
+            prefix_sums.append((n + 1, sx + xi, sy + yi, sxx + xi * xi,
+                                sxy + xi * yi))
+
+        def search(value):
+            return bisect.bisect_right(x, value)
+
+        def window_sums(start):
+            return [a - b for a, b in zip(prefix_sums[-1],
+                                          prefix_sums[start])]
+    else:
+        import numpy
+        x = numpy.array(sorted_x, dtype=numpy.float64)
+        y = numpy.array([datapoints[t] for t in sorted_x], dtype=numpy.float64)
+        if seasonality:
+            y = remove_seasonality(x, y, [SEASONALITY_PERIODS[p]
+                                          for p in seasonality])
+        x = (x - x[-1]) / (3600 * 24)
+        y = y - y[-1]
+
+        sums = numpy.zeros((5, len(x) + 1))
+        numpy.cumsum(numpy.vstack([numpy.ones(len(x)), x, y, x*x, x*y]),
+                     axis=1, out=sums[:, 1:])
+
+        def search(value):
+            return numpy.searchsorted(x, value, side='right')
+
+        def window_sums(start):
+            return sums[:, -1] - sums[:, start]
+
+    ret = {}
+    for name, (max_window, min_window) in windows.items():
+        # Same border condition as the one HistoryFile uses for trimming:
+        start = search(-max_window)
+        n, sx, sy, sxx, sxy = window_sums(start)
+        if n < 3 or -x[start] < min_window:
+            ret[name] = None
+            continue
+        if estimator == 'theil-sen':
+            ret[name] = round(theil_sen_slope(x[start:], y[start:]), 2)
+            continue
+        denominator = n * sxx - sx * sx
+        if denominator == 0:
+            ret[name] = None
+            continue
+        ret[name] = round(float((n * sxy - sx * sy) / denominator), 2)
+
+    return ret
 
 
 def parse_command_line():
@@ -359,9 +1664,10 @@ def parse_command_line():
         version='1.0')
     parser.add_argument(
         "-c", "--config-file",
-        action='store',
+        action='append',
         required=True,
-        help="Location of the configuration file")
+        help="Location of the configuration file, can be given multiple " +
+             "times to evaluate several configurations in a single run")
     parser.add_argument(
         "-v", "--verbose",
         action='store_true',
@@ -377,18 +1683,383 @@ def parse_command_line():
         action='store_true',
         required=False,
         help="ACK abnormal growth")
+    parser.add_argument(
+        "action",
+        nargs='?',
+        choices=['check', 'sample', 'evaluate', 'export', 'import',
+                 'migrate'],
+        default='check',
+        help="Run the check (default), only sample the resources, only " +
+             "evaluate the samples collected so far, export the datapoints " +
+             "from the history file, import them into it or rewrite it in " +
+             "the configured storage format, without expired datapoints")
+    parser.add_argument(
+        "-f", "--format",
+        choices=FORMATS,
+        default='ndjson',
+        help="Format of exported/imported datapoints")
+    parser.add_argument(
+        "-o", "--data-file",
+        default='-',
+        help="File to export the datapoints to or import them from, " +
+             "stdout/stdin by default")
+    parser.add_argument(
+        "--resource",
+        action='append',
+        choices=RESOURCE_TYPES,
+        help="Export/import only the datapoints of the given resource type, " +
+             "can be given multiple times")
+    parser.add_argument(
+        "--path",
+        action='append',
+        help="Export/import only the datapoints of the given mountpoint, " +
+             "directory, meminfo or collector series, can be given " +
+             "multiple times")
+    parser.add_argument(
+        "--since",
+        type=int,
+        help="Export/import only the datapoints not older than the given " +
+             "UNIX timestamp")
+    parser.add_argument(
+        "--until",
+        type=int,
+        help="Export/import only the datapoints not newer than the given " +
+             "UNIX timestamp")
+    parser.add_argument(
+        "--profile",
+        metavar='PROFILE_DIR',
+        help="Profile CPU usage and memory allocations of the run, store " +
+             "the results in the given directory")
 
     args = parser.parse_args()
+    if args.action != 'check' and len(args.config_file) > 1:
+        parser.error('only a single configuration file can be given for ' +
+                     '{0}'.format(args.action))
     return {'std_err': args.std_err,
             'verbose': args.verbose,
             'config_file': args.config_file,
             'clean_histdata': args.clean_histdata,
+            'action': args.action,
+            'data_format': args.format,
+            'data_file': args.data_file,
+            'filters': {'resources': args.resource,
+                        'paths': args.path,
+                        'since': args.since,
+                        'until': args.until,
+                        },
+            'profile_dir': args.profile,
             }
 
 
+def get_series_id(prefix, path=None, data_type=None):
+    """
+    Return a short, unique identifier of a series.
+
+    Args:
+        prefix, path, data_type: same as for HistoryFile.add_datapoint() method
+
+    Returns:
+        A string like "memory", "disk:/tmp/:inode" or "meminfo:slab".
+    """
+    return ':'.join(str(x) for x in (prefix, path, data_type) if x is not None)
+
+
+def get_resource_name(prefix, path=None, data_type=None):
+    """
+    Return a human readable name of the growth of the given series.
+
+    Args:
+        prefix, path, data_type: same as for HistoryFile.add_datapoint() method
+    """
+    if prefix == 'disk':
+        return '{0} usage growth for mount {1}'.format(data_type, path)
+    elif prefix == 'directory':
+        return 'directory usage growth for path {0}'.format(path)
+    elif prefix == 'meminfo':
+        return 'meminfo series {0} growth'.format(path)
+    elif prefix == 'collector':
+        return 'collector series {0} growth'.format(path)
+    elif prefix == 'group':
+        return 'combined usage growth of series group {0}'.format(path)
+    else:
+        return '{0} usage growth'.format(prefix)
+
+
+def get_conf_val(key, default=None):
+    """
+    Fetch an optional configuration value.
+
+    Args:
+        key: name of the configuration option
+        default: value returned when the option is not set
+
+    Returns:
+        Value of the option from the configuration file or the default.
+    """
+    try:
+        return ScriptConfiguration.get_val(key)
+    except KeyError:
+        return default
+
+
+def load_evaluation_cache(location):
+    """
+    Load results of the previous evaluation, see evaluate_config().
+
+    Returns:
+        A hash with the cached results keyed by series id, empty if the cache
+        does not exist or is not readable.
+    """
+    try:
+        with open(location, 'r') as fh:
+            cache = json.load(fh)
+    except (IOError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    return cache
+
+
+def get_memory_series():
+    """
+    Return definitions of all the memory series enabled in the currently
+    loaded configuration, in the format accepted by compile_meminfo_series().
+    Series are keyed by (prefix, path) tuples.
+    """
+    memory_series = {}
+    if ScriptConfiguration.get_val('memory_mon_enabled'):
+        memory_series[('memory', None)] = {'usage': MEMORY_USAGE_EXPRESSION,
+                                           'max': 'MemTotal'}
+    if get_conf_val('meminfo_mon_enabled', False):
+        for name, conf in ScriptConfiguration.get_val(
+                'meminfo_series').items():
+            memory_series[('meminfo', name)] = conf
+    return memory_series
+
+
+def get_collectors():
+    """
+    Return the collector plugins enabled in the currently loaded
+    configuration.
+
+    Returns:
+        A hash with names of the collectors as keys and Collector objects as
+        values.
+
+    Raises:
+        RecoverableException: a collector could not be loaded
+    """
+    collectors = {}
+    if not get_conf_val('collector_mon_enabled', False):
+        return collectors
+    for name, conf in ScriptConfiguration.get_val('collectors').items():
+        try:
+            collectors[name] = CollectorRegistry.get(name, conf)
+        except ValueError as e:
+            raise RecoverableException(str(e))
+    return collectors
+
+
+def get_config_series():
+    """
+    Return all the series enabled in the currently loaded configuration.
+
+    Returns:
+        A list of (prefix, path, data_type) tuples, in the order in which the
+        series are evaluated.
+    """
+    series = []
+    if ScriptConfiguration.get_val('memory_mon_enabled'):
+        series.append(('memory', None, None))
+    if get_conf_val('meminfo_mon_enabled', False):
+        for name in sorted(ScriptConfiguration.get_val('meminfo_series')):
+            series.append(('meminfo', name, None))
+    if ScriptConfiguration.get_val('disk_mon_enabled'):
+        for dtype in ['space', 'inode']:
+            for mountpoint in ScriptConfiguration.get_val('disk_mountpoints'):
+                series.append(('disk', mountpoint, dtype))
+    if get_conf_val('directory_mon_enabled', False):
+        for path in ScriptConfiguration.get_val('directory_paths'):
+            series.append(('directory', path, None))
+    for name, collector in sorted(get_collectors().items()):
+        for series_name in sorted(collector.series()):
+            series.append(('collector', name + '/' + series_name, None))
+    for name in sorted(get_conf_val('series_groups', None) or {}):
+        series.append(('group', name, None))
+    return series
+
+
+def match_group(group, prefix, path=None, data_type=None):
+    """
+    Check if the series is a member of the series group.
+
+    Args:
+        group: definition of the group, an entry of $series_groups
+        prefix, path, data_type: same as for HistoryFile.add_datapoint() method
+    """
+    if prefix != group['resource']:
+        return False
+    if prefix == 'disk' and data_type != group.get('data_type', 'space'):
+        return False
+    return 'match' not in group or (path is not None and
+                                    fnmatch.fnmatchcase(path, group['match']))
+
+
+def resolve_thresholds(series, windows):
+    """
+    Resolve thresholds and timeframes of the series.
+
+    By default, each series uses $<prefix>_mon_warn_reduction,
+    $<prefix>_mon_crit_reduction and $timeframe. Series groups use the
+    reductions of the resource type of their members. Entries of
+    $threshold_overrides are checked in order and the first one matching the
+    series replaces the values it defines. An entry matches if its `resource`
+    (if given) equals the prefix of the series and its `match` glob (if
+    given) matches the path of the series - mountpoint, directory or meminfo
+    series name. Additional windows which define their own thresholds use
+    them instead of the series ones.
+
+    Args:
+        series: a list of (prefix, path, data_type) tuples
+        windows: a hash with additional windows' definitions
+
+    Returns:
+        A tuple (warn reductions, crit reductions, timeframes) of lists.
+        Reductions have a row for each of the series and a column for
+        the main window followed by columns for the additional windows, in
+        sorted order. Timeframes have a value for each of the series.
+    """
+    overrides = get_conf_val('threshold_overrides', None) or []
+    default_timeframe = ScriptConfiguration.get_val('timeframe')
+    window_names = sorted(windows)
+
+    warn = []
+    crit = []
+    timeframes = []
+    groups = get_conf_val('series_groups', None) or {}
+    defaults = {}
+    for prefix, path, _ in series:
+        base = groups[path]['resource'] if prefix == 'group' else prefix
+        if base not in defaults:
+            defaults[base] = (
+                ScriptConfiguration.get_val(base + '_mon_warn_reduction'),
+                ScriptConfiguration.get_val(base + '_mon_crit_reduction'))
+        warn_reduction, crit_reduction = defaults[base]
+        timeframe = default_timeframe
+        for override in overrides:
+            if override.get('resource', prefix) != prefix:
+                continue
+            if 'match' in override and (path is None or not
+                                        fnmatch.fnmatchcase(path,
+                                                            override['match'])):
+                continue
+            warn_reduction = override.get('warn_reduction', warn_reduction)
+            crit_reduction = override.get('crit_reduction', crit_reduction)
+            timeframe = override.get('timeframe', timeframe)
+            break
+        warn.append([warn_reduction] +
+                    [windows[x].get('warn_reduction', warn_reduction)
+                     for x in window_names])
+        crit.append([crit_reduction] +
+                    [windows[x].get('crit_reduction', crit_reduction)
+                     for x in window_names])
+        timeframes.append(timeframe)
+
+    return warn, crit, timeframes
+
+
+def _status_rank(entry):
+    ratio = 0
+    if entry['current_growth'] is not None and entry['planned_growth']:
+        ratio = entry['current_growth'] / entry['planned_growth']
+    return (STATUS_SEVERITY[entry['status']], ratio)
+
+
+def find_worst_statuses(statuses, top):
+    """
+    Find the `top` worst series which are not OK, see summarize_statuses().
+
+    Args:
+        statuses: see summarize_statuses()
+        top: maximum number of series returned
+
+    Returns:
+        A list of indexes of the statuses, worst first.
+    """
+    return heapq.nlargest(top, (i for i, x in enumerate(statuses)
+                                if x['status'] != 'ok'),
+                          key=lambda i: _status_rank(statuses[i]))
+
+
+def summarize_statuses(statuses, top):
+    """
+    Reduce statuses of the series to a bounded number of messages.
+
+    Series are ranked by their state and then by the ratio of current to
+    planned growth. Finding the `top` worst ones costs O(n log top), and the
+    size of the output does not depend on the number of series.
+
+    Args:
+        statuses: a list of hashes with 'status', 'message', 'current_growth'
+            and 'planned_growth' keys
+        top: maximum number of series which are reported individually
+
+    Returns:
+        A list of (status, message) tuples - the number of series in each of
+        the states, reported with the worst of the states, followed by the
+        messages of at most `top` worst series which are not OK.
+    """
+    counts = collections.Counter(x['status'] for x in statuses)
+    worst_state = max(counts, key=STATUS_SEVERITY.get, default='ok')
+    states = sorted(STATUS_SEVERITY, key=STATUS_SEVERITY.get, reverse=True)
+    summary = '{0} series: '.format(len(statuses)) + \
+              ', '.join('{0} {1}'.format(counts[x], x) for x in states) + '.'
+
+    return [(worst_state, summary)] + \
+        [(statuses[i]['status'], statuses[i]['message'])
+         for i in find_worst_statuses(statuses, top)]
+
+
+def _is_positive_number(value):
+    return isinstance(value, (int, float)) and \
+        not isinstance(value, bool) and value > 0
+
+
+def _verify_reductions(warn_reduction, crit_reduction, windows):
+    """
+    Check the reductions a series ends up with after merging the defaults,
+    the threshold override and the growth windows.
+
+    Args:
+        warn_reduction: warning reduction of the main window of the series
+        crit_reduction: critical reduction of the main window of the series
+        windows: a hash with additional windows' definitions, reductions
+            they do not define are taken from the main window
+
+    Returns:
+        A description of the first problem found, or None.
+    """
+    if not (_is_positive_number(warn_reduction) and
+            _is_positive_number(crit_reduction)):
+        return 'reductions should be positive numbers'
+    if warn_reduction >= crit_reduction:
+        return 'warn_reduction should be lower than crit_reduction'
+    for name in sorted(windows):
+        window_warn = windows[name].get('warn_reduction', warn_reduction)
+        window_crit = windows[name].get('crit_reduction', crit_reduction)
+        # Invalid reductions of the window itself are reported separately:
+        if _is_positive_number(window_warn) and \
+                _is_positive_number(window_crit) and \
+                window_warn >= window_crit:
+            return 'growth window {0} warn_reduction '.format(name) + \
+                   'should be lower than its crit_reduction'
+    return None
+
+
 def verify_conf():
     msg = []
     prefixes = []
+    defaults = {}
 
     timeframe = ScriptConfiguration.get_val('timeframe')
     max_averaging_window = ScriptConfiguration.get_val('max_averaging_window')
@@ -408,13 +2079,52 @@ def verify_conf():
         msg.append('Maximum averaging windown should be grater than ' +
                    'minimal averaging window.')
 
+    windows = get_conf_val('growth_windows', None) or {}
+    for name, window in windows.items():
+        if 'averaging_window' not in window or \
+                'min_averaging_window' not in window:
+            msg.append('Growth window {0} should define '.format(name) +
+                       'averaging_window and min_averaging_window.')
+            continue
+        if not 0 < window['averaging_window'] <= max_averaging_window:
+            msg.append('Growth window {0} should be positive '.format(name) +
+                       'and not greater than max averaging window.')
+        if window['min_averaging_window'] >= window['averaging_window']:
+            msg.append('Growth window {0} min_averaging_window '.format(name) +
+                       'should be lower than its averaging_window.')
+        if not all(_is_positive_number(window[x]) for x in
+                   ['warn_reduction', 'crit_reduction'] if x in window):
+            msg.append('Growth window {0} reductions should '.format(name) +
+                       'be positive ints.')
+
     if ScriptConfiguration.get_val('memory_mon_enabled'):
         prefixes.append('memory_mon_')
     if ScriptConfiguration.get_val('disk_mon_enabled'):
         prefixes.append('disk_mon_')
+    if get_conf_val('directory_mon_enabled', False):
+        prefixes.append('directory_mon_')
+    if get_conf_val('meminfo_mon_enabled', False):
+        prefixes.append('meminfo_mon_')
+    if get_conf_val('collector_mon_enabled', False):
+        prefixes.append('collector_mon_')
     if not prefixes:
         msg.append('There should be at least one resourece check enabled.')
     for prefix in prefixes:
+        if get_conf_val(prefix + 'estimator', 'lstsq') not in ESTIMATORS:
+            msg.append(prefix + 'estimator should be one of: ' +
+                       ', '.join(ESTIMATORS) + '.')
+        outlier_filter = get_conf_val(prefix + 'outlier_filter', None)
+        if outlier_filter is not None and (
+                not isinstance(outlier_filter, dict) or
+                outlier_filter.get('window', 60) < 1 or
+                outlier_filter.get('threshold', 5) <= 0):
+            msg.append(prefix + 'outlier_filter should be a hash with ' +
+                       'positive window and threshold.')
+        for period in get_conf_val(prefix + 'seasonality', None) or []:
+            if period not in SEASONALITY_PERIODS:
+                msg.append(prefix + 'seasonality should be a list of: ' +
+                           ', '.join(sorted(SEASONALITY_PERIODS)) + '.')
+                break
         warn_reduction = ScriptConfiguration.get_val(prefix + 'warn_reduction')
         crit_reduction = ScriptConfiguration.get_val(prefix + 'crit_reduction')
         if warn_reduction <= 0:
@@ -426,16 +2136,165 @@ def verify_conf():
         if warn_reduction >= crit_reduction:
             msg.append(prefix + "warn_reduction should be lower than " +
                        prefix + "crit_reduction.")
+        elif warn_reduction > 0:
+            problem = _verify_reductions(warn_reduction, crit_reduction,
+                                         windows)
+            if problem:
+                msg.append('Thresholds of {0} '.format(prefix[:-5]) +
+                           'series: ' + problem + '.')
+        defaults[prefix[:-5]] = (warn_reduction, crit_reduction)
 
     if ScriptConfiguration.get_val('disk_mon_enabled'):
         mountpoints = ScriptConfiguration.get_val('disk_mountpoints')
         for mountpoint in mountpoints:
             # ismount seems to not properly detect all mount types :/
             # if not (os.path.exists(mountpoint) and os.path.ismount(mountpoint)):
-            if not os.path.exists(mountpoint):
+            if not os.path.exists(Host.path(mountpoint)):
                 msg.append('disk_mountpoint {0} '.format(mountpoint) +
                            'does not point to a valid mountpoint.')
 
+    if get_conf_val('directory_mon_enabled', False):
+        paths = ScriptConfiguration.get_val('directory_paths')
+        if not paths:
+            msg.append('directory_paths should contain at least one path.')
+        for path in paths or []:
+            if not os.path.isdir(path):
+                msg.append('directory_path {0} '.format(path) +
+                           'does not point to a valid directory.')
+        if get_conf_val('directory_scan_time_budget', 10) <= 0:
+            msg.append('directory_scan_time_budget should be a positive int.')
+
+    if get_conf_val('meminfo_mon_enabled', False):
+        series = ScriptConfiguration.get_val('meminfo_series')
+        if not series or not isinstance(series, dict):
+            msg.append('meminfo_series should define at least one series.')
+        else:
+            try:
+                compile_meminfo_series(series)
+            except ValueError as e:
+                msg.append(str(e) + '.')
+
+    if get_conf_val('collector_mon_enabled', False):
+        collectors = ScriptConfiguration.get_val('collectors')
+        if not collectors or not isinstance(collectors, dict):
+            msg.append('collectors should define at least one collector.')
+        else:
+            available = CollectorRegistry.available()
+            for name in sorted(collectors):
+                conf = collectors[name] or {}
+                if name not in available:
+                    msg.append('Collector {0} is not installed.'.format(name))
+                if not isinstance(conf, dict):
+                    msg.append('Configuration of collector ' +
+                               '{0} should be a hash.'.format(name))
+                    continue
+                timeout = conf.get('timeout', COLLECTOR_TIMEOUT)
+                if not isinstance(timeout, (int, float)) or timeout <= 0:
+                    msg.append('Timeout of collector {0} '.format(name) +
+                               'should be a positive number.')
+
+    adaptive = get_conf_val('adaptive_sampling', None)
+    if adaptive is not None:
+        if not isinstance(adaptive, dict) or \
+                not 0 < adaptive.get('min_interval', 0) <= \
+                adaptive.get('max_interval', 0) or \
+                adaptive.get('resolution', 0) <= 0:
+            msg.append('adaptive_sampling should be a hash with positive ' +
+                       'min_interval, max_interval not lower than ' +
+                       'min_interval and positive resolution.')
+
+    push_url = get_conf_val('push_url', None)
+    if push_url is not None:
+        from check_growth.push import PUSH_BATCH_SIZE, PUSH_TIMEOUT
+        if not isinstance(push_url, str) or \
+                not re.match(r'^https?://[^/]+', push_url):
+            msg.append('push_url should be an http:// or https:// URL.')
+        batch_size = get_conf_val('push_batch_size', PUSH_BATCH_SIZE)
+        if not isinstance(batch_size, int) or batch_size < 1:
+            msg.append('push_batch_size should be a positive int.')
+        timeout = get_conf_val('push_timeout', PUSH_TIMEOUT)
+        if not isinstance(timeout, (int, float)) or timeout <= 0:
+            msg.append('push_timeout should be a positive number.')
+
+    groups = get_conf_val('series_groups', None)
+    if groups is not None and not isinstance(groups, dict):
+        msg.append('series_groups should be a hash.')
+        groups = None
+    for name in sorted(groups or {}):
+        group = groups[name]
+        if not isinstance(group, dict) or \
+                group.get('resource') not in RESOURCE_TYPES:
+            msg.append('Series group {0} should define '.format(name) +
+                       'resource, one of: ' + ', '.join(RESOURCE_TYPES) + '.')
+        elif group['resource'] + '_mon_' not in prefixes:
+            msg.append('Series group {0} resource '.format(name) +
+                       'type is not enabled.')
+        elif group.get('data_type', 'space') not in ['inode', 'space']:
+            msg.append('Series group {0} data_type '.format(name) +
+                       'should be either inode or space.')
+
+    max_datapoints = get_conf_val('max_datapoints_per_series', None)
+    if max_datapoints is not None and (not isinstance(max_datapoints, int) or
+                                       max_datapoints < 3):
+        msg.append('max_datapoints_per_series should be an int not lower ' +
+                   'than 3.')
+
+    wal_max_records = get_conf_val('history_wal_max_records',
+                                   HISTORY_WAL_MAX_RECORDS)
+    if not isinstance(wal_max_records, int) or wal_max_records < 1:
+        msg.append('history_wal_max_records should be a positive int.')
+
+    shard_days = get_conf_val('history_shard_days', None)
+    if shard_days is not None and (not isinstance(shard_days, int) or
+                                   shard_days < 1):
+        msg.append('history_shard_days should be a positive int.')
+
+    summary_top = get_conf_val('status_summary_top', None)
+    if summary_top is not None and (not isinstance(summary_top, int) or
+                                    summary_top < 0):
+        msg.append('status_summary_top should be a non-negative int.')
+
+    overrides = get_conf_val('threshold_overrides', None) or []
+    if not isinstance(overrides, list):
+        msg.append('threshold_overrides should be a list.')
+        overrides = []
+    for override in overrides:
+        if not isinstance(override, dict) or \
+                set(override) - set(THRESHOLD_OVERRIDE_KEYS):
+            msg.append('threshold_overrides entries should be hashes ' +
+                       'with keys: ' + ', '.join(THRESHOLD_OVERRIDE_KEYS) + '.')
+            continue
+        if 'resource' in override and \
+                str(override['resource']) + '_mon_' not in prefixes and \
+                not (override['resource'] == 'group' and
+                     get_conf_val('series_groups', None)):
+            msg.append('threshold_overrides entry {0} '.format(override) +
+                       'refers to a resource which is not monitored.')
+        # The entry replaces only the values it defines, so it is checked
+        # merged onto the defaults of each resource it may apply to:
+        if override.get('resource') == 'group':
+            resources = set(x.get('resource') for x in (groups or {}).values()
+                            if isinstance(x, dict))
+        elif 'resource' in override:
+            resources = set([override['resource']])
+        else:
+            resources = set(defaults)
+        for resource in sorted(resources & set(defaults)):
+            warn_reduction, crit_reduction = defaults[resource]
+            problem = _verify_reductions(
+                override.get('warn_reduction', warn_reduction),
+                override.get('crit_reduction', crit_reduction), windows)
+            if problem:
+                msg.append('threshold_overrides entry {0} '.format(override) +
+                           'applied to {0} series: '.format(resource) +
+                           problem + '.')
+        if 'timeframe' in override and (
+                not _is_positive_number(override['timeframe']) or
+                0.5 * override['timeframe'] <= max_averaging_window):
+            msg.append('threshold_overrides entry {0} '.format(override) +
+                       'timeframe should be greater than ' +
+                       '2 * max averaging window.')
+
     # if there are problems with configuration file then there is no point
     # in continuing:
     if msg:
@@ -447,16 +2306,851 @@ def verify_conf():
     return
 
 
-def main(config_file, std_err=False, verbose=True, clean_histdata=False):
+class EvaluationRun():
+    """
+    State of the evaluation of a single configuration.
+
+    It is shared by the functions which sample the series, evaluate them and
+    report the results, see evaluate_config(). Settings are resolved only
+    once, when the object is created, so the functions do not depend on the
+    configuration being loaded.
+
+    Attributes:
+        series: a list of (prefix, path, data_type) tuples of all the series,
+            see get_config_series()
+        series_index: a hash mapping the series to their positions in the list
+        warn_reductions, crit_reductions, timeframes: thresholds of the
+            series, see resolve_thresholds()
+        windows: a hash with additional windows' definitions
+        window_names: names of the additional windows, sorted
+        window_spans: a hash with (averaging window, min averaging window)
+            tuples of the additional windows
+        options: a hash with (estimator, seasonality, outlier filter) tuples
+            of the resource types, see series_options() method
+        config_name: see evaluate_config()
+        mode: see evaluate_config()
+        perfdata_enabled: gather performance data of the series
+        summary_top: see summarize_statuses(), None disables the summary
+        status_sidecar: location of the JSON file with statuses of all the
+            series, None disables it
+        adaptive: settings of the adaptive sampling, None disables it
+        push_url: URL the samples and results are pushed to, if any
+        pure_python_limit: see find_current_grow_ratio()
+        statuses: statuses of the series, in a structured form, reported at
+            the very end so that they can be summarized
+        perfdata: performance data of the series, keyed by the index of their
+            status
+        results: outcome of the evaluation of each of the series, used by
+            exporters
+        evaluations: growth ratios waiting for the threshold check, as (series
+            index, window column, current growth, planned growth, units)
+            tuples
+        sampled: ids of the series sampled during this run
+        skipped: ids of the series which were not due yet
+        pushed: samples and results sent to the central collector
+        eval_cache: evaluation cache loaded from the file, see
+            evaluate_cached_series()
+        new_eval_cache: evaluation cache to be saved
+    """
+
+    def __init__(self, series, thresholds, windows=None, options=None,
+                 config_name=None, mode='check', perfdata_enabled=False,
+                 summary_top=None, status_sidecar=None, adaptive=None,
+                 push_url=None, pure_python_limit=PURE_PYTHON_MAX_DATAPOINTS):
+        """
+        Args:
+            thresholds: a tuple (warn reductions, crit reductions,
+                timeframes), as returned by resolve_thresholds()
+            other: see class attributes
+        """
+        self.series = series
+        self.series_index = {x: i for i, x in enumerate(series)}
+        self.warn_reductions, self.crit_reductions, self.timeframes = \
+            thresholds
+        self.windows = windows or {}
+        self.window_names = sorted(self.windows)
+        self.window_spans = {x: (self.windows[x]['averaging_window'],
+                                 self.windows[x]['min_averaging_window'])
+                             for x in self.windows}
+        self.options = options or {}
+        self.config_name = config_name
+        self.mode = mode
+        self.perfdata_enabled = perfdata_enabled
+        self.summary_top = summary_top
+        self.status_sidecar = status_sidecar
+        self.adaptive = adaptive
+        self.push_url = push_url
+        self.pure_python_limit = pure_python_limit
+
+        self.statuses = []
+        self.perfdata = {}
+        self.results = []
+        self.evaluations = []
+        self.sampled = []
+        self.skipped = []
+        self.pushed = []
+        self.eval_cache = {}
+        self.new_eval_cache = {}
+
+    @classmethod
+    def from_config(cls, config_name=None, mode='check'):
+        """
+        Create the state of the evaluation of the configuration which is
+        currently loaded.
+        """
+        series = get_config_series()
+        windows = get_conf_val('growth_windows', None) or {}
+        # Thresholds are resolved only once, into lists aligned with the list
+        # of the series:
+        thresholds = resolve_thresholds(series, windows)
+        options = {x: (get_conf_val(x + '_mon_estimator', 'lstsq'),
+                       get_conf_val(x + '_mon_seasonality', None),
+                       get_conf_val(x + '_mon_outlier_filter', None))
+                   for x in RESOURCE_TYPES}
+        return cls(series, thresholds, windows=windows, options=options,
+                   config_name=config_name, mode=mode,
+                   perfdata_enabled=get_conf_val('perfdata_enabled', False),
+                   summary_top=get_conf_val('status_summary_top', None),
+                   status_sidecar=get_conf_val('status_sidecar', None),
+                   adaptive=get_conf_val('adaptive_sampling', None),
+                   push_url=get_conf_val('push_url', None),
+                   pure_python_limit=get_conf_val(
+                       'pure_python_max_datapoints',
+                       PURE_PYTHON_MAX_DATAPOINTS))
+
+    def series_options(self, prefix):
+        """
+        Return (estimator, seasonality, outlier filter) tuple with the
+        settings of the given resource type.
+        """
+        return self.options.get(prefix, ('lstsq', None, None))
+
+    def update_status(self, status, msg, series_id=None, window=None,
+                      current_growth=None, planned_growth=None):
+        self.statuses.append({'status': status,
+                              'message': msg,
+                              'series': series_id,
+                              'window': window,
+                              'current_growth': current_growth,
+                              'planned_growth': planned_growth,
+                              })
+
+
+def check_thresholds(run):
+    """
+    Compare the growth ratios gathered so far with their thresholds and
+    record the statuses and the performance data of the series.
+    """
+    evaluations = run.evaluations
+    if not evaluations:
+        return
+    # All the series are checked at once:
+    warn_limits = [x[3] * (1 + run.warn_reductions[x[0]][x[1]]/100)
+                   for x in evaluations]
+    crit_limits = [x[3] * (1 + run.crit_reductions[x[0]][x[1]]/100)
+                   for x in evaluations]
+    exceeds_warn = [x[2] > limit for x, limit in zip(evaluations,
+                                                      warn_limits)]
+    exceeds_crit = [warn and x[2] > limit for x, warn, limit in
+                    zip(evaluations, exceeds_warn, crit_limits)]
+
+    for k, (i, col, current_growth, planned_growth, units) in \
+            enumerate(evaluations):
+        prefix, path, data_type = run.series[i]
+        window = run.window_names[col - 1] if col else None
+
+        if units is not None:
+            units = units + '/day'
+        elif prefix == 'disk' and data_type == 'inode':
+            units = 'inodes/day'
+        else:
+            units = 'MB/day'
+
+        rname = get_resource_name(prefix, path, data_type)
+        if window is not None:
+            rname += ' ({0} window)'.format(window)
+        rname = rname.capitalize()
+
+        label = get_series_id(prefix, path, data_type) + '_growth'
+        if window is not None:
+            label += '_' + window
+        if run.config_name is not None:
+            label = run.config_name + ':' + label
+        if run.perfdata_enabled:
+            run.perfdata[len(run.statuses)] = (label, current_growth,
+                                               round(warn_limits[k], 2),
+                                               round(crit_limits[k], 2))
+
+        details = {'series_id': get_series_id(prefix, path, data_type),
+                   'window': window,
+                   'current_growth': current_growth,
+                   'planned_growth': planned_growth}
+        if exceeds_warn[k]:
+            msg = '{0} exceeds planned growth '.format(rname) + \
+                  '- current: {0} {1}'.format(current_growth, units) + \
+                  ', planned: {0} {1}.'.format(planned_growth, units)
+            if exceeds_crit[k]:
+                run.update_status('crit', msg, **details)
+            else:
+                run.update_status('warn', msg, **details)
+        else:
+            run.update_status('ok',
+                              '{0} is OK ({1} {2}).'.format(
+                                  rname, current_growth, units),
+                              **details)
+
+
+def report_statuses(run):
+    """
+    Pass the statuses and the performance data of the series to the
+    monitoring system, summarized if requested, and write the status sidecar.
+    """
+    if run.summary_top is None:
+        messages = [(x['status'], x['message']) for x in run.statuses]
+        charted = sorted(run.perfdata)
+    else:
+        messages = summarize_statuses(run.statuses, run.summary_top)
+        # Perfdata is capped to the series which are reported, otherwise it
+        # would grow with the number of series all the same:
+        charted = sorted(set(run.perfdata).intersection(
+            find_worst_statuses(run.statuses, run.summary_top)))
+    for status, msg in messages:
+        if run.config_name is not None:
+            msg = '{0}: {1}'.format(run.config_name, msg)
+        ScriptStatus.update(status, msg)
+    for i in charted:
+        PerfData.add(*run.perfdata[i])
+
+    if run.status_sidecar:
+        write_status_sidecar(run.status_sidecar, run.statuses)
+
+
+def _skip_sampling(run, prefix, path=None, data_type=None):
+    # With adaptive sampling, series which are not due yet are evaluated
+    # using their most recent sample:
+    if run.adaptive is None or HistoryFile.is_sample_due(
+            prefix, path=path, data_type=data_type,
+            tolerance=run.adaptive['min_interval'] / 2):
+        return False
+    sample = HistoryFile.get_last_sample(prefix, path=path,
+                                         data_type=data_type)
+    if sample is None:
+        return False
+    run.skipped.append(get_series_id(prefix, path, data_type))
+    if run.mode != 'sample':
+        _, cur_usage, max_usage, units = sample
+        evaluate_series(run, prefix, cur_usage, max_usage, path=path,
+                        data_type=data_type, units=units)
+    return True
+
+
+def sample_series(run, prefix, cur_usage, max_usage, path=None,
+                  data_type=None, units=None):
+    """
+    Store a sample of the series in the history and evaluate the series,
+    unless only sampling was requested.
+
+    With adaptive sampling, a series which is not due yet is not sampled,
+    its most recent sample is evaluated instead.
+    """
+    if _skip_sampling(run, prefix, path=path, data_type=data_type):
+        return
+    timestamp = HistoryFile.add_datapoint(prefix, cur_usage, path=path,
+                                          data_type=data_type)
+    HistoryFile.set_limit(prefix, max_usage, units, path=path,
+                          data_type=data_type)
+    run.sampled.append(get_series_id(prefix, path, data_type))
+    if run.adaptive is not None:
+        HistoryFile.adapt_sampling_interval(
+            prefix, max_usage, run.adaptive['min_interval'],
+            run.adaptive['max_interval'], run.adaptive['resolution'] / 100,
+            path=path, data_type=data_type)
+    if run.push_url:
+        run.pushed.append({'type': 'sample',
+                           'series': get_series_id(prefix, path, data_type),
+                           'prefix': prefix,
+                           'path': path,
+                           'data_type': data_type,
+                           'units': units,
+                           'timestamp': timestamp,
+                           'cur_usage': cur_usage,
+                           'max_usage': max_usage,
+                           })
+
+    outlier_filter = run.series_options(prefix)[2]
+    if outlier_filter:
+        if HistoryFile.filter_datapoint(
+                prefix, cur_usage, timestamp, path=path,
+                data_type=data_type,
+                window=outlier_filter.get('window', 60),
+                threshold=outlier_filter.get('threshold', 5)):
+            logging.info('{0}: datapoint {1} '.format(
+                get_resource_name(prefix, path, data_type), cur_usage) +
+                'has been flagged as an outlier')
+
+    if run.mode != 'sample':
+        evaluate_series(run, prefix, cur_usage, max_usage, path=path,
+                        data_type=data_type, units=units)
+
+
+def sample_resources(run, meminfo, collected):
+    """
+    Sample all the resources enabled in the configuration which is currently
+    loaded, see sample_series().
+
+    Args:
+        meminfo: see evaluate_config()
+        collected: see evaluate_config()
+    """
+    if ScriptConfiguration.get_val('memory_mon_enabled'):
+        cur_usage, max_usage, _ = meminfo[('memory', None)]
+        sample_series(run, 'memory', cur_usage, max_usage)
+
+    if get_conf_val('meminfo_mon_enabled', False):
+        for name in sorted(x[1] for x in meminfo if x[0] == 'meminfo'):
+            cur_usage, max_usage, units = meminfo[('meminfo', name)]
+            sample_series(run, 'meminfo', cur_usage, max_usage, path=name,
+                          units=units)
+
+    if ScriptConfiguration.get_val('disk_mon_enabled'):
+        mountpoints = ScriptConfiguration.get_val('disk_mountpoints')
+        for dtype in ['space', 'inode']:
+            for mountpoint in mountpoints:
+                if dtype == 'inode':
+                    cur_usage, max_usage = SampleCache.get(
+                        ('disk', mountpoint, dtype), fetch_inode_usage,
+                        mountpoint)
+                else:
+                    cur_usage, max_usage = SampleCache.get(
+                        ('disk', mountpoint, dtype), fetch_disk_usage,
+                        mountpoint)
+                sample_series(run, 'disk', cur_usage, max_usage,
+                              path=mountpoint, data_type=dtype)
+
+    if get_conf_val('directory_mon_enabled', False):
+        DirectoryScanCache.init(get_conf_val(
+            'directory_scan_cache',
+            ScriptConfiguration.get_val('history_file') + '.dirscan'))
+        paths = ScriptConfiguration.get_val('directory_paths')
+        # Each tree gets an equal share of the budget so that a big tree
+        # can not starve the others:
+        time_budget = get_conf_val('directory_scan_time_budget', 10) / \
+            len(paths)
+        rescan_interval = get_conf_val('directory_rescan_interval', 1)
+        for path in paths:
+            # Scanning a tree is expensive, so it is skipped altogether if
+            # the series is not due:
+            if _skip_sampling(run, 'directory', path=path):
+                continue
+            cur_usage, max_usage = SampleCache.get(
+                ('directory', path), fetch_directory_usage, path,
+                time_budget, rescan_interval)
+            if cur_usage is None:
+                run.update_status('unknown',
+                                  'Initial scan of directory ' +
+                                  '{0} is still in progress.'.format(path),
+                                  series_id=get_series_id('directory', path))
+                continue
+            sample_series(run, 'directory', cur_usage, max_usage, path=path)
+        DirectoryScanCache.save()
+
+    if get_conf_val('collector_mon_enabled', False):
+        for name, collector in sorted(get_collectors().items()):
+            samples, error = collected[name]
+            declared = collector.series()
+            for series_name in sorted(declared):
+                path = name + '/' + series_name
+                if error is None and series_name in samples:
+                    cur_usage, max_usage = samples[series_name]
+                    sample_series(run, 'collector', cur_usage, max_usage,
+                                  path=path, units=declared[series_name])
+                    continue
+                reason = error or 'series {0} was not collected'.format(
+                    series_name)
+                run.update_status('unknown',
+                                  'Collector {0}: {1}.'.format(name, reason),
+                                  series_id=get_series_id('collector', path))
+
+
+def evaluate_cached_series(run, prefix, timestamp, cur_usage, max_usage,
+                           path=None, data_type=None, units=None):
+    """
+    Evaluate the series, unless it has not changed since it was last
+    evaluated - its cached results are used then, see evaluate_config().
+
+    Args:
+        timestamp: timestamp of the most recent sample of the series
+    """
+    series_id = get_series_id(prefix, path, data_type)
+    i = run.series_index[(prefix, path, data_type)]
+    # Everything the results of evaluate_series() depend on - the state of
+    # the series and every setting used to evaluate it. The state is
+    # summarized by values which are cheap to get, the datapoints themselves
+    # are read only if the series has to be evaluated again:
+    estimator, seasonality, outlier_filter = run.series_options(prefix)
+    key = [HistoryFile.count_datapoints(prefix, path=path,
+                                        data_type=data_type),
+           timestamp,
+           len(HistoryFile.get_outliers(prefix, path=path,
+                                        data_type=data_type)),
+           cur_usage, max_usage, units, run.timeframes[i],
+           ScriptConfiguration.get_val('max_averaging_window'),
+           ScriptConfiguration.get_val('min_averaging_window'),
+           estimator, seasonality, outlier_filter, run.pure_python_limit,
+           [[x] + list(run.window_spans[x]) for x in run.window_names]]
+
+    cached = run.eval_cache.get(series_id)
+    if cached is not None and cached['key'] == key:
+        logging.debug('{0} has not changed since '.format(series_id) +
+                      'the last evaluation, using cached results')
+        run.results.append(cached['result'])
+        run.statuses.extend(cached['statuses'])
+        run.evaluations.extend((i,) + tuple(x) for x in cached['evaluations'])
+    else:
+        first_result = len(run.results)
+        first_status = len(run.statuses)
+        first_evaluation = len(run.evaluations)
+        evaluate_series(run, prefix, cur_usage, max_usage, path=path,
+                        data_type=data_type, units=units)
+        cached = {'key': key,
+                  'result': run.results[first_result],
+                  'statuses': run.statuses[first_status:],
+                  'evaluations': [x[1:] for x in
+                                  run.evaluations[first_evaluation:]],
+                  }
+    run.new_eval_cache[series_id] = cached
+
+
+def evaluate_series(run, prefix, cur_usage, max_usage, path=None,
+                    data_type=None, units=None):
+    """
+    Estimate the growth of the series in the main window and in all the
+    additional ones, using the datapoints stored in the history.
+
+    The outcome is added to the results of the run, the growth ratios wait
+    for the threshold check, see check_thresholds().
+    """
+    rname = get_resource_name(prefix, path, data_type)
+    estimator, seasonality, outlier_filter = run.series_options(prefix)
+
+    outliers = None
+    if outlier_filter:
+        outliers = HistoryFile.get_outliers(prefix, path=path,
+                                            data_type=data_type)
+    i = run.series_index[(prefix, path, data_type)]
+    planned_growth = find_planned_grow_ratio(cur_usage, max_usage,
+                                             run.timeframes[i])
+    datapoints = HistoryFile.get_datapoints(prefix, path=path,
+                                            data_type=data_type)
+    result = {'prefix': prefix,
+              'path': path,
+              'data_type': data_type,
+              'units': units or ('inodes' if data_type == 'inode' else 'MB'),
+              'cur_usage': cur_usage,
+              'max_usage': max_usage,
+              'planned_growth': planned_growth,
+              'days_to_full': None,
+              'datapoints': len(datapoints),
+              'growth': {},
+              }
+    run.results.append(result)
+
+    # Datapoints flagged as outliers are ignored by the estimators, so they
+    # do not count towards the data span either:
+    tmp = HistoryFile.verify_dataspan(prefix, path=path, data_type=data_type,
+                                      outliers=outliers)
+    current_growth = None
+    if tmp >= 0:
+        current_growth = find_current_grow_ratio(
+            datapoints, estimator=estimator, seasonality=seasonality,
+            outliers=outliers, pure_python_limit=run.pure_python_limit)
+    if tmp < 0:
+        run.update_status('unknown',
+                          'There is not enough data to calculate ' +
+                          'current {0}: {1} '.format(rname, abs(tmp)) +
+                          'days more is needed.',
+                          series_id=get_series_id(prefix, path, data_type))
+    elif current_growth is None:
+        run.update_status('unknown',
+                          'There is not enough data to calculate ' +
+                          'current {0}.'.format(rname),
+                          series_id=get_series_id(prefix, path, data_type))
+    else:
+        result['growth']['main'] = current_growth
+        if current_growth > 0:
+            result['days_to_full'] = round(
+                (max_usage - cur_usage) / current_growth, 2)
+        else:
+            result['days_to_full'] = float('inf')
+
+        logging.debug('{0} -> '.format(rname) +
+                      'current_growth: {0}, '.format(current_growth) +
+                      'planned_growth: {0}'.format(planned_growth))
+        run.evaluations.append((i, 0, current_growth, planned_growth, units))
+
+    if not run.windows:
+        return
+
+    # All the additional windows are evaluated in a single pass:
+    ratios = find_window_grow_ratios(datapoints, run.window_spans,
+                                     estimator=estimator,
+                                     seasonality=seasonality,
+                                     outliers=outliers,
+                                     pure_python_limit=run.pure_python_limit)
+    result['growth'].update(ratios)
+    for window in sorted(ratios):
+        if ratios[window] is None:
+            run.update_status('unknown',
+                              'There is not enough data to ' +
+                              'calculate current {0} '.format(rname) +
+                              'in {0} window.'.format(window),
+                              series_id=get_series_id(prefix, path,
+                                                      data_type),
+                              window=window)
+            continue
+        logging.debug('{0}, {1} window -> '.format(rname, window) +
+                      'current_growth: {0}, '.format(ratios[window]) +
+                      'planned_growth: {0}'.format(planned_growth))
+        run.evaluations.append((i, 1 + run.window_names.index(window),
+                                ratios[window], planned_growth, units))
+
+
+def evaluate_group(run, name, group):
+    """
+    Evaluate the series group using the results of its members gathered so
+    far, see match_group().
+    """
+    series_id = get_series_id('group', name)
+    i = run.series_index[('group', name, None)]
+    rname = get_resource_name('group', name)
+    members = [x for x in run.results if match_group(group, x['prefix'],
+                                                     x['path'],
+                                                     x['data_type'])]
+    if not members:
+        run.update_status('unknown',
+                          'Series group {0} has no members.'.format(name),
+                          series_id=series_id)
+        return
+    units = sorted(set(x['units'] for x in members))
+    if len(units) > 1:
+        run.update_status('unknown',
+                          'Configuration of series group {0} '.format(name) +
+                          'is invalid, its members have different units: ' +
+                          ', '.join(units) + '.', series_id=series_id)
+        return
+
+    cur_usage = round(sum(x['cur_usage'] for x in members), 2)
+    max_usage = round(sum(x['max_usage'] for x in members), 2)
+    planned_growth = find_planned_grow_ratio(cur_usage, max_usage,
+                                             run.timeframes[i])
+    units = units[0]
+    result = {'prefix': 'group',
+              'path': name,
+              'data_type': None,
+              'units': units,
+              'cur_usage': cur_usage,
+              'max_usage': max_usage,
+              'planned_growth': planned_growth,
+              'days_to_full': None,
+              'datapoints': sum(x['datapoints'] for x in members),
+              'growth': {},
+              }
+    run.results.append(result)
+
+    # The growth of the group is approximated by the sum of the growth ratios
+    # of its members, without summing their datapoints. This is exact only
+    # for plain least squares fits of series sampled at the same times - with
+    # other estimators, outlier filtering, seasonality or unaligned samples
+    # it is an estimate:
+    for col, window in enumerate([None] + run.window_names):
+        key = 'main' if window is None else window
+        ratios = [x['growth'].get(key) for x in members]
+        if None in ratios:
+            msg = 'There is not enough data to calculate ' + \
+                  'current {0}'.format(rname)
+            if window is not None:
+                msg += ' in {0} window'.format(window)
+            run.update_status('unknown', msg + '.', series_id=series_id,
+                              window=window)
+            continue
+        current_growth = round(sum(ratios), 2)
+        result['growth'][key] = current_growth
+        if window is None:
+            if current_growth > 0:
+                result['days_to_full'] = round(
+                    (max_usage - cur_usage) / current_growth, 2)
+            else:
+                result['days_to_full'] = float('inf')
+        logging.debug('{0} -> '.format(rname) +
+                      'current_growth: {0}, '.format(current_growth) +
+                      'planned_growth: {0}'.format(planned_growth))
+        run.evaluations.append((i, col, current_growth, planned_growth,
+                                units))
+
+
+def push_results(run):
+    """
+    Queue the samples and the results of the run for the central collector
+    and try to send everything queued so far, see check_growth.push.
+    """
+    # The push module pulls in http.client, which is not worth importing
+    # when nothing is pushed:
+    from check_growth.push import PUSH_BATCH_SIZE, PUSH_TIMEOUT
+    from check_growth.push import flush_spool, spool_entries
+    now = round(Host.time())
+    pushed = list(run.pushed)
+    if run.mode != 'sample':
+        for result in run.results:
+            entry = dict(result, type='result', timestamp=now,
+                         series=get_series_id(result['prefix'],
+                                              result['path'],
+                                              result['data_type']))
+            if entry['days_to_full'] == float('inf'):
+                entry['days_to_full'] = None
+            pushed.append(entry)
+    hostname = socket.gethostname()
+    for entry in pushed:
+        entry['host'] = hostname
+        entry['config'] = run.config_name
+    # Entries are queued on disk first, so none of them is lost if the
+    # collector is not reachable:
+    push_spool = get_conf_val('push_spool', None) or \
+        ScriptConfiguration.get_val('history_file') + '.spool'
+    spool_entries(push_spool, pushed)
+    flush_spool(push_spool, run.push_url,
+                batch_size=get_conf_val('push_batch_size', PUSH_BATCH_SIZE),
+                timeout=get_conf_val('push_timeout', PUSH_TIMEOUT),
+                now=now)
+
+
+def evaluate_config(meminfo, clean_histdata, start_time, config_name=None,
+                    mode='check', collected=None):
+    """
+    Evaluate the configuration which is currently loaded.
+
+    Resources are sampled through SampleCache, so a resource which was
+    already sampled for another configuration during this run is not
+    sampled again.
+
+    Sampling is cheap, while estimating the growth is not, so both can be
+    done separately and at different intervals. In 'sample' mode, datapoints
+    are only appended to the history. In 'evaluate' mode, no resources are
+    sampled and the most recent samples stored in the history are evaluated
+    instead. Results of the evaluation of each series are cached in
+    $evaluation_cache, keyed by the state of the series (number of
+    datapoints, last datapoint, outliers) and all the settings its evaluation
+    depends on. If the series has not changed since it was last evaluated,
+    its cached growth ratios and statuses are used, without reading its
+    datapoints. Verdicts are always checked against the current thresholds.
+
+    Args:
+        meminfo: values of the memory series of this configuration, as
+            returned by fetch_meminfo_usage() for get_memory_series()
+        clean_histdata: all historical data should be cleared
+        start_time: time the run has started at
+        config_name: name of the configuration, prepended to all the
+            messages and perfdata labels. Used when several configurations
+            are evaluated in a single run.
+        mode: 'check' - sample and evaluate, 'sample' or 'evaluate', see
+            above.
+        collected: results of the collectors of this configuration, as
+            returned by run_collectors() for get_collectors()
+    """
+    # The history file is locked only while it is being saved, so runs which
+    # check different resources do not wait for each other:
+    HistoryFile.init(location=ScriptConfiguration.get_val('history_file'),
+                     max_averaging_window=ScriptConfiguration.get_val(
+                         'max_averaging_window'),
+                     min_averaging_window=ScriptConfiguration.get_val(
+                         'min_averaging_window'),
+                     max_datapoints=get_conf_val('max_datapoints_per_series',
+                                                 None),
+                     lock_location=ScriptConfiguration.get_val('lockfile'),
+                     wal_max_records=get_conf_val('history_wal_max_records',
+                                                  HISTORY_WAL_MAX_RECORDS),
+                     shard_period=get_conf_val('history_shard_days', None),
+                     compact=get_conf_val('history_compact_storage', False))
+
+    if clean_histdata:
+        HistoryFile.clear_history()
+        HistoryFile.save()
+        return
+
+    run = EvaluationRun.from_config(config_name=config_name, mode=mode)
+    sampling = mode != 'evaluate'
+
+    if sampling:
+        sample_resources(run, meminfo, collected)
+
+    if mode == 'evaluate':
+        eval_cache_location = get_conf_val('evaluation_cache', None) or \
+            ScriptConfiguration.get_val('history_file') + '.eval'
+        run.eval_cache = load_evaluation_cache(eval_cache_location)
+        for prefix, path, data_type in run.series:
+            if prefix == 'group':
+                continue
+            sample = HistoryFile.get_last_sample(prefix, path=path,
+                                                 data_type=data_type)
+            if sample is None:
+                run.update_status(
+                    'unknown',
+                    'No samples of {0} '.format(
+                        get_resource_name(prefix, path, data_type)) +
+                    'have been collected yet.',
+                    series_id=get_series_id(prefix, path, data_type))
+                continue
+            timestamp, cur_usage, max_usage, units = sample
+            evaluate_cached_series(run, prefix, timestamp, cur_usage,
+                                   max_usage, path=path, data_type=data_type,
+                                   units=units)
+        write_atomically(eval_cache_location,
+                         json.dumps(run.new_eval_cache,
+                                    separators=(',', ':')))
+
+    if mode != 'sample':
+        groups = get_conf_val('series_groups', None) or {}
+        for name in sorted(groups):
+            evaluate_group(run, name, groups[name])
+
+    if mode == 'sample':
+        msg = '{0} series sampled.'.format(len(run.sampled))
+        if run.skipped:
+            msg = '{0} series sampled, {1} not due yet.'.format(
+                len(run.sampled), len(run.skipped))
+        if config_name is not None:
+            msg = '{0}: {1}'.format(config_name, msg)
+        ScriptStatus.update('ok', msg)
+    else:
+        check_thresholds(run)
+        report_statuses(run)
+
+        prometheus_textfile = get_conf_val('prometheus_textfile', None)
+        if prometheus_textfile:
+            write_prometheus_textfile(prometheus_textfile, run.results,
+                                      time.time() - start_time)
+
+    if sampling:
+        HistoryFile.save()
+
+    if run.push_url:
+        push_results(run)
+
+
+def transfer_history(config_file, action, data_format, data_file,
+                     filters=None):
+    """
+    Export the datapoints from the history file, import them into it or
+    migrate it.
+
+    Datapoints are streamed one by one, the memory usage does not depend on
+    the size of the exported/imported data. Migration rewrites the history
+    file (and its shards) in the storage format set in the configuration,
+    see history_shard_days and history_compact_storage. The file is streamed
+    as well and datapoints older than max_averaging_window are dropped while
+    it is being read, so oversized histories can be trimmed this way.
+
+    Args:
+        config_file: file path of the config file with the location of the
+            history file
+        action: 'export', 'import' or 'migrate'
+        data_format: one of histio.FORMATS
+        data_file: file to export the datapoints to or import them from, '-'
+            means stdout/stdin
+        filters: keyword arguments of histio.filter_datapoints()
+
+    Returns:
+        Number of exported/imported/migrated datapoints.
+    """
+    ScriptConfiguration.load_config(config_file)
+    filters = filters or {}
+
+    if action == 'export':
+        # The history is streamed instead of being loaded by init():
+        datapoints = filter_datapoints(
+            HistoryFile.stream_datapoints(
+                location=ScriptConfiguration.get_val('history_file'),
+                max_averaging_window=ScriptConfiguration.get_val(
+                    'max_averaging_window'),
+                lock_location=ScriptConfiguration.get_val('lockfile')),
+            **filters)
+        if data_file == '-':
+            count = dump_datapoints(datapoints, sys.stdout, data_format)
+        else:
+            with open(data_file, 'w', newline='') as fh:
+                count = dump_datapoints(datapoints, fh, data_format)
+        logging.info('Exported {0} datapoints'.format(count))
+        return count
+
+    HistoryFile.init(location=ScriptConfiguration.get_val('history_file'),
+                     max_averaging_window=ScriptConfiguration.get_val(
+                         'max_averaging_window'),
+                     min_averaging_window=ScriptConfiguration.get_val(
+                         'min_averaging_window'),
+                     max_datapoints=get_conf_val('max_datapoints_per_series',
+                                                 None),
+                     lock_location=ScriptConfiguration.get_val('lockfile'),
+                     shard_period=get_conf_val('history_shard_days', None),
+                     compact=get_conf_val('history_compact_storage', False))
+
+    if action == 'migrate':
+        HistoryFile.save(compact=True)
+        count = sum(1 for _ in HistoryFile.iter_datapoints())
+        logging.info('Migrated {0} datapoints'.format(count))
+        return count
+
+    def do_import(fh):
+        count = 0
+        for datapoint in filter_datapoints(load_datapoints(fh, data_format),
+                                           **filters):
+            HistoryFile.import_datapoint(*datapoint)
+            count += 1
+        return count
+
+    if data_file == '-':
+        count = do_import(sys.stdin)
+    else:
+        with open(data_file, 'r', newline='') as fh:
+            count = do_import(fh)
+    # Imported datapoints go straight to the history file instead of
+    # bloating the write-ahead log:
+    HistoryFile.save(compact=True)
+    logging.info('Imported {0} datapoints'.format(count))
+    return count
+
+
+def main(config_file, std_err=False, verbose=True, clean_histdata=False,
+         action='check', data_format='ndjson', data_file='-', filters=None,
+         profile_dir=None):
     """
     Main function of the script
 
     Args:
-        config_file: file path of the config file to load
+        config_file: file path of the config file to load, or a list of them.
+            All the configurations are evaluated in a single run and the
+            resources they have in common are sampled only once.
         std_err: whether print logging output to stderr
         verbose: whether to provide verbose logging messages
         clean_histdata: all historical data should be cleared
+        action: 'check' runs the check, 'sample' and 'evaluate' run only one
+            half of it (see evaluate_config()), 'export', 'import' and
+            'migrate' are handled by transfer_history()
+        data_format, data_file, filters: see transfer_history()
+        profile_dir: if set, the run is profiled and the results are stored
+            in the given directory, see profiling.profiled()
     """
+    if profile_dir is not None:
+        with profiled(profile_dir):
+            return main(config_file, std_err=std_err, verbose=verbose,
+                        clean_histdata=clean_histdata, action=action,
+                        data_format=data_format, data_file=data_file,
+                        filters=filters)
+
+    start_time = time.time()
+
+    if isinstance(config_file, str):
+        config_files = [config_file]
+    else:
+        config_files = list(config_file)
 
     try:
         # Configure logging:
@@ -480,143 +3174,77 @@ def main(config_file, std_err=False, verbose=True, clean_histdata=False):
                      "config_file={0}, ".format(config_file) +
                      "std_err={0}, ".format(std_err) +
                      "verbose={0}, ".format(verbose) +
-                     "clean_histdata={0}".format(clean_histdata)
+                     "clean_histdata={0}, ".format(clean_histdata) +
+                     "action={0}".format(action)
                      )
 
-        # FIXME - Remember to correctly configure syslog, otherwise rsyslog will
-        # discard messages
-        ScriptConfiguration.load_config(config_file)
-
-        logger.debug("Loaded configuration: " +
-                     str(ScriptConfiguration.get_config())
-                     )
+        if action in ['export', 'import', 'migrate']:
+            transfer_history(config_files[0], action, data_format, data_file,
+                             filters)
+            return
 
         # Initialize reporting to monitoring system:
         ScriptStatus.init(nrpe_enable=True)
-
-        # Make sure that we are the only ones running on the server:
-        ScriptLock.init(ScriptConfiguration.get_val('lockfile'))
-        ScriptLock.aqquire()
-
-        # Some basic sanity checking:
-        verify_conf()
-
-        # We are all set, lets do some real work:
-        HistoryFile.init(location=ScriptConfiguration.get_val('history_file'),
-                         max_averaging_window=ScriptConfiguration.get_val(
-                             'max_averaging_window'),
-                         min_averaging_window=ScriptConfiguration.get_val(
-                             'min_averaging_window'))
+        PerfData.init()
+        SampleCache.init()
+        CollectorRegistry.init()
+
+        # Memory series of all the configurations are gathered first, so that
+        # /proc/meminfo is read only once, and so are the collectors, so that
+        # all of them are run concurrently:
+        memory_series = {}
+        collectors = {}
+        perfdata_enabled = False
+        for idx, cur_config in enumerate(config_files):
+            # FIXME - Remember to correctly configure syslog, otherwise rsyslog
+            # will discard messages
+            ScriptConfiguration.load_config(cur_config)
+
+            logger.debug("Loaded configuration: " +
+                         str(ScriptConfiguration.get_config())
+                         )
+
+            # Some basic sanity checking:
+            verify_conf()
+
+            for key, conf in get_memory_series().items():
+                memory_series[(idx,) + key] = conf
+            for name, collector in get_collectors().items():
+                collectors[(idx, name)] = collector
+            perfdata_enabled |= bool(get_conf_val('perfdata_enabled', False))
+
+        meminfo = {}
+        if memory_series and action != 'evaluate':
+            meminfo = fetch_meminfo_usage(
+                *compile_meminfo_series(memory_series))
+        collected = {}
+        if collectors and action != 'evaluate':
+            collected = run_collectors(collectors)
+
+        for idx, cur_config in enumerate(config_files):
+            config_name = None
+            if len(config_files) > 1:
+                ScriptConfiguration.load_config(cur_config)
+                config_name = os.path.splitext(
+                    os.path.basename(cur_config))[0]
+            evaluate_config({x[1:]: meminfo[x] for x in meminfo if x[0] == idx},
+                            clean_histdata, start_time,
+                            config_name=config_name, mode=action,
+                            collected={x[1]: collected[x] for x in collected
+                                       if x[0] == idx})
 
         if clean_histdata:
-            HistoryFile.clear_history()
-            HistoryFile.save()
             ScriptStatus.notify_immediate('unknown',
                                           'History data has been cleared.')
 
-        timeframe = ScriptConfiguration.get_val('timeframe')
-
-        # FIXME: not sure how to refactor this, copypaste does not seem the best
-        # solution :(
-        def do_status_processing(prefix, current_growth, planned_growth,
-                                 mountpoint=None, data_type=None):
-            warn_tresh = 1 + (ScriptConfiguration.get_val(
-                prefix + '_mon_warn_reduction')/100)
-            crit_tresh = 1 + (ScriptConfiguration.get_val(
-                prefix + '_mon_crit_reduction')/100)
-
-            if prefix == 'disk' and data_type == 'inode':
-                units = 'inodes/day'
-            else:
-                units = 'MB/day'
-
-            if prefix == 'disk':
-                rname = data_type + \
-                    ' usage growth for mount {0}'.format(mountpoint)
-            else:
-                rname = '{0} usage growth'.format(prefix)
-
-            rname = rname.capitalize()
-
-            if current_growth > planned_growth * warn_tresh:
-                msg = '{0} exceeds planned growth '.format(rname) + \
-                      '- current: {0} {1}'.format(current_growth, units) + \
-                      ', planned: {0} {1}.'.format(planned_growth, units)
-                if current_growth > planned_growth * crit_tresh:
-                    ScriptStatus.update('crit', msg)
-                else:
-                    ScriptStatus.update('warn', msg)
-            else:
-                ScriptStatus.update('ok',
-                                    '{0} is OK ({1} {2}).'.format(
-                                        rname, current_growth, units))
-
-        if ScriptConfiguration.get_val('memory_mon_enabled'):
-            cur_usage, max_usage = fetch_memory_usage()
-            HistoryFile.add_datapoint('memory', cur_usage)
-            tmp = HistoryFile.verify_dataspan('memory')
-            if tmp < 0:
-                ScriptStatus.update('unknown', 'There is not enough data ' +
-                                    'to calculate current memory ' +
-                                    'usage growth: {0} '.format(abs(tmp)) +
-                                    'days more is needed.')
-            else:
-                datapoints = HistoryFile.get_datapoints('memory')
-
-                planned_growth = find_planned_grow_ratio(cur_usage, max_usage,
-                                                         timeframe)
-                current_growth = find_current_grow_ratio(datapoints)
-
-                logging.debug('memory -> ' +
-                              'current_growth: {0}, '.format(current_growth) +
-                              'planned_growth: {0}'.format(planned_growth))
-
-                do_status_processing('memory', current_growth, planned_growth)
-
-        if ScriptConfiguration.get_val('disk_mon_enabled'):
-            mountpoints = ScriptConfiguration.get_val('disk_mountpoints')
-            for dtype in ['space', 'inode']:
-                for mountpoint in mountpoints:
-                    if dtype == 'inode':
-                        cur_usage, max_usage = fetch_inode_usage(mountpoint)
-                    else:
-                        cur_usage, max_usage = fetch_disk_usage(mountpoint)
-                    HistoryFile.add_datapoint('disk', cur_usage,
-                                              data_type=dtype,
-                                              path=mountpoint)
-                    tmp = HistoryFile.verify_dataspan('disk',
-                                                      data_type=dtype,
-                                                      path=mountpoint)
-                    if tmp < 0:
-                        ScriptStatus.update('unknown',
-                                            'There is not enough data to ' +
-                                            'calculate current disk ' + dtype +
-                                            ' usage growth for mountpoint ' +
-                                            '{0}: {1} '.format(
-                                                mountpoint, abs(tmp)) +
-                                            'days more is needed.')
-                    else:
-                        datapoints = HistoryFile.get_datapoints('disk',
-                                                                data_type=dtype,
-                                                                path=mountpoint)
-                        planned_growth = find_planned_grow_ratio(cur_usage,
-                                                                 max_usage,
-                                                                 timeframe)
-                        current_growth = find_current_grow_ratio(datapoints)
-
-                        logging.debug('disk, ' +
-                                      'mountpoint {0}, '.format(mountpoint) +
-                                      'data_type {0}: '.format(dtype) +
-                                      'current_growth: {0}'.format(current_growth) +
-                                      'planned_growth: {0}'.format(planned_growth))
-                        do_status_processing('disk', current_growth, planned_growth,
-                                             mountpoint=mountpoint, data_type=dtype)
+        if perfdata_enabled and PerfData.get():
+            # Perfdata has to be placed at the very end of the output, this
+            # works because the messages are concatenated in order:
+            ScriptStatus.update('ok', '| ' + PerfData.render())
 
-        HistoryFile.save()
         ScriptStatus.notify_agregated()
-        ScriptLock.release()
 
-    except RecoverableException as e:
+    except (RecoverableException, FileLockTimeout) as e:
         msg = str(e)
         logging.critical(msg)
         ScriptStatus.notify_immediate('unknown', msg)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Pawel Rozlach
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+# Imports:
+import json
+import threading
+import time
+
+# Entry point group collector plugins are registered in:
+COLLECTOR_ENTRY_POINT_GROUP = 'check_growth.collectors'
+
+# Default time limit of a single collector run, in seconds:
+COLLECTOR_TIMEOUT = 10
+
+
+class Collector():
+    """
+    Base class of collector plugins.
+
+    A collector gathers the usage of a set of resources which are not
+    supported by check_growth itself. Plugins are distributed as separate
+    packages and registered in the 'check_growth.collectors' entry point
+    group, i.e. in their setup.py:
+
+        entry_points={
+            'check_growth.collectors': [
+                'nfs = check_growth_nfs:NFSCollector',
+            ],
+        }
+
+    Attributes:
+        conf: a hash with the configuration of the collector, as given in
+            $collectors
+        timeout: maximum time collect() may take, in seconds. Collector which
+            does not finish in time is abandoned and its series are reported
+            as unknown.
+    """
+
+    def __init__(self, conf):
+        self.conf = conf or {}
+        self.timeout = self.conf.get('timeout', COLLECTOR_TIMEOUT)
+
+    def series(self):
+        """
+        Declare the series gathered by the collector.
+
+        Returns:
+            A hash with names of the series as keys and their units (i.e.
+            'MB', 'connections') as values.
+        """
+        raise NotImplementedError
+
+    def collect(self):
+        """
+        Gather current usage of all the series.
+
+        Called in a separate thread, concurrently with the other collectors.
+
+        Returns:
+            A hash with names of the series as keys and (current usage,
+            max usage) tuples as values.
+        """
+        raise NotImplementedError
+
+
+class CollectorRegistry():
+    """
+    Collector plugins enabled during the check run.
+
+    Entry points are scanned only if any collector is enabled, and only the
+    plugins which are enabled are imported. A collector enabled with the same
+    configuration by several configurations is instantiated and run only
+    once.
+
+    Attributes:
+        _entry_points: a hash with names of the installed plugins as keys
+            and their entry points as values, None if not scanned yet
+        _instances: a hash with the collectors, keyed by their name and
+            configuration
+    """
+    _entry_points = None
+    _instances = {}
+
+    @classmethod
+    def init(cls):
+        """
+        Remove all the collectors instantiated so far.
+        """
+        cls._instances = {}
+
+    @classmethod
+    def available(cls):
+        """
+        Return a sorted list of names of the installed collector plugins.
+        """
+        if cls._entry_points is None:
+            from importlib.metadata import entry_points
+            found = entry_points()
+            if hasattr(found, 'select'):
+                found = found.select(group=COLLECTOR_ENTRY_POINT_GROUP)
+            else:
+                found = found.get(COLLECTOR_ENTRY_POINT_GROUP, [])
+            cls._entry_points = {x.name: x for x in found}
+        return sorted(cls._entry_points)
+
+    @classmethod
+    def get(cls, name, conf):
+        """
+        Return the collector with the given configuration, loading the plugin
+        if necessary.
+
+        Args:
+            name: name of the plugin
+            conf: configuration of the collector
+
+        Raises:
+            ValueError: plugin is not installed or could not be loaded
+        """
+        key = (name, json.dumps(conf, sort_keys=True))
+        if key not in cls._instances:
+            if name not in cls.available():
+                raise ValueError(
+                    'Collector {0} is not installed'.format(name))
+            try:
+                plugin = cls._entry_points[name].load()
+                if not (isinstance(plugin, type) and
+                        issubclass(plugin, Collector)):
+                    raise TypeError('not a subclass of Collector')
+                cls._instances[key] = plugin(conf)
+            except Exception as e:
+                raise ValueError('Collector {0} could not be '.format(name) +
+                                 'loaded: {0}'.format(e))
+        return cls._instances[key]
+
+
+def run_collectors(collectors):
+    """
+    Run the collectors concurrently.
+
+    Each collector runs in its own daemon thread, so the ones which hang do
+    not delay the others nor the exit of the check. A collector given under
+    several keys is run only once.
+
+    Args:
+        collectors: a hash with collectors as values
+
+    Returns:
+        A hash with the same keys and (samples, error) tuples as values:
+        samples as returned by collect() and None, or None and the
+        description of the failure.
+    """
+    finished = {}
+
+    def run(key, collector):
+        try:
+            finished[key] = (collector.collect(), None)
+        except Exception as e:
+            finished[key] = (None, 'collection failed: {0}'.format(e))
+
+    unique = {id(x): x for x in collectors.values()}
+    start = time.monotonic()
+    threads = {}
+    for key, collector in unique.items():
+        threads[key] = threading.Thread(target=run, args=(key, collector),
+                                        daemon=True)
+        threads[key].start()
+
+    results = {}
+    for key, thread in threads.items():
+        timeout = unique[key].timeout
+        thread.join(max(0, start + timeout - time.monotonic()))
+        if thread.is_alive():
+            results[key] = (None, 'timed out after {0}s'.format(timeout))
+        else:
+            results[key] = finished[key]
+    return {x: results[id(y)] for x, y in collectors.items()}
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Pawel Rozlach
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+# Imports:
+import array
+import bisect
+import collections.abc
+import sys
+
+# Type codes of the columns - 32 bit signed integers and 32 bit floats:
+OFFSET_TYPECODE = 'i'
+VALUE_TYPECODE = 'f'
+
+# Keys of the serialized form, see CompactSeries.encode():
+ENCODED_KEYS = ('epoch', 'base', 'offsets', 'values')
+
+
+class CompactSeries(collections.abc.MutableMapping):
+    """
+    Series of datapoints stored in two columns instead of a hash.
+
+    Timestamps are kept as 32 bit offsets from the epoch of the series - the
+    timestamp of its first datapoint - and values as 32 bit floats relative
+    to the base of the series - the value of its first datapoint. A datapoint
+    takes 8 bytes this way, half of what float64 columns would take and a
+    small fraction of a hash entry. Values relative to the base are small, so
+    float32 keeps their changes accurate even for big resources, i.e. disks
+    measured in megabytes. Timestamps must be integers within 68 years from
+    the epoch.
+
+    The series behaves like a hash with timestamps as keys and values as
+    values, and iterates over the timestamps in ascending order. Appending a
+    datapoint newer than all the others is O(1), other updates are O(n).
+    """
+
+    def __init__(self, items=()):
+        self._epoch = None
+        self._base = None
+        self._offsets = array.array(OFFSET_TYPECODE)
+        self._values = array.array(VALUE_TYPECODE)
+        for timestamp, value in items:
+            self[timestamp] = value
+
+    def _index(self, timestamp):
+        offset = timestamp - self._epoch
+        i = bisect.bisect_left(self._offsets, offset)
+        if i < len(self._offsets) and self._offsets[i] == offset:
+            return i
+        raise KeyError(timestamp)
+
+    def __getitem__(self, timestamp):
+        if self._epoch is None:
+            raise KeyError(timestamp)
+        return self._base + self._values[self._index(timestamp)]
+
+    def __setitem__(self, timestamp, value):
+        if self._epoch is None:
+            self._epoch = int(timestamp)
+            self._base = float(value)
+        offset = int(timestamp) - self._epoch
+        value = float(value) - self._base
+        if not self._offsets or offset > self._offsets[-1]:
+            self._offsets.append(offset)
+            self._values.append(value)
+            return
+        i = bisect.bisect_left(self._offsets, offset)
+        if self._offsets[i] == offset:
+            self._values[i] = value
+        else:
+            self._offsets.insert(i, offset)
+            self._values.insert(i, value)
+
+    def __delitem__(self, timestamp):
+        if self._epoch is None:
+            raise KeyError(timestamp)
+        i = self._index(timestamp)
+        del self._offsets[i]
+        del self._values[i]
+
+    def __iter__(self):
+        epoch = self._epoch
+        return (epoch + x for x in self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __repr__(self):
+        return 'CompactSeries({0})'.format(dict(self))
+
+    def truncate(self, border):
+        """
+        Remove all the datapoints not newer than border at once.
+        """
+        if self._epoch is not None:
+            i = bisect.bisect_right(self._offsets, border - self._epoch)
+            del self._offsets[:i]
+            del self._values[:i]
+
+    def remove_all(self, timestamps):
+        """
+        Remove the datapoints with the given timestamps at once, in O(n)
+        instead of O(n) per datapoint.
+        """
+        if self._epoch is None:
+            return
+        removed = set(x - self._epoch for x in timestamps)
+        keep = [i for i, x in enumerate(self._offsets) if x not in removed]
+        self._offsets = array.array(OFFSET_TYPECODE,
+                                    [self._offsets[i] for i in keep])
+        self._values = array.array(VALUE_TYPECODE,
+                                   [self._values[i] for i in keep])
+
+    def columns(self):
+        """
+        Return the timestamps and the values relative to the first datapoint.
+
+        Returns:
+            A tuple (epoch, base, offsets, values) - offsets and values are
+            arrays of the same length, ordered by timestamp.
+        """
+        return self._epoch, self._base, self._offsets, self._values
+
+    def encode(self):
+        """
+        Serialize the series.
+
+        Returns:
+            A hash with ENCODED_KEYS as keys, the columns are little-endian
+            bytes.
+        """
+        offsets, values = self._offsets, self._values
+        if sys.byteorder != 'little':
+            offsets, values = array.array(offsets.typecode, offsets), \
+                array.array(values.typecode, values)
+            offsets.byteswap()
+            values.byteswap()
+        return {'epoch': self._epoch, 'base': self._base,
+                'offsets': offsets.tobytes(), 'values': values.tobytes()}
+
+    @classmethod
+    def decode(cls, encoded):
+        """
+        Deserialize the series serialized by encode() method.
+
+        Raises:
+            ValueError: the data is malformed
+        """
+        series = cls()
+        series._offsets.frombytes(encoded['offsets'])
+        series._values.frombytes(encoded['values'])
+        if sys.byteorder != 'little':
+            series._offsets.byteswap()
+            series._values.byteswap()
+        if len(series._offsets) != len(series._values):
+            raise ValueError('Columns of the series differ in length')
+        if series._offsets:
+            series._epoch = int(encoded['epoch'])
+            series._base = float(encoded['base'])
+        return series
+
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Pawel Rozlach
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+# Imports:
+import logging
+import os
+import time
+
+from check_growth.fsutils import FileLock, write_atomically
+
+# Indexes of the fields of the per-directory cache entry:
+_INO, _MTIME, _SIZE, _SUBDIRS, _SCANNED = range(5)
+
+
+class DirectoryScanCache():
+    """
+    Incremental, resumable scanner of directory trees.
+
+    Every directory of a scanned tree has a cache entry which holds its inode
+    number, its mtime, the space used by the files placed directly in it, the
+    list of its subdirectories and the time it was last scanned. A directory
+    whose inode and mtime did not change since the last scan has had no
+    entries added, removed or renamed, so instead of listing it we just descend
+    into its cached subdirectories. Such directories are still re-listed once
+    in a while (see `rescan_interval`) in order to catch files growing in
+    place, which does not change the mtime of the parent directory.
+
+    Scanning is limited by a time budget. When it is exhausted, the list of
+    directories that still need to be visited is stored in the cache and the
+    next run picks up where the previous one stopped.
+
+    Attributes:
+        _data: a hash with scan state for each of the tree roots
+        _location: location of the file where the cache is stored betwean
+            script runs
+        _scanned: tree roots scanned since the cache was loaded
+    """
+    _data = {}
+    _location = None
+    _scanned = set()
+
+    @classmethod
+    def init(cls, location):
+        """
+        Initialize DirectoryScanCache class.
+
+        Args:
+            location: location of the file where the cache is stored or should
+                be stored. File is in YAML format.
+        """
+        cls._location = location
+        cls._scanned = set()
+        cls._data = cls._load(location)
+
+    @staticmethod
+    def _load(location):
+        import yaml
+        # libyaml bindings are much faster for big scan caches, use them if
+        # possible:
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+        try:
+            with open(location, 'r') as fh:
+                data = yaml.load(fh, Loader=loader)
+        except (IOError, yaml.YAMLError):
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        return data
+
+    @classmethod
+    def save(cls):
+        """
+        Save the scan cache to the file provided in init() call.
+
+        Only the trees scanned by this run are replaced, the state of the
+        remaining ones is taken from the current content of the file, as it
+        might have been updated by a concurrent run in the meantime.
+        """
+        import yaml
+        dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+        with FileLock(cls._location + '.lock'):
+            data = cls._load(cls._location)
+            for root in cls._scanned:
+                data[root] = cls._data[root]
+            cls._data = data
+            cls._scanned = set()
+            write_atomically(cls._location, yaml.dump(data, Dumper=dumper))
+
+    @classmethod
+    def _forget_subtree(cls, dirs, path):
+        """
+        Remove cache entries of the given directory and all its descendants.
+        """
+        stack = [path]
+        while stack:
+            cur_path = stack.pop()
+            entry = dirs.pop(cur_path, None)
+            if entry is not None:
+                stack.extend(os.path.join(cur_path, x) for x in entry[_SUBDIRS])
+
+    @classmethod
+    def _scan_dir(cls, path, root_dev):
+        """
+        List a single directory.
+
+        Returns:
+            A tuple (space used by the files, list of subdirectories)
+        """
+        size = 0
+        subdirs = []
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        # Do not cross filesystem boundaries, just like du -x:
+                        if entry.stat(follow_symlinks=False).st_dev == root_dev:
+                            subdirs.append(entry.name)
+                    else:
+                        size += entry.stat(follow_symlinks=False).st_blocks * 512
+                except OSError:
+                    # Entry vanished while we were scanning, ignore it:
+                    continue
+        return size, subdirs
+
+    @classmethod
+    def scan(cls, root, time_budget, rescan_interval, clock=time.time,
+             location=None):
+        """
+        Continue scanning of the given directory tree.
+
+        Args:
+            root: the root of the directory tree, the state of the scan is
+                stored under this name
+            time_budget: maximum number of seconds this call may spend on
+                scanning, measured with the monotonic clock
+            rescan_interval: maximum age of a cache entry (in days) after
+                which the directory is listed again even if its mtime did not
+                change.
+            clock: callable returning current UNIX timestamp, used for the
+                ages of the cache entries
+            location: where the tree actually is, defaults to root
+
+        Returns:
+            Space used by the tree in bytes, or None if the tree has not been
+            fully scanned even once yet.
+        """
+        cur_time = clock()
+        deadline = time.monotonic() + time_budget
+        max_age = rescan_interval * 3600 * 24
+
+        cls._scanned.add(root)
+        state = cls._data.setdefault(root, {'dirs': {}, 'pending': [],
+                                            'complete': False})
+        dirs = state['dirs']
+        pending = state['pending']
+        if not pending:
+            # Previous pass has finished, begin a new one:
+            pending.append(location or root)
+
+        root_dev = os.stat(location or root).st_dev
+        listed = 0
+        while pending:
+            if time.monotonic() > deadline:
+                logging.debug('Time budget for scanning {0} '.format(root) +
+                              'exhausted, {0} '.format(len(pending)) +
+                              'directories left for the next run')
+                break
+            path = pending.pop()
+            try:
+                st = os.stat(path)
+            except OSError:
+                cls._forget_subtree(dirs, path)
+                continue
+
+            entry = dirs.get(path)
+            if entry is not None and entry[_INO] == st.st_ino and \
+                    entry[_MTIME] == st.st_mtime_ns and \
+                    cur_time - entry[_SCANNED] < max_age:
+                pending.extend(os.path.join(path, x) for x in entry[_SUBDIRS])
+                continue
+
+            try:
+                size, subdirs = cls._scan_dir(path, root_dev)
+            except OSError:
+                cls._forget_subtree(dirs, path)
+                continue
+            listed += 1
+
+            if entry is not None:
+                for gone in set(entry[_SUBDIRS]) - set(subdirs):
+                    cls._forget_subtree(dirs, os.path.join(path, gone))
+            dirs[path] = [st.st_ino, st.st_mtime_ns, size, subdirs, cur_time]
+            pending.extend(os.path.join(path, x) for x in subdirs)
+        else:
+            state['complete'] = True
+
+        logging.debug('Scan of {0}: {1} directories '.format(root, len(dirs)) +
+                      'cached, {0} listed during this run'.format(listed))
+
+        if not state['complete']:
+            return None
+        return sum(x[_SIZE] for x in dirs.values())
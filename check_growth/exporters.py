@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Pawel Rozlach
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+# Imports:
+from check_growth.fsutils import write_atomically
+import collections
+import json
+import time
+
+# Gauges exported for every series: (name, help, key in the results hash)
+_PROMETHEUS_SERIES_GAUGES = [
+    ('check_growth_usage', 'Current usage of the resource.', 'cur_usage'),
+    ('check_growth_max_usage', 'Total amount of the resource.', 'max_usage'),
+    ('check_growth_planned_growth',
+     'Growth per day which makes the resource last for the whole timeframe.',
+     'planned_growth'),
+    ('check_growth_days_to_full',
+     'Days until the resource is exhausted at the current growth ratio.',
+     'days_to_full'),
+    ('check_growth_datapoints', 'Number of datapoints in the history.',
+     'datapoints'),
+]
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    return ','.join('{0}="{1}"'.format(k, _escape_label_value(v))
+                    for k, v in labels)
+
+
+def render_prometheus(results, duration):
+    """
+    Render check results in the Prometheus text exposition format.
+
+    Args:
+        results: a list of hashes describing each of the evaluated series,
+            as gathered by main()
+        duration: duration of the check run, in seconds
+
+    Returns:
+        A string with the metrics.
+    """
+    lines = {name: [] for name, _, _ in _PROMETHEUS_SERIES_GAUGES}
+    growth_lines = []
+    for result in results:
+        labels = [('resource', result['prefix']),
+                  ('path', result['path'] or ''),
+                  ('data_type', result['data_type'] or ''),
+                  ('units', result['units'])]
+        fmt_labels = _format_labels(labels)
+        for name, _, key in _PROMETHEUS_SERIES_GAUGES:
+            if result[key] is None:
+                continue
+            lines[name].append('{0}{{{1}}} {2}'.format(
+                name, fmt_labels, _format_value(result[key])))
+        for window in sorted(result['growth']):
+            if result['growth'][window] is None:
+                continue
+            growth_lines.append('check_growth_current_growth{{{0}}} {1}'.format(
+                _format_labels(labels + [('window', window)]),
+                _format_value(result['growth'][window])))
+
+    ret = []
+    for name, help_text, _ in _PROMETHEUS_SERIES_GAUGES:
+        ret.append('# HELP {0} {1}'.format(name, help_text))
+        ret.append('# TYPE {0} gauge'.format(name))
+        ret.extend(lines[name])
+    ret.append('# HELP check_growth_current_growth Current growth per day ' +
+               'of the resource.')
+    ret.append('# TYPE check_growth_current_growth gauge')
+    ret.extend(growth_lines)
+    ret.append('# HELP check_growth_run_duration_seconds Duration of the ' +
+               'last check run.')
+    ret.append('# TYPE check_growth_run_duration_seconds gauge')
+    ret.append('check_growth_run_duration_seconds {0}'.format(
+        _format_value(duration)))
+
+    return '\n'.join(ret) + '\n'
+
+
+def write_prometheus_textfile(location, results, duration):
+    """
+    Atomically write check results to a node_exporter textfile.
+
+    The name of the temporary file does not end with .prom, so it is ignored
+    by the textfile collector.
+
+    Args:
+        location: path of the .prom file
+        results: see render_prometheus()
+        duration: see render_prometheus()
+    """
+    write_atomically(location, render_prometheus(results, duration))
+
+
+def render_status_sidecar(statuses):
+    """
+    Render statuses of all the series as a compact JSON document.
+
+    Args:
+        statuses: a list of hashes describing status of each of the series,
+            as gathered by evaluate_config()
+
+    Returns:
+        A string with the JSON document.
+    """
+    counts = collections.Counter(x['status'] for x in statuses)
+    doc = {'timestamp': round(time.time(), 3),
+           'counts': dict(counts),
+           'series': statuses,
+           }
+    return json.dumps(doc, separators=(',', ':'), sort_keys=True) + '\n'
+
+
+def write_status_sidecar(location, statuses):
+    """
+    Atomically write statuses of all the series to a JSON file.
+
+    Args:
+        location: path of the JSON file
+        statuses: see render_status_sidecar()
+    """
+    write_atomically(location, render_status_sidecar(statuses))
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Pawel Rozlach
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+# Imports:
+import fcntl
+import json
+import logging
+import os
+import time
+import zlib
+
+# How long to wait for a lock before giving up, in seconds:
+LOCK_TIMEOUT = 10
+
+# How often to retry taking a lock, in seconds:
+LOCK_POLL_INTERVAL = 0.01
+
+
+class FileLockTimeout(Exception):
+    pass
+
+
+class FileLock():
+    """
+    Advisory lock, usable as a context manager.
+
+    The lock is meant to be held only for short periods of time - i.e. while
+    a file shared by several processes is read, updated and written back - so
+    waiting for it is bounded by a timeout. flock() locks are released by the
+    kernel when the process dies, so a killed run never leaves a stale lock
+    behind.
+    """
+
+    def __init__(self, location, timeout=None, shared=False):
+        """
+        Args:
+            location: path of the lock file, created if it does not exist
+            timeout: maximum number of seconds to wait for the lock, defaults
+                to LOCK_TIMEOUT
+            shared: take a shared lock, which is held by any number of readers
+                at once, but never together with the exclusive one
+        """
+        self._location = location
+        self._timeout = LOCK_TIMEOUT if timeout is None else timeout
+        self._operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        self._fh = None
+
+    def __enter__(self):
+        deadline = time.monotonic() + self._timeout
+        self._fh = open(self._location, 'a')
+        while True:
+            try:
+                fcntl.flock(self._fh, self._operation | fcntl.LOCK_NB)
+                return self
+            except (IOError, OSError):
+                if time.monotonic() > deadline:
+                    self._fh.close()
+                    self._fh = None
+                    raise FileLockTimeout('Timed out waiting for lock ' +
+                                          '{0}'.format(self._location))
+                time.sleep(LOCK_POLL_INTERVAL)
+
+    def __exit__(self, *unused):
+        fcntl.flock(self._fh, fcntl.LOCK_UN)
+        self._fh.close()
+        self._fh = None
+
+
+def _fsync_directory(location):
+    """
+    Flush the directory entries of the directory holding the location to
+    disk, so a file created, renamed or removed there survives a power loss.
+    """
+    fd = os.open(os.path.dirname(os.path.abspath(location)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_atomically(location, content):
+    """
+    Write the content to a temporary file placed in the same directory as
+    the location and then rename it, so readers never see a partially
+    written file.
+
+    The content is flushed to disk before the rename and the directory right
+    after it, so once the function returns, the new file survives a power
+    loss - a rename which reaches the disk before the content could leave an
+    empty file behind.
+    """
+    tmp_location = '{0}.{1}.tmp'.format(location, os.getpid())
+    try:
+        with open(tmp_location, 'w') as fh:
+            fh.write(content)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp_location, location)
+    except Exception:
+        try:
+            os.unlink(tmp_location)
+        except OSError:
+            pass
+        raise
+    _fsync_directory(location)
+
+
+def _encode_record(payload):
+    data = json.dumps(payload, separators=(',', ':')).encode()
+    return '{0:08x} '.format(zlib.crc32(data)).encode() + data + b'\n'
+
+
+def append_record(location, payload):
+    """
+    Append a single checksummed record to a log file and flush it to disk.
+
+    Each record is a single line holding the CRC32 of the JSON-serialized
+    payload followed by the payload itself. If the previous writer was killed
+    in the middle of a record, the torn record is terminated first, so it
+    does not corrupt the one being appended.
+
+    Args:
+        location: path of the log file, created if it does not exist
+        payload: JSON-serializable object
+    """
+    record = _encode_record(payload)
+    with open(location, 'a+b') as fh:
+        fh.seek(0, os.SEEK_END)
+        if fh.tell() > 0:
+            fh.seek(-1, os.SEEK_END)
+            if fh.read(1) != b'\n':
+                record = b'\n' + record
+        fh.write(record)
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+def write_records(location, payloads):
+    """
+    Replace the log file with the given records, atomically.
+
+    Args:
+        location: path of the log file
+        payloads: list of JSON-serializable objects, see append_record()
+    """
+    write_atomically(location, b''.join(
+        _encode_record(x) for x in payloads).decode())
+
+
+def read_records(location):
+    """
+    Read all the records appended to the log file with append_record().
+
+    Records which are torn (i.e. not terminated because the writer was
+    killed) or whose checksum does not match are skipped.
+
+    Yields:
+        Payloads of the valid records, in the order they were appended.
+    """
+    try:
+        fh = open(location, 'rb')
+    except (IOError, OSError):
+        return
+    with fh:
+        for lineno, line in enumerate(fh, start=1):
+            if not line.endswith(b'\n'):
+                logging.warning('Skipping torn record at the end of ' +
+                                '{0}'.format(location))
+                continue
+            checksum, _, data = line[:-1].partition(b' ')
+            try:
+                if int(checksum, 16) != zlib.crc32(data):
+                    raise ValueError('checksum mismatch')
+                payload = json.loads(data.decode())
+            except ValueError:
+                logging.warning('Skipping corrupted record ' +
+                                '{0} of {1}'.format(lineno, location))
+                continue
+            yield payload
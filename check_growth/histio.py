@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Pawel Rozlach
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+# Imports:
+from check_growth.columns import ENCODED_KEYS, CompactSeries
+import collections
+import csv
+import json
+
+# Supported formats of exported datapoints:
+FORMATS = ['csv', 'ndjson']
+
+# Fields of a single exported datapoint, in order:
+FIELDS = ['resource', 'path', 'data_type', 'timestamp', 'value']
+
+
+def _parse_number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def filter_datapoints(datapoints, resources=None, paths=None, since=None,
+                      until=None):
+    """
+    Pass through only the datapoints matching all the given criteria.
+
+    Args:
+        datapoints: iterable of (resource, path, data_type, timestamp, value)
+            tuples
+        resources: list of resource types to pass, None passes all of them
+        paths: list of mountpoints, directory paths or meminfo series names
+            to pass, None passes all of them. Memory datapoints have no path
+            and are passed only if no paths are given.
+        since, until: range of timestamps to pass (inclusive), None means no
+            limit
+
+    Yields:
+        Matching datapoints.
+    """
+    for datapoint in datapoints:
+        resource, path, _, timestamp, _ = datapoint
+        if resources is not None and resource not in resources:
+            continue
+        if paths is not None and path not in paths:
+            continue
+        if since is not None and timestamp < since:
+            continue
+        if until is not None and timestamp > until:
+            continue
+        yield datapoint
+
+
+def dump_datapoints(datapoints, fh, data_format):
+    """
+    Write datapoints to a file, one per line.
+
+    Datapoints are consumed one by one, so the memory usage does not depend
+    on the number of datapoints.
+
+    Args:
+        datapoints: iterable of (resource, path, data_type, timestamp, value)
+            tuples
+        fh: file object opened for writing in text mode
+        data_format: one of FORMATS. CSV output starts with a header line,
+            fields which are not set are empty. In NDJSON output each line is
+            an object, fields which are not set are null.
+
+    Returns:
+        Number of datapoints written.
+    """
+    count = 0
+    if data_format == 'csv':
+        writer = csv.writer(fh, lineterminator='\n')
+        writer.writerow(FIELDS)
+        for datapoint in datapoints:
+            writer.writerow(['' if x is None else x for x in datapoint])
+            count += 1
+    elif data_format == 'ndjson':
+        for datapoint in datapoints:
+            fh.write(json.dumps(dict(zip(FIELDS, datapoint)),
+                                separators=(',', ':')) + '\n')
+            count += 1
+    else:
+        raise ValueError('Unsupported format: {0}'.format(data_format))
+    return count
+
+
+def load_datapoints(fh, data_format):
+    """
+    Read datapoints written by dump_datapoints().
+
+    Args:
+        fh: file object opened for reading in text mode
+        data_format: one of FORMATS
+
+    Yields:
+        (resource, path, data_type, timestamp, value) tuples, one per line.
+
+    Raises:
+        ValueError: a line is malformed
+    """
+    if data_format == 'csv':
+        reader = csv.DictReader(fh)
+        if reader.fieldnames != FIELDS:
+            raise ValueError('CSV header should be: ' + ','.join(FIELDS))
+        for row in reader:
+            yield (row['resource'],
+                   row['path'] or None,
+                   row['data_type'] or None,
+                   int(row['timestamp']),
+                   _parse_number(row['value']))
+    elif data_format == 'ndjson':
+        for lineno, line in enumerate(fh, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+                datapoint = (row['resource'], row.get('path'),
+                             row.get('data_type'), int(row['timestamp']),
+                             row['value'])
+            except (KeyError, TypeError, ValueError):
+                raise ValueError('Malformed datapoint in line ' +
+                                 '{0}'.format(lineno))
+            yield datapoint
+    else:
+        raise ValueError('Unsupported format: {0}'.format(data_format))
+
+
+def _is_branch(keys):
+    """
+    Check if the node of the history file under the given keys is a mapping
+    which stream_history() descends into, as opposed to a series or a section
+    which is read as a whole.
+    """
+    if not keys:
+        return True
+    if keys[0] != 'datapoints':
+        return False
+    if len(keys) == 1:
+        return True
+    if keys[1] == 'memory':
+        return False
+    return len(keys) < (4 if keys[1] == 'disk' else 3)
+
+
+def stream_history(fh):
+    """
+    Read the history file incrementally.
+
+    Instead of building the whole document, the YAML event stream is walked
+    and only a single datapoint (or a single section other than the
+    datapoints) is constructed at a time, so the memory needed does not
+    depend on the size of the file, only on what the caller keeps.
+
+    Args:
+        fh: file object of the history file, opened for reading in text mode
+
+    Yields:
+        (keys, value) tuples. For series, keys is a tuple with 'datapoints',
+        the resource type, and the path and the data type if the resource
+        type has them, i.e. ('datapoints', 'disk', '/srv', 'space'), and value
+        is an iterator over (timestamp, value) pairs of the series. It has to
+        be consumed before the next item is requested, anything left is
+        skipped. For the other sections, keys is a tuple with the name of the
+        section and value is its content.
+
+    Raises:
+        ValueError: the file is not a valid history file
+    """
+    import yaml
+
+    loader = yaml.SafeLoader(fh)
+
+    def construct():
+        return loader.construct_document(loader.compose_node(None, None))
+
+    def series_items():
+        if not loader.check_event(yaml.MappingStartEvent):
+            if construct() is not None:
+                raise ValueError('Series is not a mapping')
+            return
+        loader.get_event()
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = construct()
+            if key in ENCODED_KEYS:
+                # Series stored as columns, see CompactSeries.encode():
+                encoded = {key: construct()}
+                while not loader.check_event(yaml.MappingEndEvent):
+                    key = construct()
+                    encoded[key] = construct()
+                loader.get_event()
+                yield from CompactSeries.decode(encoded).items()
+                return
+            if not isinstance(key, int):
+                raise ValueError('Timestamp {0} is not an integer'.format(key))
+            yield key, construct()
+        loader.get_event()
+
+    def walk(keys):
+        if not _is_branch(keys):
+            if keys[0] == 'datapoints':
+                items = series_items()
+                yield keys, items
+                collections.deque(items, maxlen=0)
+            else:
+                yield keys, construct()
+            return
+        if not loader.check_event(yaml.MappingStartEvent):
+            if construct() is not None:
+                raise ValueError('{0} is not a mapping'.format(
+                    '/'.join(str(x) for x in keys) or 'History'))
+            return
+        loader.get_event()
+        while not loader.check_event(yaml.MappingEndEvent):
+            yield from walk(keys + (construct(),))
+        loader.get_event()
+
+    try:
+        loader.get_event()
+        if loader.check_event(yaml.StreamEndEvent):
+            return
+        loader.get_event()
+        yield from walk(())
+    except yaml.YAMLError as e:
+        raise ValueError('Malformed YAML: {0}'.format(e))
+    finally:
+        loader.dispose()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Pawel Rozlach
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+# Imports:
+import bisect
+import collections
+
+# Filter does not flag anything until it has seen at least this many values:
+OUTLIER_MIN_SAMPLES = 10
+
+# Scales MAD so that it estimates standard deviation for normally distributed
+# data:
+MAD_SCALE = 1.4826
+
+# If all the values in the window are (nearly) equal, MAD is zero and every
+# change would be flagged. Deviation is therefore never measured in units
+# smaller than this fraction of the median:
+MIN_RELATIVE_SPREAD = 0.001
+
+
+class RollingMedianFilter():
+    """
+    Outlier detection basing on rolling median and median absolute deviation.
+
+    The filter keeps the last `window` values both in arrival order (so that
+    the oldest one can be dropped) and in a sorted list (so that order
+    statistics can be read). A value is an outlier if it is further from the
+    median of the preceding values than `threshold` times the scaled MAD.
+
+    Processing of a single value costs O(log w) comparisons plus moving O(w)
+    list items when the value is inserted and the oldest one removed, which
+    for windows of up to a few hundred values is as fast as any balanced
+    structure, and O(log^2 w) for finding MAD, which is the k-th smallest
+    element of two sorted sequences - distances from the median of the values
+    below it and of the values above it - and can be found by binary search.
+    Creating the filter with initial values sorts them, O(w log w).
+    """
+
+    def __init__(self, window, threshold, values=()):
+        """
+        Args:
+            window: number of recent values the median/MAD are calculated from
+            threshold: how many scaled MADs from the median a value must be to
+                be considered an outlier
+            values: initial content of the window, oldest first
+        """
+        self._window = window
+        self._threshold = threshold
+        self._fifo = collections.deque(values, maxlen=window)
+        self._sorted = sorted(self._fifo)
+
+    def _push(self, value):
+        if len(self._fifo) == self._window:
+            oldest = self._fifo[0]
+            del self._sorted[bisect.bisect_left(self._sorted, oldest)]
+        self._fifo.append(value)
+        bisect.insort(self._sorted, value)
+
+    def median(self):
+        """
+        Return the median of the values in the window.
+        """
+        n = len(self._sorted)
+        return (self._sorted[(n - 1) // 2] + self._sorted[n // 2]) / 2
+
+    def mad(self):
+        """
+        Return the median absolute deviation of the values in the window.
+        """
+        a = self._sorted
+        n = len(a)
+        m = self.median()
+        # a[0:p] <= m <= a[p:n], distances from m of both parts, ascending:
+        p = n // 2
+        nl, nr = p, n - p
+
+        def left(i):
+            return m - a[p - 1 - i]
+
+        def right(j):
+            return a[p + j] - m
+
+        # (Lower) median of all the distances is the k-th smallest of them,
+        # find how many (i) of the k+1 smallest come from the left part:
+        k = (n - 1) // 2
+        lo, hi = max(0, k + 1 - nr), min(k + 1, nl)
+        while True:
+            i = (lo + hi) // 2
+            j = k + 1 - i
+            if i > 0 and j < nr and left(i - 1) > right(j):
+                hi = i - 1
+            elif j > 0 and i < nl and right(j - 1) > left(i):
+                lo = i + 1
+            else:
+                break
+        candidates = []
+        if i > 0:
+            candidates.append(left(i - 1))
+        if j > 0:
+            candidates.append(right(j - 1))
+        return max(candidates)
+
+    def update(self, value):
+        """
+        Check the value against the window and then add it to the window.
+
+        Outliers are added to the window as well - the median is robust
+        against them anyway, and thanks to that a persistent change of the
+        level stops being flagged once it fills half of the window.
+
+        Returns:
+            True if the value is an outlier, False otherwise.
+        """
+        is_outlier = False
+        if len(self._fifo) >= min(OUTLIER_MIN_SAMPLES, self._window):
+            median = self.median()
+            spread = max(MAD_SCALE * self.mad(),
+                         MIN_RELATIVE_SPREAD * abs(median))
+            is_outlier = abs(value - median) > self._threshold * spread
+        self._push(value)
+        return is_outlier
+
+    def values(self):
+        """
+        Return the content of the window, oldest first.
+        """
+        return list(self._fifo)
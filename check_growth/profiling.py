@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Pawel Rozlach
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+# Imports:
+import contextlib
+import io
+import logging
+import os
+import time
+
+# Number of profiled runs whose results are kept:
+PROFILE_KEEP = 10
+
+# Number of functions and allocation sites reported:
+PROFILE_TOP = 20
+
+_PROFILE_PREFIX = 'check_growth.'
+_PROFILE_SUFFIXES = ['.prof', '.alloc']
+
+
+def _rotate(profile_dir, keep):
+    """
+    Remove results of all but the keep most recent profiled runs.
+    """
+    runs = set()
+    for name in os.listdir(profile_dir):
+        for suffix in _PROFILE_SUFFIXES:
+            if name.startswith(_PROFILE_PREFIX) and name.endswith(suffix):
+                runs.add(name[:-len(suffix)])
+    for run in sorted(runs)[:-keep]:
+        for suffix in _PROFILE_SUFFIXES:
+            try:
+                os.unlink(os.path.join(profile_dir, run + suffix))
+            except OSError:
+                pass
+
+
+@contextlib.contextmanager
+def profiled(profile_dir, keep=PROFILE_KEEP, top=PROFILE_TOP):
+    """
+    Profile CPU usage and memory allocations of the code run in the context.
+
+    Results are written to profile_dir even if the code raises, i.e. calls
+    sys.exit():
+      - check_growth.<time>.<pid>.prof: cProfile stats, readable with pstats
+      - check_growth.<time>.<pid>.alloc: top allocation sites, as reported
+        by tracemalloc
+    The functions with the highest cumulative time are logged at debug
+    level. Only the results of the keep most recent runs are kept.
+
+    Profilers are imported only when profiling is requested, so they cost
+    nothing otherwise.
+
+    Args:
+        profile_dir: directory where the results are stored, created if it
+            does not exist
+        keep: number of profiled runs whose results are kept
+        top: number of functions and allocation sites reported
+    """
+    import cProfile
+    import pstats
+    import tracemalloc
+
+    os.makedirs(profile_dir, exist_ok=True)
+    run_prefix = os.path.join(profile_dir, _PROFILE_PREFIX +
+                              '{0:.6f}.{1}'.format(time.time(), os.getpid()))
+
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        profiler.dump_stats(run_prefix + '.prof')
+        with open(run_prefix + '.alloc', 'w') as fh:
+            for stat in snapshot.statistics('lineno')[:top]:
+                fh.write(str(stat) + '\n')
+
+        summary = io.StringIO()
+        stats = pstats.Stats(profiler, stream=summary)
+        stats.sort_stats('cumulative').print_stats(top)
+        logging.debug('Profile of the run, full results stored in ' +
+                      '{0}.*:\n{1}'.format(run_prefix, summary.getvalue()))
+
+        _rotate(profile_dir, keep)
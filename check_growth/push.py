@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Pawel Rozlach
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+# Imports:
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from check_growth.fsutils import FileLock, FileLockTimeout, append_record
+from check_growth.fsutils import read_records, write_atomically
+from check_growth.fsutils import write_records
+
+# Maximum number of entries sent in a single request:
+PUSH_BATCH_SIZE = 500
+
+# Time limit of the whole flush, including name resolution, in seconds:
+PUSH_TIMEOUT = 2
+
+# Delay before the first retry after a failed flush, in seconds. It is
+# doubled after each consecutive failure, up to PUSH_MAX_BACKOFF:
+PUSH_BACKOFF = 60
+PUSH_MAX_BACKOFF = 3600
+
+# Maximum number of runs kept in the spool, older ones are dropped:
+PUSH_SPOOL_MAX_RECORDS = 10000
+
+
+class PushError(Exception):
+    pass
+
+
+def spool_entries(location, entries):
+    """
+    Queue entries for sending.
+
+    Entries of a single run are appended to the spool as one checksummed
+    record, see check_growth.fsutils.append_record(). The append is done
+    under the same lock flush_spool() holds, so it waits for a flush which is
+    in progress instead of racing with the rewrite of the spool.
+
+    Args:
+        location: path of the spool file
+        entries: list of JSON-serializable hashes
+    """
+    if entries:
+        with FileLock(location + '.lock'):
+            append_record(location, entries)
+
+
+def _load_state(location):
+    try:
+        with open(location, 'r') as fh:
+            state = json.load(fh)
+    except (IOError, ValueError):
+        state = None
+    if not isinstance(state, dict):
+        state = {}
+    state.setdefault('failures', 0)
+    state.setdefault('next_attempt', 0)
+    return state
+
+
+def _batches(records, batch_size):
+    """
+    Group records into batches of at most batch_size entries, a record
+    bigger than that is sent on its own.
+
+    Yields:
+        Lists of records.
+    """
+    batch = []
+    size = 0
+    for record in records:
+        if batch and size + len(record) > batch_size:
+            yield batch
+            batch = []
+            size = 0
+        batch.append(record)
+        size += len(record)
+    if batch:
+        yield batch
+
+
+def flush_spool(location, url, batch_size=PUSH_BATCH_SIZE,
+                timeout=PUSH_TIMEOUT, now=None):
+    """
+    Send the queued entries to the central collector.
+
+    Entries are POST-ed in batches, as newline-delimited JSON, over a
+    single reused HTTP connection. Batches which were accepted (2xx response)
+    are removed from the spool, the rest is kept for the next run. After a
+    failure the flushes are skipped for PUSH_BACKOFF seconds, doubled after
+    each consecutive failure, with a random jitter so that a fleet of hosts
+    does not retry in lockstep. Failures are only logged - the check never
+    fails because of the network.
+
+    The flush runs in a daemon thread which is waited for at most timeout
+    seconds. Neither name resolution nor the socket operations can be
+    interrupted, so a flush which takes longer is abandoned - it goes on in
+    the background and is killed when the process exits. Batches which were
+    sent, but not yet removed from the spool at that point are sent again by
+    the next flush.
+
+    Args:
+        location: path of the spool file. The lock and the backoff state are
+            kept in files with '.lock' and '.state' appended.
+        url: http:// or https:// URL the entries are POST-ed to
+        batch_size: maximum number of entries sent in a single request
+        timeout: time limit of the whole flush, in seconds
+        now: current UNIX timestamp, defaults to time.time()
+
+    Returns:
+        Number of entries sent, 0 if the flush was abandoned.
+    """
+    if now is None:
+        now = time.time()
+    state_location = location + '.state'
+    state = _load_state(state_location)
+    if now < state['next_attempt']:
+        logging.debug('Push to {0} is backing off, '.format(url) +
+                      'next attempt in {0:.0f}s'.format(
+                          state['next_attempt'] - now))
+        return 0
+    if not os.path.exists(location):
+        return 0
+
+    sent = []
+
+    def locked_flush():
+        try:
+            with FileLock(location + '.lock', timeout=0):
+                sent.append(_flush(location, url, batch_size, timeout, now,
+                                   state, state_location))
+        except FileLockTimeout:
+            # Another run is flushing the spool right now:
+            pass
+
+    thread = threading.Thread(target=locked_flush, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        logging.warning('Pushing to {0} did not finish '.format(url) +
+                        'within {0}s, giving up'.format(timeout))
+        return 0
+    return sum(sent)
+
+
+def _flush(location, url, batch_size, timeout, now, state, state_location):
+    import http.client
+    import urllib.parse
+
+    records = list(read_records(location))
+    read_count = len(records)
+    dropped = max(0, len(records) - PUSH_SPOOL_MAX_RECORDS)
+    if dropped:
+        logging.warning('Push spool {0} is full, '.format(location) +
+                        'dropping {0} oldest runs'.format(dropped))
+        records = records[dropped:]
+
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme == 'https':
+        connection = http.client.HTTPSConnection(parsed.netloc,
+                                                 timeout=timeout)
+    else:
+        connection = http.client.HTTPConnection(parsed.netloc,
+                                                timeout=timeout)
+    path = parsed.path or '/'
+    if parsed.query:
+        path += '?' + parsed.query
+
+    # Once flush_spool() gives up, the thread stops starting new batches:
+    deadline = time.monotonic() + timeout
+    sent_records = sent_entries = 0
+    try:
+        for batch in _batches(records, batch_size):
+            if sent_records and time.monotonic() > deadline:
+                break
+            body = ''.join(json.dumps(entry, separators=(',', ':')) + '\n'
+                           for record in batch for entry in record)
+            connection.request('POST', path, body=body.encode(),
+                               headers={'Content-Type':
+                                        'application/x-ndjson'})
+            response = connection.getresponse()
+            response.read()
+            if not 200 <= response.status < 300:
+                raise PushError('HTTP status {0}'.format(response.status))
+            sent_records += len(batch)
+            sent_entries += sum(len(x) for x in batch)
+    except (OSError, http.client.HTTPException, PushError) as e:
+        state['failures'] += 1
+        backoff = min(PUSH_BACKOFF * 2 ** (state['failures'] - 1),
+                      PUSH_MAX_BACKOFF)
+        state['next_attempt'] = now + backoff * random.uniform(0.5, 1)
+        logging.warning('Pushing to {0} failed: {1}, '.format(url, e) +
+                        '{0} runs left in the spool'.format(
+                            len(records) - sent_records))
+    else:
+        state['failures'] = 0
+        state['next_attempt'] = 0
+    finally:
+        connection.close()
+
+    if sent_records or dropped:
+        # Records appended since the spool was read, i.e. by writers which do
+        # not take the lock, are kept:
+        appended = list(read_records(location))[read_count:]
+        write_records(location, records[sent_records:] + appended)
+    write_atomically(state_location, json.dumps(state))
+    return sent_entries
+
+
+class PushReceiver():
+    """
+    Minimal HTTP server accepting entries sent by flush_spool(), meant for
+    tests and for checking the setup by hand:
+
+        python3 -m check_growth.push 8080
+
+    Attributes:
+        entries: a list of all the entries received so far
+        connections: a list of (host, port) tuples of the clients, one for
+            each request
+        status: HTTP status returned to the clients
+        url: URL of the receiver, set once it is started
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, status=200, echo=False):
+        """
+        Args:
+            host, port: address to listen on, port 0 picks a free one
+            status: see class attributes
+            echo: print the received entries to stdout
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.entries = []
+        self.connections = []
+        self.status = status
+        self.url = None
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length).decode()
+                receiver.connections.append(self.client_address)
+                if receiver.status == 200:
+                    for line in body.splitlines():
+                        if echo:
+                            print(line, flush=True)
+                        receiver.entries.append(json.loads(line))
+                self.send_response(receiver.status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *unused):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    def start(self):
+        host, port = self._server.server_address[:2]
+        self.url = 'http://{0}:{1}/'.format(host, port)
+        import threading
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        kwargs={'poll_interval': 0.05},
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+if __name__ == '__main__':
+    import sys
+    server = PushReceiver(host='0.0.0.0',
+                          port=int(sys.argv[1]) if len(sys.argv) > 1 else 8080,
+                          echo=True)
+    server.start()
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
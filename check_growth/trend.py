@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Pawel Rozlach
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+# numpy is imported by the functions themselves - importing it takes longer
+# than the whole run of the check in the common case, so it is done only if
+# it is really needed.
+
+# Up to this many datapoints the exact Theil-Sen estimator is used, which
+# needs n*(n-1)/2 pairwise slopes (~1.1M for 1500 points):
+THEIL_SEN_EXACT_LIMIT = 1500
+
+# Number of randomly sampled pairwise slopes used for bigger series:
+THEIL_SEN_SAMPLES = 200000
+
+# Periodic components which can be removed from the series, in seconds:
+SEASONALITY_PERIODS = {'daily': 3600 * 24,
+                       'weekly': 3600 * 24 * 7}
+
+# Number of harmonics fitted for each of the periods. Must stay below 7,
+# otherwise weekly harmonics overlap with the daily ones:
+SEASONALITY_HARMONICS = 2
+
+
+def theil_sen_slope(x, y, samples=THEIL_SEN_SAMPLES):
+    """
+    Robust estimation of the slope of y = ax + b.
+
+    Theil-Sen estimator is the median of the slopes of all the lines
+    passing through pairs of datapoints. Up to 29% of the datapoints can be
+    arbitrarily corrupted (i.e. a temporary spike) before the result is
+    affected, unlike least squares where a single outlier pulls the whole fit.
+
+    Computing all the pairwise slopes is O(n^2), so for series longer than
+    THEIL_SEN_EXACT_LIMIT a fixed number of randomly chosen pairs is used
+    instead. The median of such sample estimates the median of all the
+    slopes with a rank error of O(1/sqrt(samples)), at a cost which does not
+    depend on the length of the series. The random generator is seeded with
+    a constant, so the same data always gives the same result.
+
+    Args:
+        x: numpy array with datapoint timestamps, sorted ascending and unique
+        y: numpy array with datapoint values
+        samples: number of pairs to sample for long series
+
+    Returns:
+        The slope in units of y per unit of x.
+    """
+    import numpy
+    n = len(x)
+    if n < 2:
+        raise ValueError('At least two datapoints are needed')
+
+    if n <= THEIL_SEN_EXACT_LIMIT:
+        i, j = numpy.triu_indices(n, k=1)
+    else:
+        rng = numpy.random.RandomState(n)
+        i = rng.randint(0, n, samples)
+        j = rng.randint(0, n, samples)
+        mask = i != j
+        i, j = i[mask], j[mask]
+
+    slopes = (y[j] - y[i]) / (x[j] - x[i])
+
+    return float(numpy.median(slopes))
+
+
+def remove_seasonality(x, y, periods, harmonics=SEASONALITY_HARMONICS):
+    """
+    Remove periodic components from the series.
+
+    The series is fitted with a linear trend plus a few harmonics of each of
+    the periods:
+
+        y = a*t + b + sum(c_k*cos(2*pi*k*t/P) + s_k*sin(2*pi*k*t/P))
+
+    and the fitted periodic part is subtracted, leaving the trend and the
+    noise. Fitting trend and harmonics jointly is what prevents i.e. a daily
+    cycle which was cut in the middle by the start of the averaging window
+    from being mistaken for growth. The cost is O(n * m^2), where m is the
+    number of columns (2 + 2 * harmonics * len(periods)), so it is linear
+    in the number of datapoints.
+
+    A period longer than the time span of the data can not be told apart from
+    the trend, so such periods are skipped.
+
+    Args:
+        x: numpy array with datapoint timestamps (seconds), sorted ascending
+        y: numpy array with datapoint values
+        periods: list of period lengths in seconds
+        harmonics: number of harmonics fitted for each period
+
+    Returns:
+        A numpy array with deseasonalized datapoint values.
+    """
+    import numpy
+    t = x - x[0]
+    span = t[-1] if len(t) else 0
+    periods = [p for p in periods if p <= span]
+    if not periods:
+        return y
+
+    columns = [numpy.ones(len(t)), t / span]
+    for period in periods:
+        for k in range(1, harmonics + 1):
+            phase = (2 * numpy.pi * k / period) * t
+            columns.append(numpy.cos(phase))
+            columns.append(numpy.sin(phase))
+    A = numpy.column_stack(columns)
+
+    coef = numpy.linalg.lstsq(A, y, rcond=-1)[0]
+
+    return y - A[:, 2:].dot(coef[2:])
@@ -26,4 +26,5 @@ setup(name='check_growth',
       description='Simple resource growth check',
       packages=['check_growth'],
       scripts=['bin/check_growth'],
+      python_requires='>=3.8',
     )
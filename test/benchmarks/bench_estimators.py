@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Pawel Rozlach
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+# Measures how long it takes to estimate the growth ratio of series of
+# different lengths with each of the supported estimators, with and without
+# removal of periodic components. Run it from the
+# top directory of the project:
+#
+#   ./test/benchmarks/bench_estimators.py
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '../../')))
+
+import check_growth
+
+SERIES_LENGTHS = [1000, 10000, 100000]
+SEASONALITY = [None, ['daily', 'weekly']]
+REPEAT = 5
+
+
+def gen_datapoints(count):
+    cur_time = 1400000000
+    datapoints = {cur_time + i * 60: 1000 + i * 10 / 1440
+                  for i in range(0, count)}
+    # A spike, just to make things realistic:
+    for i in range(count // 2, count // 2 + count // 100):
+        datapoints[cur_time + i * 60] += 5000
+    return datapoints
+
+
+def main():
+    print('{0:>8} {1:>10} {2:>14} {3:>12} {4:>10}'.format(
+        'points', 'estimator', 'seasonality', 'best [ms]', 'result'))
+    for count in SERIES_LENGTHS:
+        datapoints = gen_datapoints(count)
+        for estimator in check_growth.ESTIMATORS:
+            for seasonality in SEASONALITY:
+                def run():
+                    return check_growth.find_current_grow_ratio(
+                        datapoints, estimator=estimator,
+                        seasonality=seasonality)
+                best = min(timeit.Timer(run).repeat(repeat=REPEAT, number=1))
+                print('{0:>8} {1:>10} {2:>14} {3:>12.1f} {4:>10}'.format(
+                    count, estimator, ','.join(seasonality or ['-']),
+                    best * 1000, run()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Pawel Rozlach
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+# Measures wall time and peak RSS of a fresh interpreter which imports
+# check_growth and estimates the growth ratio of a typical series, with the
+# pure Python regression and with numpy. Run it from the top directory of the
+# project:
+#
+#   ./test/benchmarks/bench_startup.py
+
+import os
+import subprocess
+import sys
+import time
+
+TOP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+REPEAT = 10
+
+# A week of datapoints sampled every 5 minutes:
+CHILD_CODE = """
+import resource, sys
+import check_growth
+datapoints = {{1400000000 + i * 300: 1000 + i / 30 for i in range(2016)}}
+check_growth.find_current_grow_ratio(datapoints, pure_python_limit={0})
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+      'numpy' in sys.modules)
+"""
+
+
+def run_child(pure_python_limit):
+    start = time.time()
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHILD_CODE.format(pure_python_limit)],
+        cwd=TOP_DIR)
+    duration = time.time() - start
+    maxrss, numpy_loaded = output.decode().split()
+    return duration, int(maxrss), numpy_loaded == 'True'
+
+
+def main():
+    print('{0:>12} {1:>14} {2:>10} {3:>8}'.format(
+        'regression', 'best wall [ms]', 'RSS [kB]', 'numpy'))
+    for name, limit in [('pure python', 10000), ('numpy', 0)]:
+        runs = [run_child(limit) for _ in range(REPEAT)]
+        print('{0:>12} {1:>14.1f} {2:>10} {3:>8}'.format(
+            name, min(x[0] for x in runs) * 1000, min(x[1] for x in runs),
+            str(runs[0][2])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# Copyright (c) 2015 Pawel Rozlach
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+# Replays weeks of runs of check_growth.main() against scripted usage curves.
+# The clock is virtual and /proc/meminfo and statvfs() are faked (see
+# check_growth.Host), so each scenario takes seconds instead of months. For
+# every scenario, the false positive rate (warn/crit before the usage starts
+# to grow too fast), the alert latency (time from the onset of the growth to
+# the first warn/crit) and the cost of a single run as the history grows are
+# reported. Run it from the top directory of the project:
+#
+#   ./test/benchmarks/simulate.py --days 45 --interval 1800
+
+import argparse
+import contextlib
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+TOP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+sys.path.insert(0, TOP_DIR)
+
+import check_growth  # noqa: E402
+
+START_TIME = 1420070400
+MEMTOTAL_MB = 16 * 1024
+DISK_BLOCK_SIZE = 4096
+DISK_SIZE_GB = 100
+MOUNTPOINT = '/srv'
+
+
+def _noise(scale):
+    return random.gauss(0, scale)
+
+
+# Scenarios: usage of memory (MB) and of the disk (GB) as a function of the
+# number of days since the start of the simulation, and the day the usage
+# starts growing faster than permitted (None if it never does):
+SCENARIOS = {
+    'steady': {
+        'memory': lambda d: 6000 + _noise(50),
+        'disk': lambda d: 40 + 0.05 * d + _noise(0.1),
+        'onset': None,
+    },
+    'daily-cycle': {
+        'memory': lambda d: 6000 + 2000 * math.sin(2 * math.pi * d) +
+        _noise(50),
+        'disk': lambda d: 40 + 5 * max(0, math.sin(2 * math.pi * d)) +
+        _noise(0.1),
+        'onset': None,
+    },
+    'disk-leak': {
+        'memory': lambda d: 6000 + _noise(50),
+        'disk': lambda d: 40 + 0.05 * d + 1.5 * max(0, d - 30) + _noise(0.1),
+        'onset': 30,
+    },
+}
+
+
+def write_config(workdir):
+    config = {
+        'lockfile': os.path.join(workdir, 'check_growth.lock'),
+        'history_file': os.path.join(workdir, 'history.yml'),
+        'status_sidecar': os.path.join(workdir, 'status.json'),
+        'timeframe': 365,
+        'max_averaging_window': 14,
+        'min_averaging_window': 7,
+        'memory_mon_enabled': True,
+        'memory_mon_warn_reduction': 20,
+        'memory_mon_crit_reduction': 40,
+        'disk_mon_enabled': True,
+        'disk_mountpoints': [MOUNTPOINT],
+        'disk_mon_warn_reduction': 20,
+        'disk_mon_crit_reduction': 40,
+        'directory_mon_enabled': False,
+        'meminfo_mon_enabled': False,
+        'perfdata_enabled': False,
+    }
+    location = os.path.join(workdir, 'check_growth.yml')
+    with open(location, 'w') as fh:
+        json.dump(config, fh)  # JSON is a subset of YAML
+    return location, config['status_sidecar']
+
+
+class FakeSystem():
+    """
+    Scripted state of the simulated host.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.now = START_TIME
+        self.disk_used_gb = 0
+        os.makedirs(os.path.join(root, 'proc'))
+        os.makedirs(os.path.join(root, MOUNTPOINT.lstrip('/')))
+
+    def clock(self):
+        return self.now
+
+    def statvfs(self, path):
+        blocks = DISK_SIZE_GB * 1024**3 // DISK_BLOCK_SIZE
+        free = blocks - int(self.disk_used_gb * 1024**3 // DISK_BLOCK_SIZE)
+        return os.statvfs_result((DISK_BLOCK_SIZE, DISK_BLOCK_SIZE, blocks,
+                                  free, free, 1000000, 900000, 900000, 0, 255))
+
+    def set_state(self, now, memory_mb, disk_gb):
+        self.now = now
+        self.disk_used_gb = disk_gb
+        cached, slab, buffers = 2048 * 1024, 512 * 1024, 256 * 1024
+        memfree = MEMTOTAL_MB * 1024 - int(memory_mb * 1024) - cached - \
+            slab - buffers
+        with open(os.path.join(self.root, 'proc/meminfo'), 'w') as fh:
+            for name, value in [('MemTotal', MEMTOTAL_MB * 1024),
+                                ('MemFree', memfree), ('Buffers', buffers),
+                                ('Cached', cached), ('Slab', slab)]:
+                fh.write('{0}:{1:>16} kB\n'.format(name, value))
+
+
+def run_check(config_file):
+    devnull = open(os.devnull, 'w')
+    with devnull, contextlib.redirect_stdout(devnull), \
+            contextlib.redirect_stderr(devnull):
+        try:
+            check_growth.main(config_file, std_err=True, verbose=False)
+        except SystemExit:
+            pass
+    # main() installs a new log handler during every run:
+    logging.getLogger().handlers = []
+
+
+def simulate(name, scenario, days, interval):
+    workdir = tempfile.mkdtemp(prefix='check_growth_sim.')
+    try:
+        config_file, sidecar = write_config(workdir)
+        system = FakeSystem(os.path.join(workdir, 'root'))
+        check_growth.Host.init(clock=system.clock, root=system.root,
+                               statvfs=system.statvfs)
+
+        onset = scenario['onset']
+        first_alert = None
+        evaluated = false_positives = 0
+        costs = {}
+        runs = int(days * 86400 / interval)
+        wall_start = time.perf_counter()
+        for i in range(runs):
+            now = START_TIME + i * interval
+            day = (now - START_TIME) / 86400
+            system.set_state(now, scenario['memory'](day),
+                             scenario['disk'](day))
+
+            start = time.perf_counter()
+            run_check(config_file)
+            costs.setdefault(int(day // 7), []).append(
+                time.perf_counter() - start)
+
+            with open(sidecar, 'r') as fh:
+                statuses = json.load(fh)['series']
+            if all(x['status'] == 'unknown' for x in statuses):
+                # Not enough datapoints yet:
+                continue
+            alerting = any(x['status'] in ('warn', 'crit') for x in statuses)
+            if onset is None or day < onset:
+                evaluated += 1
+                false_positives += alerting
+            elif alerting and first_alert is None:
+                first_alert = day
+        wall = time.perf_counter() - wall_start
+    finally:
+        check_growth.Host.init()
+        shutil.rmtree(workdir)
+
+    print('{0}: {1} runs in {2:.1f}s ({3:.0f} runs/s)'.format(
+        name, runs, wall, runs / wall))
+    if evaluated:
+        print('  false positive rate: {0:.2%}'.format(
+            false_positives / evaluated))
+    if onset is not None:
+        if first_alert is None:
+            print('  alert latency: no alert')
+        else:
+            print('  alert latency: {0:.1f}h'.format(
+                (first_alert - onset) * 24))
+    for week in sorted(costs):
+        print('  week {0:>2}: {1:6.2f} ms/run'.format(
+            week, 1000 * sum(costs[week]) / len(costs[week])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--days', type=float, default=30,
+                        help='Simulated time span, in days')
+    parser.add_argument('--interval', type=int, default=1800,
+                        help='Interval between the runs, in seconds')
+    parser.add_argument('--scenario', action='append',
+                        choices=sorted(SCENARIOS),
+                        help='Scenarios to run, all of them by default')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    for name in args.scenario or sorted(SCENARIOS):
+        simulate(name, SCENARIOS[name], args.days, args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -32,5 +32,12 @@ TEST_LOCKFILE = op.join(_fabric_base_dir, 'filelock.pid')
 # Test historyfile location
 TEST_STATUSFILE = op.join(_fabric_base_dir, 'check_growth.status.yml')
 
+# Test directory scan cache location
+TEST_DIRSCAN_CACHE = op.join(_fabric_base_dir, 'check_growth.dirscan.yml')
+
+# Test Prometheus textfile location
+TEST_PROMETHEUS_FILE = op.join(_fabric_base_dir, 'check_growth.prom')
+TEST_STATUS_SIDECAR = op.join(_fabric_base_dir, 'check_growth.status.json')
+
 # Test /proc/meminfo file:
 TEST_MEMINFO = op.join(_fabric_base_dir, 'meminfo.out')
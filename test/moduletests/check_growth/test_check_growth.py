@@ -18,10 +18,19 @@
 
 # Global imports:
 import ddt
+import json
 import mock
+import numpy
 import os
+import pstats
+import random
+import shutil
+import socket
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
 from ddt import ddt, data
@@ -33,11 +42,40 @@ sys.path.append(os.path.abspath(pwd + '/../../modules/'))
 # Local imports:
 import file_paths as paths
 import check_growth
+import check_growth.push
 
 # Constants:
 DF_COMMAND = '/bin/df'  # FIXME - should be autodetected
 
 
+class FakeCollector(check_growth.collectors.Collector):
+    def __init__(self, conf):
+        super().__init__(conf)
+        self.calls = 0
+
+    def series(self):
+        return {'connections': 'conns', 'queue': 'jobs'}
+
+    def collect(self):
+        self.calls += 1
+        behaviour = self.conf.get('behaviour')
+        if behaviour == 'fail':
+            raise IOError('connection refused')
+        if behaviour == 'hang':
+            self.conf['release'].wait()
+        if behaviour == 'partial':
+            return {'queue': (10, 10**6)}
+        return {'connections': (check_growth.Host.time() / 86400, 10**6),
+                'queue': (10, 10**6)}
+
+
+def fake_entry_point(name, plugin):
+    entry_point = mock.Mock()
+    entry_point.name = name
+    entry_point.load.return_value = plugin
+    return entry_point
+
+
 class TestsBaseClass(unittest.TestCase):
 
     # Used by side effects:
@@ -55,12 +93,64 @@ class TestsBaseClass(unittest.TestCase):
                               "memory_mon_enabled": True,
                               "memory_mon_warn_reduction": 20,
                               "memory_mon_crit_reduction": 40,
+                              "memory_mon_estimator": "lstsq",
+                              "memory_mon_seasonality": None,
+                              "memory_mon_outlier_filter": None,
                               "disk_mon_enabled": True,
                               "disk_mountpoints": ["/fake/mountpoint/",
                                                    "/faker/mountpoint/",
                                                    "/not/a/mountpoint"],
                               "disk_mon_warn_reduction": 20,
                               "disk_mon_crit_reduction": 40,
+                              "disk_mon_estimator": "lstsq",
+                              "disk_mon_seasonality": None,
+                              "disk_mon_outlier_filter": None,
+                              "directory_mon_enabled": False,
+                              "directory_paths": ["/tmp/"],
+                              "directory_mon_warn_reduction": 20,
+                              "directory_mon_crit_reduction": 40,
+                              "directory_mon_estimator": "lstsq",
+                              "directory_mon_seasonality": None,
+                              "directory_mon_outlier_filter": None,
+                              "directory_scan_cache": paths.TEST_DIRSCAN_CACHE,
+                              "directory_scan_time_budget": 10,
+                              "directory_rescan_interval": 1,
+                              "meminfo_mon_enabled": False,
+                              "meminfo_series": {
+                                  "slab": {"usage": "Slab"},
+                                  "swap": {"usage": "SwapTotal - SwapFree",
+                                           "max": "SwapTotal"},
+                                  },
+                              "meminfo_mon_warn_reduction": 20,
+                              "meminfo_mon_crit_reduction": 40,
+                              "meminfo_mon_estimator": "lstsq",
+                              "meminfo_mon_seasonality": None,
+                              "meminfo_mon_outlier_filter": None,
+                              "collector_mon_enabled": False,
+                              "collectors": None,
+                              "collector_mon_warn_reduction": 20,
+                              "collector_mon_crit_reduction": 40,
+                              "collector_mon_estimator": "lstsq",
+                              "collector_mon_seasonality": None,
+                              "collector_mon_outlier_filter": None,
+                              "growth_windows": None,
+                              "perfdata_enabled": False,
+                              "prometheus_textfile": None,
+                              "threshold_overrides": None,
+                              "status_summary_top": None,
+                              "status_sidecar": None,
+                              "pure_python_max_datapoints": 2000,
+                              "max_datapoints_per_series": None,
+                              "history_wal_max_records": 50,
+                              "history_shard_days": None,
+                              "history_compact_storage": False,
+                              "series_groups": None,
+                              "push_url": None,
+                              "push_spool": None,
+                              "push_batch_size": 500,
+                              "push_timeout": 2,
+                              "adaptive_sampling": None,
+                              "evaluation_cache": None,
                               }
 
         def func(key):
@@ -84,9 +174,17 @@ class TestCommandLineParsing(unittest.TestCase):
         sys.argv = ['./check_growth.py', '-v', '-s', '-c', './check_growth.json']
         parsed_cmdline = check_growth.parse_command_line()
         self.assertEqual(parsed_cmdline, {'std_err': True,
-                                          'config_file': './check_growth.json',
+                                          'config_file': ['./check_growth.json'],
                                           'verbose': True,
                                           'clean_histdata': False,
+                                          'action': 'check',
+                                          'data_format': 'ndjson',
+                                          'data_file': '-',
+                                          'filters': {'resources': None,
+                                                      'paths': None,
+                                                      'since': None,
+                                                      'until': None},
+                                          'profile_dir': None,
                                           })
 
     def test_config_file_missing_from_commandline(self, SysExitMock):
@@ -96,16 +194,58 @@ class TestCommandLineParsing(unittest.TestCase):
             check_growth.parse_command_line()
         SysExitMock.assert_called_once_with(2)
 
+    def test_multiple_config_files(self, *unused):
+        sys.argv = ['./check_growth.py', '-c', './team_a.yml',
+                    '--config-file', './team_b.yml']
+        parsed_cmdline = check_growth.parse_command_line()
+        self.assertEqual(parsed_cmdline['config_file'],
+                         ['./team_a.yml', './team_b.yml'])
+
     def test_default_command_line_args(self, *unused):
         sys.argv = ['./check_growth.py', '-c', './check_growth.json']
         parsed_cmdline = check_growth.parse_command_line()
         self.assertEqual(parsed_cmdline, {'std_err': False,
-                                          'config_file': './check_growth.json',
+                                          'config_file': ['./check_growth.json'],
                                           'verbose': False,
                                           'clean_histdata': False,
+                                          'action': 'check',
+                                          'data_format': 'ndjson',
+                                          'data_file': '-',
+                                          'filters': {'resources': None,
+                                                      'paths': None,
+                                                      'since': None,
+                                                      'until': None},
+                                          'profile_dir': None,
                                           })
 
+    def test_export_command_line(self, *unused):
+        sys.argv = ['./check_growth.py', '-c', './check_growth.json', 'export',
+                    '-f', 'csv', '-o', '/tmp/export.csv', '--resource', 'disk',
+                    '--path', '/srv', '--path', '/var', '--since', '1000']
+        parsed_cmdline = check_growth.parse_command_line()
+        self.assertEqual(parsed_cmdline['action'], 'export')
+        self.assertEqual(parsed_cmdline['data_format'], 'csv')
+        self.assertEqual(parsed_cmdline['data_file'], '/tmp/export.csv')
+        self.assertEqual(parsed_cmdline['filters'],
+                         {'resources': ['disk'], 'paths': ['/srv', '/var'],
+                          'since': 1000, 'until': None})
+
+    def test_sample_command_line(self, *unused):
+        sys.argv = ['./check_growth.py', '-c', './check_growth.json', 'sample']
+        parsed_cmdline = check_growth.parse_command_line()
+        self.assertEqual(parsed_cmdline['action'], 'sample')
+
+    def test_export_needs_single_config(self, SysExitMock):
+        sys.argv = ['./check_growth.py', '-c', './a.yml', '-c', './b.yml',
+                    'export']
+        SysExitMock.side_effect = SystemExit(2)
+        with mock.patch('sys.stderr'):
+            with self.assertRaises(SystemExit):
+                check_growth.parse_command_line()
+        SysExitMock.assert_called_once_with(2)
 
+
+@ddt
 class TestSystemMeasurement(unittest.TestCase):
     def test_memusage_fetch(self):
 
@@ -119,6 +259,68 @@ class TestSystemMeasurement(unittest.TestCase):
         self.assertLessEqual(cur_mem, 3808.93)
         self.assertLessEqual(max_mem, 24058.3)
 
+    def test_fake_host(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.addCleanup(check_growth.Host.init)
+        os.makedirs(os.path.join(root, 'proc'))
+        shutil.copy(paths.TEST_MEMINFO, os.path.join(root, 'proc/meminfo'))
+        statvfs = mock.Mock(return_value=os.statvfs_result(
+            (4096, 4096, 262144, 131072, 65536, 1000, 400, 400, 0, 255)))
+
+        check_growth.Host.init(clock=lambda: 1234567890, root=root,
+                               statvfs=statvfs)
+
+        self.assertEqual(check_growth.Host.time(), 1234567890)
+        self.assertEqual(check_growth.fetch_memory_usage()[1], 24058.3)
+        self.assertEqual(check_growth.fetch_disk_usage('/srv'), (768.0, 1024.0))
+        self.assertEqual(check_growth.fetch_inode_usage('/srv'), (600, 1000))
+        statvfs.assert_called_with('/srv')
+
+    def _fetch_meminfo_series(self, series):
+        with open(paths.TEST_MEMINFO, 'r') as fh:
+            tmp = fh.read()
+
+        m = mock.mock_open(read_data=tmp)
+        with mock.patch('check_growth.open', m, create=True):
+            return check_growth.fetch_meminfo_usage(
+                *check_growth.compile_meminfo_series(series))
+
+    def test_meminfo_series_fetch(self):
+        result = self._fetch_meminfo_series(
+            {'slab': {'usage': 'Slab'},
+             'swap': {'usage': 'SwapTotal-SwapFree', 'max': 'SwapTotal'},
+             'unreclaimable': {'usage': 'SUnreclaim + Shmem'},
+             'hugepages': {'usage': 'HugePages_Total - HugePages_Free',
+                           'max': 'HugePages_Total'},
+             })
+
+        self.assertEqual(result['slab'], (1042.02, 24058.3, 'MB'))
+        self.assertEqual(result['swap'], (0, 2048.0, 'MB'))
+        self.assertEqual(result['unreclaimable'], (266.81, 24058.3, 'MB'))
+        self.assertEqual(result['hugepages'], (0, 0, 'pages'))
+
+    def test_meminfo_series_unit_mismatch(self):
+        with self.assertRaises(check_growth.RecoverableException):
+            self._fetch_meminfo_series({'hugepages': {'usage': 'HugePages_Free'}})
+
+    def test_meminfo_series_missing_field(self):
+        with self.assertRaises(check_growth.RecoverableException):
+            self._fetch_meminfo_series({'foo': {'usage': 'NoSuchField'}})
+
+    def test_meminfo_expression_parsing(self):
+        field_index, compiled = check_growth.compile_meminfo_series(
+            {'foo': {'usage': 'Active(anon) - Slab + Shmem', 'max': 'Slab'}})
+
+        self.assertEqual(field_index, {'Active(anon)': 0, 'Slab': 1, 'Shmem': 2})
+        self.assertEqual(compiled['foo'],
+                         ([(1, 0), (-1, 1), (1, 2)], [(1, 1)]))
+
+        for expression in ['Slab Shmem', 'Slab - ', '', '2 * Slab']:
+            with self.assertRaises(ValueError):
+                check_growth.compile_meminfo_series(
+                    {'foo': {'usage': expression}})
+
     def test_inodeusage_fetch(self):
         cur_inode, max_inode = check_growth.fetch_inode_usage(
             paths.MOUNTPOINT_DIRS[0])
@@ -166,6 +368,218 @@ class TestSystemMeasurement(unittest.TestCase):
 
         self.assertTrue(result, 5)
 
+    def _spiky_datapoints(self, count):
+        # Steady growth of 10 units/day, sampled every 5 minutes, with
+        # a short, big spike near the end of the series:
+        cur_time = 1400000000
+        datapoints = {cur_time + i * 300: 1000 + i * 10 / 288
+                      for i in range(0, count)}
+        for i in range(count * 3 // 4, count * 3 // 4 + max(count // 50, 1)):
+            datapoints[cur_time + i * 300] += 50000
+        return datapoints
+
+    def test_theil_sen_ignores_spikes(self):
+        datapoints = self._spiky_datapoints(1000)
+
+        lstsq = check_growth.find_current_grow_ratio(datapoints)
+        robust = check_growth.find_current_grow_ratio(datapoints,
+                                                      estimator='theil-sen')
+
+        self.assertGreater(abs(lstsq - 10), 10)
+        self.assertAlmostEqual(robust, 10, places=2)
+
+    def test_theil_sen_exact_for_short_series(self):
+        x = numpy.array([1, 2, 4, 7, 11], dtype=float)
+        y = numpy.array([3, 1, 8, 6, 30], dtype=float)
+        slopes = [(y[j] - y[i]) / (x[j] - x[i])
+                  for i in range(len(x)) for j in range(i + 1, len(x))]
+
+        self.assertEqual(check_growth.theil_sen_slope(x, y),
+                         numpy.median(slopes))
+
+    def test_theil_sen_sampled_for_long_series(self):
+        datapoints = self._spiky_datapoints(20000)
+
+        x = numpy.array(sorted(datapoints.keys()), dtype=float)
+        y = numpy.array([datapoints[t] for t in x])
+        result = check_growth.theil_sen_slope(x, y)
+
+        self.assertAlmostEqual(result * 3600 * 24, 10, places=2)
+        # Results are reproducible:
+        self.assertEqual(result, check_growth.theil_sen_slope(x, y))
+
+    @staticmethod
+    def _cyclic_datapoints(days, offset):
+        # 10 units/day of growth with a strong daily cycle (amplitude of 500),
+        # sampled every 10 minutes. The series starts `offset` hours after
+        # the midnight:
+        cur_time = 1400000000 + offset * 3600
+        datapoints = {}
+        for i in range(0, days * 144):
+            t = cur_time + i * 600
+            datapoints[t] = 1000 + (t - 1400000000) * 10 / 86400 + \
+                500 * numpy.sin(2 * numpy.pi * t / 86400)
+        return datapoints
+
+    @data(0, 5, 13, 19)
+    def test_seasonality_removal(self, offset):
+        datapoints = self._cyclic_datapoints(3, offset)
+        # Cut the series in the middle of a daily cycle:
+        datapoints = {x: datapoints[x] for x in sorted(datapoints)[:-40]}
+
+        plain = check_growth.find_current_grow_ratio(datapoints)
+        detrended = check_growth.find_current_grow_ratio(
+            datapoints, seasonality=['daily'])
+        robust = check_growth.find_current_grow_ratio(
+            datapoints, estimator='theil-sen', seasonality=['daily'])
+
+        self.assertGreater(abs(plain - 10), 10)
+        self.assertAlmostEqual(detrended, 10, places=1)
+        self.assertAlmostEqual(robust, 10, places=1)
+
+    def test_seasonality_longer_than_dataspan_is_ignored(self):
+        datapoints = self._cyclic_datapoints(3, 0)
+
+        self.assertEqual(
+            check_growth.find_current_grow_ratio(datapoints,
+                                                 seasonality=['daily']),
+            check_growth.find_current_grow_ratio(datapoints,
+                                                 seasonality=['daily',
+                                                              'weekly']))
+
+    def test_outliers_are_ignored(self):
+        datapoints = self._spiky_datapoints(1000)
+        spikes = [x for x in datapoints if datapoints[x] > 10000]
+
+        result = check_growth.find_current_grow_ratio(datapoints,
+                                                      outliers=spikes)
+
+        self.assertAlmostEqual(result, 10, places=2)
+        result = check_growth.find_window_grow_ratios(
+            datapoints, {'all': (14, 1)}, outliers=spikes)
+        self.assertAlmostEqual(result['all'], 10, places=2)
+
+    def test_too_many_outliers(self):
+        datapoints = {1400000000 + x * 3600: x for x in range(10)}
+        for flagged in [sorted(datapoints)[1:], sorted(datapoints)]:
+            for estimator in ['lstsq', 'theil-sen']:
+                self.assertIsNone(check_growth.find_current_grow_ratio(
+                    datapoints, estimator=estimator, outliers=flagged))
+                self.assertEqual(check_growth.find_window_grow_ratios(
+                    datapoints, {'all': (14, 0)}, estimator=estimator,
+                    outliers=flagged), {'all': None})
+
+    def test_window_growth_ratios_calculation(self):
+        # Slow growth for 10 days, then a fast one during the last 6 hours:
+        datapoints = {}
+        cur_time = 1400000000
+        for i in range(0, 240):
+            datapoints[cur_time + i * 3600] = 1000 + i * 10 / 24
+        for i in range(240, 247):
+            datapoints[cur_time + i * 3600] = datapoints[cur_time + 239 * 3600] + \
+                (i - 239) * 100 / 24
+
+        result = check_growth.find_window_grow_ratios(
+            datapoints, {'long': (14, 7), 'short': (0.25, 0.2),
+                         'tiny': (0.05, 0.01), 'toolong': (14, 12)})
+
+        x = numpy.array(sorted(datapoints.keys()))
+        y = numpy.array([datapoints[t] for t in x])
+        reference = numpy.polyfit(x, y, 1)[0] * 3600 * 24
+        self.assertAlmostEqual(result['long'], reference, places=2)
+        self.assertAlmostEqual(result['short'], 100, places=2)
+        # Not enough datapoints/dataspan:
+        self.assertIsNone(result['tiny'])
+        self.assertIsNone(result['toolong'])
+
+    def test_pure_python_regression_matches_numpy(self):
+        datapoints = self._spiky_datapoints(1000)
+        outliers = sorted(datapoints)[100:110]
+        windows = {'long': (14, 1), 'short': (0.5, 0.2)}
+
+        for kwargs in [{}, {'outliers': outliers}]:
+            pure = check_growth.find_current_grow_ratio(
+                datapoints, pure_python_limit=1000, **kwargs)
+            with_numpy = check_growth.find_current_grow_ratio(
+                datapoints, pure_python_limit=0, **kwargs)
+            self.assertAlmostEqual(pure, with_numpy, places=2)
+
+            pure = check_growth.find_window_grow_ratios(
+                datapoints, windows, pure_python_limit=1000, **kwargs)
+            with_numpy = check_growth.find_window_grow_ratios(
+                datapoints, windows, pure_python_limit=0, **kwargs)
+            self.assertEqual(pure, with_numpy)
+
+    @staticmethod
+    def _realistic_datapoints(start, growth, noise):
+        # Two weeks of 5-minute samples at present-day timestamps:
+        rng = random.Random(0)
+        cur_time = 1700000000
+        return {cur_time + i * 300: start + growth * i / 288 +
+                rng.gauss(0, noise) for i in range(14 * 288)}
+
+    # (starting usage, growth per day, noise) of a big disk in MB, inodes,
+    # memory in MB and a small meminfo series:
+    @data((1200000, 850, 30), (60000000, 1234, 100), (15000, 3.7, 200),
+          (300, 0.05, 0.5))
+    def test_compact_series_regression_matches_float64(self, series):
+        datapoints = self._realistic_datapoints(*series)
+        compact = check_growth.CompactSeries(sorted(datapoints.items()))
+        self.assertEqual(list(compact), sorted(datapoints))
+        x = numpy.array(sorted(datapoints), dtype=numpy.float64)
+        y = numpy.array([datapoints[t] for t in sorted(datapoints)])
+        reference = numpy.polyfit(x - x.mean(), y, 1)[0] * 3600 * 24
+        windows = {'long': (14, 1), 'short': (2, 1)}
+
+        for source in [datapoints, compact]:
+            for limit in [0, len(datapoints)]:
+                self.assertAlmostEqual(
+                    check_growth.find_current_grow_ratio(
+                        source, pure_python_limit=limit),
+                    reference, delta=0.01)
+                self.assertEqual(
+                    check_growth.find_window_grow_ratios(
+                        source, windows, pure_python_limit=limit)['long'],
+                    check_growth.find_current_grow_ratio(datapoints))
+        self.assertAlmostEqual(
+            check_growth.find_current_grow_ratio(compact,
+                                                 estimator='theil-sen'),
+            check_growth.find_current_grow_ratio(datapoints,
+                                                 estimator='theil-sen'),
+            delta=0.01)
+        self.assertAlmostEqual(
+            check_growth.find_window_grow_ratios(compact, windows)['short'],
+            check_growth.find_window_grow_ratios(datapoints,
+                                                 windows)['short'],
+            delta=0.01)
+
+        # Columns take 8 bytes per datapoint:
+        encoded = compact.encode()
+        self.assertEqual(len(encoded['offsets']) + len(encoded['values']),
+                         8 * len(datapoints))
+        self.assertEqual(dict(check_growth.CompactSeries.decode(encoded)),
+                         dict(compact))
+
+    def test_numpy_is_not_imported_on_startup(self):
+        # Importing numpy takes longer than the whole check run in the common
+        # case, it has to be deferred until it is needed:
+        code = 'import sys, check_growth; ' + \
+            'check_growth.find_current_grow_ratio({1: 5, 20: 100, 30: 150}); ' + \
+            'print("numpy" in sys.modules)'
+        output = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.abspath(pwd + '/../../../'))
+        self.assertEqual(output.strip(), b'False')
+
+    def test_push_is_not_imported_on_startup(self):
+        code = 'import sys, check_growth; ' + \
+            'print("check_growth.push" in sys.modules, ' + \
+            '"http.client" in sys.modules)'
+        output = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.abspath(pwd + '/../../../'))
+        self.assertEqual(output.strip(), b'False False')
+
 
 class TestConfigVerification(TestsBaseClass):
 
@@ -225,6 +639,123 @@ class TestConfigVerification(TestsBaseClass):
         self.assertIn('There should be at least one resourece check enabled.',
                       msg)
 
+    def test_series_groups_sanity(self):
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(
+                disk_mountpoints=paths.MOUNTPOINT_DIRS,
+                series_groups={'data': {'resource': 'disk', 'match': '/data*'},
+                               'foo': {'match': '/foo*'},
+                               'dirs': {'resource': 'directory'},
+                               'inodes': {'resource': 'disk',
+                                          'data_type': 'inodes'}})
+        with self.assertRaises(SystemExit):
+            check_growth.verify_conf()
+        status, msg = self.mocks['check_growth.ScriptStatus'].notify_immediate.call_args[0]
+        self.assertEqual(status, 'unknown')
+        self.assertNotIn('Series group data', msg)
+        self.assertIn('Series group foo should define resource', msg)
+        self.assertIn('Series group dirs resource type is not enabled', msg)
+        self.assertIn('Series group inodes data_type should be either inode ' +
+                      'or space', msg)
+
+    def test_threshold_overrides_sanity(self):
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(
+                disk_mountpoints=paths.MOUNTPOINT_DIRS,
+                threshold_overrides=[{'match': '/data*', 'timeframe': 20},
+                                     {'resource': 'directory',
+                                      'warn_reduction': 10},
+                                     {'match': '/var/log', 'warn': 10}])
+        with self.assertRaises(SystemExit):
+            check_growth.verify_conf()
+        status, msg = self.mocks['check_growth.ScriptStatus'].notify_immediate.call_args[0]
+        self.assertEqual(status, 'unknown')
+        self.assertIn('timeframe should be greater than 2 * max averaging ' +
+                      'window', msg)
+        self.assertIn('refers to a resource which is not monitored', msg)
+        self.assertIn('threshold_overrides entries should be hashes', msg)
+
+    def test_threshold_overrides_merged_sanity(self):
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(
+                disk_mountpoints=paths.MOUNTPOINT_DIRS,
+                growth_windows={'short': {'averaging_window': 0.25,
+                                          'min_averaging_window': 0.1,
+                                          'crit_reduction': 60}},
+                threshold_overrides=[{'resource': 'disk',
+                                      'warn_reduction': 50},
+                                     {'resource': 'memory',
+                                      'crit_reduction': 'x'},
+                                     {'match': '/data*', 'warn_reduction': 70,
+                                      'crit_reduction': 100},
+                                     {'match': '/srv*', 'timeframe': 'year'}])
+        with self.assertRaises(SystemExit):
+            check_growth.verify_conf()
+        status, msg = self.mocks['check_growth.ScriptStatus'].notify_immediate.call_args[0]
+        self.assertEqual(status, 'unknown')
+        # Only the warning reduction is overridden, the critical one comes
+        # from the defaults of the resource:
+        self.assertIn("'warn_reduction': 50} applied to disk series: " +
+                      'warn_reduction should be lower than crit_reduction',
+                      msg)
+        self.assertIn("'crit_reduction': 'x'} applied to memory series: " +
+                      'reductions should be positive numbers', msg)
+        # Growth window reductions are merged onto the overridden ones:
+        self.assertIn("'crit_reduction': 100} applied to disk series: " +
+                      'growth window short warn_reduction should be lower ' +
+                      'than its crit_reduction', msg)
+        self.assertNotIn('Thresholds of', msg)
+        self.assertIn("'timeframe': 'year'} timeframe should be greater " +
+                      'than 2 * max averaging window', msg)
+
+    def test_growth_windows_thresholds_sanity(self):
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(
+                disk_mountpoints=paths.MOUNTPOINT_DIRS,
+                growth_windows={'short': {'averaging_window': 0.25,
+                                          'min_averaging_window': 0.1,
+                                          'warn_reduction': 40},
+                                'long': {'averaging_window': 1,
+                                         'min_averaging_window': 0.5,
+                                         'crit_reduction': 'x'}})
+        with self.assertRaises(SystemExit):
+            check_growth.verify_conf()
+        status, msg = self.mocks['check_growth.ScriptStatus'].notify_immediate.call_args[0]
+        self.assertEqual(status, 'unknown')
+        self.assertIn('Growth window long reductions should be positive', msg)
+        self.assertIn('Thresholds of disk series: growth window short ' +
+                      'warn_reduction should be lower than its crit_reduction',
+                      msg)
+
+    def test_threshold_overrides_resolution(self):
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(
+                threshold_overrides=[{'match': '/var/log/',
+                                      'warn_reduction': 50,
+                                      'crit_reduction': 100},
+                                     {'resource': 'disk', 'match': '/data*',
+                                      'timeframe': 730},
+                                     {'resource': 'memory',
+                                      'crit_reduction': 60}])
+        series = [('memory', None, None),
+                  ('disk', '/var/log/', 'space'),
+                  ('disk', '/data/db/', 'inode'),
+                  ('directory', '/data/db/', None),
+                  ('disk', '/', 'space')]
+        windows = {'short': {'averaging_window': 0.25,
+                             'min_averaging_window': 0.1,
+                             'crit_reduction': 1000}}
+
+        warn, crit, timeframes = check_growth.resolve_thresholds(series,
+                                                                 windows)
+
+        numpy.testing.assert_array_equal(
+            warn, [[20, 20], [50, 50], [20, 20], [20, 20], [20, 20]])
+        numpy.testing.assert_array_equal(
+            crit, [[60, 1000], [100, 1000], [40, 1000], [40, 1000], [40, 1000]])
+        numpy.testing.assert_array_equal(timeframes,
+                                         [365, 365, 730, 365, 365])
+
     def test_configuration_ok(self):
         self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
             self._script_conf_factory(disk_mountpoints=paths.MOUNTPOINT_DIRS)
@@ -299,13 +830,17 @@ class TestScriptLogic(TestsBaseClass):
         self.mocks = {}
         for patched in ['check_growth.fetch_inode_usage',
                         'check_growth.fetch_disk_usage',
-                        'check_growth.fetch_memory_usage',
+                        'check_growth.fetch_meminfo_usage',
+                        'check_growth.fetch_directory_usage',
+                        'check_growth.DirectoryScanCache',
                         'check_growth.find_planned_grow_ratio',
                         'check_growth.find_current_grow_ratio',
+                        'check_growth.find_window_grow_ratios',
                         'check_growth.HistoryFile',
-                        'check_growth.ScriptLock',
                         'check_growth.ScriptStatus',
                         'check_growth.verify_conf',
+                        'check_growth.write_prometheus_textfile',
+                        'check_growth.write_status_sidecar',
                         'check_growth.ScriptConfiguration',
                         'check_growth.logging',
                         ]:
@@ -321,7 +856,9 @@ class TestScriptLogic(TestsBaseClass):
 
         self.mocks['check_growth.fetch_disk_usage'].return_value = (1000, 2000)
         self.mocks['check_growth.fetch_inode_usage'].return_value = (2000, 4000)
-        self.mocks['check_growth.fetch_memory_usage'].return_value = (1000, 2000)
+        self.mocks['check_growth.fetch_meminfo_usage'].side_effect = \
+            lambda field_index, compiled: {x: (1000, 2000, 'MB') for x in compiled}
+        self.mocks['check_growth.fetch_directory_usage'].return_value = (1000, 2000)
         self.mocks['check_growth.HistoryFile'].verify_dataspan.return_value = 10
         self.mocks['check_growth.HistoryFile'].get_datapoints.side_effect = \
             self._dummy_datapoints
@@ -330,7 +867,7 @@ class TestScriptLogic(TestsBaseClass):
 
     @staticmethod
     def _dummy_datapoints(dtype, path=None, data_type=None):
-        if dtype in ('memory', 'disk'):
+        if dtype in ('memory', 'disk', 'directory', 'meminfo'):
             return (1212, 1232, 500, 1563)
         else:
             self.fail("Unsupported datapoints type requested: {0}.".format(
@@ -347,11 +884,6 @@ class TestScriptLogic(TestsBaseClass):
             paths.TEST_CONFIG_FILE)
         self.assertTrue(self.mocks['check_growth.verify_conf'].called)
 
-        # Lock is properly handled:
-        self.mocks['check_growth.ScriptLock'].init.assert_called_once_with(
-            paths.TEST_LOCKFILE)
-        self.assertTrue(self.mocks['check_growth.ScriptLock'].aqquire.called)
-
         # Monitoring is notified:
         self.assertTrue(self.mocks['check_growth.ScriptStatus'].init.called)
         self.assertTrue(self.mocks['check_growth.ScriptStatus'].notify_agregated.called)
@@ -360,13 +892,33 @@ class TestScriptLogic(TestsBaseClass):
         self.mocks['check_growth.HistoryFile'].init.assert_called_once_with(
             location=paths.TEST_STATUSFILE,
             max_averaging_window=14,
-            min_averaging_window=7)
+            min_averaging_window=7,
+            max_datapoints=None,
+            lock_location=paths.TEST_LOCKFILE,
+            wal_max_records=50, shard_period=None, compact=False)
         self.assertTrue(self.mocks['check_growth.HistoryFile'].save.called)
 
         # Status is OK
         status, msg = self.mocks['check_growth.ScriptStatus'].update.call_args[0]
         self.assertEqual(status, 'ok')
 
+    def test_profiling(self):
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory()
+        profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profile_dir)
+
+        with self.assertRaises(SystemExit):
+            check_growth.main(config_file=paths.TEST_CONFIG_FILE,
+                              profile_dir=profile_dir)
+
+        # The check itself has run:
+        self.assertTrue(self.mocks['check_growth.ScriptStatus'].notify_agregated.called)
+        # Results are stored even though the run ended with sys.exit():
+        self.assertEqual(sorted(os.path.splitext(x)[1]
+                                for x in os.listdir(profile_dir)),
+                         ['.alloc', '.prof'])
+
     def test_history_cleaning(self):
         self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
             self._script_conf_factory()
@@ -412,8 +964,12 @@ class TestScriptLogic(TestsBaseClass):
                             [mock.call(1000, 2000, 365),
                             mock.call(2000, 4000, 365)])
         self.assertEqual(self.mocks['check_growth.find_current_grow_ratio'].call_args_list,
-                            [mock.call((1212, 1232, 500, 1563), ),
-                            mock.call((1212, 1232, 500, 1563), )])
+                            [mock.call((1212, 1232, 500, 1563), estimator='lstsq',
+                                       seasonality=None, outliers=None,
+                                       pure_python_limit=2000),
+                            mock.call((1212, 1232, 500, 1563), estimator='lstsq',
+                                      seasonality=None, outliers=None,
+                                      pure_python_limit=2000)])
 
         status, msg = self.mocks['check_growth.ScriptStatus'].update.call_args[0]
         self.assertEqual(status, data[0])
@@ -429,11 +985,1213 @@ class TestScriptLogic(TestsBaseClass):
             check_growth.main(config_file=paths.TEST_CONFIG_FILE)
 
         self.mocks['check_growth.find_planned_grow_ratio'].assert_called_with(1000, 2000, 365)
-        self.mocks['check_growth.find_current_grow_ratio'].assert_called_with((1212, 1232, 500, 1563),)
+        self.mocks['check_growth.find_current_grow_ratio'].assert_called_with(
+            (1212, 1232, 500, 1563), estimator='lstsq', seasonality=None,
+            outliers=None, pure_python_limit=2000)
 
         status, msg = self.mocks['check_growth.ScriptStatus'].update.call_args[0]
         self.assertEqual(status, data[0])
 
+    @data(("warn", 130), ("crit", 160))
+    def test_directory_alert_condition(self, data):
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(memory_mon_enabled=False,
+                                      disk_mon_enabled=False,
+                                      directory_mon_enabled=True,
+                                      directory_paths=['/tmp/', '/dev/shm/'])
+
+        self.mocks['check_growth.find_current_grow_ratio'].return_value = data[1]
+
+        with self.assertRaises(SystemExit):
+            check_growth.main(config_file=paths.TEST_CONFIG_FILE)
+
+        # Time budget is split evenly between trees:
+        self.assertEqual(self.mocks['check_growth.fetch_directory_usage'].call_args_list,
+                         [mock.call('/tmp/', 5, 1),
+                          mock.call('/dev/shm/', 5, 1)])
+        self.mocks['check_growth.DirectoryScanCache'].init.assert_called_once_with(
+            paths.TEST_DIRSCAN_CACHE)
+        self.assertTrue(self.mocks['check_growth.DirectoryScanCache'].save.called)
+
+        status, msg = self.mocks['check_growth.ScriptStatus'].update.call_args[0]
+        self.assertEqual(status, data[0])
+
+    @data(("warn", 130), ("crit", 160))
+    def test_meminfo_alert_condition(self, data):
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(disk_mon_enabled=False,
+                                      meminfo_mon_enabled=True)
+
+        self.mocks['check_growth.find_current_grow_ratio'].return_value = data[1]
+
+        with self.assertRaises(SystemExit):
+            check_growth.main(config_file=paths.TEST_CONFIG_FILE)
+
+        # /proc/meminfo is read only once for all the series:
+        self.assertEqual(self.mocks['check_growth.fetch_meminfo_usage'].call_count, 1)
+        self.assertEqual(
+            self.mocks['check_growth.HistoryFile'].add_datapoint.call_args_list,
+            [mock.call('memory', 1000, path=None, data_type=None),
+             mock.call('meminfo', 1000, path='slab', data_type=None),
+             mock.call('meminfo', 1000, path='swap', data_type=None)])
+
+        status, msg = self.mocks['check_growth.ScriptStatus'].update.call_args[0]
+        self.assertEqual(status, data[0])
+        self.assertIn('Meminfo series swap growth', msg)
+
+    def test_growth_windows(self):
+        windows = {'short': {'averaging_window': 0.25,
+                             'min_averaging_window': 0.1,
+                             'warn_reduction': 500,
+                             'crit_reduction': 1000},
+                   'week': {'averaging_window': 7,
+                            'min_averaging_window': 1}}
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(disk_mon_enabled=False,
+                                      growth_windows=windows,
+                                      perfdata_enabled=True)
+        self.mocks['check_growth.find_window_grow_ratios'].return_value = \
+            {'short': 650, 'week': None}
+
+        with self.assertRaises(SystemExit):
+            check_growth.main(config_file=paths.TEST_CONFIG_FILE)
+
+        self.mocks['check_growth.find_window_grow_ratios'].assert_called_once_with(
+            (1212, 1232, 500, 1563), {'short': (0.25, 0.1), 'week': (7, 1)},
+            estimator='lstsq', seasonality=None, outliers=None,
+            pure_python_limit=2000)
+        updates = [x[0] for x in
+                   self.mocks['check_growth.ScriptStatus'].update.call_args_list]
+        # Threshold checks are done for all the series at once, after
+        # the data has been gathered:
+        self.assertEqual(updates[0][0], 'unknown')
+        self.assertIn('in week window', updates[0][1])
+        self.assertEqual(updates[1][0], 'ok')
+        self.assertEqual(updates[2][0], 'warn')
+        self.assertIn('(short window)', updates[2][1])
+        self.assertEqual(updates[3],
+                         ('ok', "| 'memory_growth'=60;120.0;140.0 " +
+                          "'memory_growth_short'=650;600.0;1100.0"))
+
+    def test_outlier_filtering(self):
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(disk_mon_enabled=False,
+                                      memory_mon_outlier_filter={'window': 30,
+                                                                 'threshold': 4})
+        self.mocks['check_growth.HistoryFile'].add_datapoint.return_value = 1234
+        self.mocks['check_growth.HistoryFile'].get_outliers.return_value = [1234]
+
+        with self.assertRaises(SystemExit):
+            check_growth.main(config_file=paths.TEST_CONFIG_FILE)
+
+        self.mocks['check_growth.HistoryFile'].filter_datapoint.assert_called_once_with(
+            'memory', 1000, 1234, path=None, data_type=None, window=30,
+            threshold=4)
+        self.mocks['check_growth.HistoryFile'].verify_dataspan.assert_called_with(
+            'memory', path=None, data_type=None, outliers=[1234])
+        self.mocks['check_growth.find_current_grow_ratio'].assert_called_with(
+            (1212, 1232, 500, 1563), estimator='lstsq', seasonality=None,
+            outliers=[1234], pure_python_limit=2000)
+
+        # Too few datapoints are left once the outliers are ignored:
+        self.mocks['check_growth.find_current_grow_ratio'].return_value = None
+        with self.assertRaises(SystemExit):
+            check_growth.main(config_file=paths.TEST_CONFIG_FILE)
+        self.mocks['check_growth.ScriptStatus'].update.assert_any_call(
+            'unknown', 'There is not enough data to calculate current ' +
+            'memory usage growth.')
+
+    def test_prometheus_export(self):
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(disk_mountpoints=['/tmp/'],
+                                      prometheus_textfile=paths.TEST_PROMETHEUS_FILE)
+
+        with self.assertRaises(SystemExit):
+            check_growth.main(config_file=paths.TEST_CONFIG_FILE)
+
+        location, results, duration = \
+            self.mocks['check_growth.write_prometheus_textfile'].call_args[0]
+        self.assertEqual(location, paths.TEST_PROMETHEUS_FILE)
+        self.assertGreaterEqual(duration, 0)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0],
+                         {'prefix': 'memory', 'path': None, 'data_type': None,
+                          'units': 'MB', 'cur_usage': 1000, 'max_usage': 2000,
+                          'planned_growth': 100, 'days_to_full': 16.67,
+                          'datapoints': 4, 'growth': {'main': 60}})
+        self.assertEqual(results[2]['units'], 'inodes')
+
+    def test_threshold_overrides(self):
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(
+                memory_mon_enabled=False,
+                disk_mountpoints=['/tmp/', '/'],
+                threshold_overrides=[{'match': '/tmp*', 'warn_reduction': 50,
+                                      'crit_reduction': 100,
+                                      'timeframe': 730}])
+        self.mocks['check_growth.find_current_grow_ratio'].return_value = 130
+
+        with self.assertRaises(SystemExit):
+            check_growth.main(config_file=paths.TEST_CONFIG_FILE)
+
+        self.assertEqual(
+            self.mocks['check_growth.find_planned_grow_ratio'].call_args_list,
+            [mock.call(1000, 2000, 730), mock.call(1000, 2000, 365),
+             mock.call(2000, 4000, 730), mock.call(2000, 4000, 365)])
+        statuses = [x[0][0] for x in
+                    self.mocks['check_growth.ScriptStatus'].update.call_args_list]
+        self.assertEqual(statuses, ['ok', 'warn', 'ok', 'warn'])
+
+    def test_status_summary(self):
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(
+                memory_mon_enabled=False,
+                disk_mountpoints=['/tmp/', '/'],
+                status_summary_top=1,
+                status_sidecar=paths.TEST_STATUS_SIDECAR,
+                perfdata_enabled=True)
+        self.mocks['check_growth.find_current_grow_ratio'].side_effect = \
+            [130, 125, 60, 60]
+
+        with self.assertRaises(SystemExit):
+            check_growth.main(config_file=paths.TEST_CONFIG_FILE)
+
+        updates = [x[0] for x in
+                   self.mocks['check_growth.ScriptStatus'].update.call_args_list]
+        self.assertEqual(updates,
+                         [('warn', '4 series: 0 crit, 2 warn, 0 unknown, 2 ok.'),
+                          ('warn', 'Space usage growth for mount /tmp/ ' +
+                           'exceeds planned growth - current: 130 MB/day, ' +
+                           'planned: 100 MB/day.'),
+                          # Perfdata is limited to the reported series:
+                          ('ok', "| 'disk:/tmp/:space_growth'=130;120.0;140.0")])
+        location, statuses = \
+            self.mocks['check_growth.write_status_sidecar'].call_args[0]
+        self.assertEqual(location, paths.TEST_STATUS_SIDECAR)
+        self.assertEqual(len(statuses), 4)
+        self.assertEqual(statuses[1]['series'], 'disk:/:space')
+        self.assertEqual(statuses[1]['current_growth'], 125)
+
+    def test_multiple_configs(self):
+        configs = {'/etc/team_a.yml': self._script_conf_factory(
+                       history_file='/tmp/team_a.status.yml',
+                       disk_mountpoints=['/tmp/', '/']),
+                   '/etc/team_b.yml': self._script_conf_factory(
+                       history_file='/tmp/team_b.status.yml',
+                       disk_mountpoints=['/tmp/'],
+                       disk_mon_warn_reduction=10,
+                       meminfo_mon_enabled=True),
+                   }
+        loaded = []
+        self.mocks['check_growth.ScriptConfiguration'].load_config.side_effect = \
+            loaded.append
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            lambda key: configs[loaded[-1]](key)
+        self.mocks['check_growth.find_current_grow_ratio'].return_value = 115
+
+        with self.assertRaises(SystemExit):
+            check_growth.main(config_file=sorted(configs))
+
+        # Every unique resource is sampled exactly once:
+        self.assertEqual(
+            self.mocks['check_growth.fetch_meminfo_usage'].call_count, 1)
+        self.assertEqual(
+            sorted(self.mocks['check_growth.fetch_disk_usage'].call_args_list),
+            [mock.call('/'), mock.call('/tmp/')])
+        self.assertEqual(
+            self.mocks['check_growth.fetch_inode_usage'].call_count, 2)
+
+        # ... but each config has its own history and thresholds:
+        self.assertEqual(
+            [x[1]['location'] for x in
+             self.mocks['check_growth.HistoryFile'].init.call_args_list],
+            ['/tmp/team_a.status.yml', '/tmp/team_b.status.yml'])
+        msgs = {x[0][1]: x[0][0] for x in
+                self.mocks['check_growth.ScriptStatus'].update.call_args_list}
+        self.assertEqual(msgs['team_a: Space usage growth for mount /tmp/ ' +
+                              'is OK (115 MB/day).'], 'ok')
+        self.assertEqual(msgs['team_b: Space usage growth for mount /tmp/ ' +
+                              'exceeds planned growth - current: 115 ' +
+                              'MB/day, planned: 100 MB/day.'], 'warn')
+        self.assertIn('team_b: Meminfo series slab growth is OK ' +
+                      '(115 MB/day).', msgs)
+        self.assertEqual(
+            self.mocks['check_growth.ScriptStatus'].notify_agregated.call_count,
+            1)
+
+    def test_directory_initial_scan_in_progress(self):
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(memory_mon_enabled=False,
+                                      disk_mon_enabled=False,
+                                      directory_mon_enabled=True)
+        self.mocks['check_growth.fetch_directory_usage'].return_value = (None, 2000)
+
+        with self.assertRaises(SystemExit):
+            check_growth.main(config_file=paths.TEST_CONFIG_FILE)
+
+        self.assertFalse(self.mocks['check_growth.HistoryFile'].add_datapoint.called)
+        status, msg = self.mocks['check_growth.ScriptStatus'].update.call_args[0]
+        self.assertEqual(status, 'unknown')
+        self.assertIn('still in progress', msg)
+
+
+class TestDirectoryScanCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tree)
+        for subdir in ['a', 'a/b', 'c']:
+            os.mkdir(os.path.join(self.tree, subdir))
+            with open(os.path.join(self.tree, subdir, 'file'), 'wb') as fh:
+                fh.write(b'x' * 8192)
+
+        try:
+            os.unlink(paths.TEST_DIRSCAN_CACHE)
+        except (OSError, IOError):
+            pass
+        check_growth.DirectoryScanCache.init(paths.TEST_DIRSCAN_CACHE)
+
+    def _du(self):
+        size = 0
+        for root, dirs, files in os.walk(self.tree):
+            for f in files:
+                size += os.lstat(os.path.join(root, f)).st_blocks * 512
+        return size
+
+    def test_full_scan(self):
+        size = check_growth.DirectoryScanCache.scan(self.tree, 10, 1)
+        self.assertEqual(size, self._du())
+
+    def test_unchanged_directories_are_not_listed(self):
+        check_growth.DirectoryScanCache.scan(self.tree, 10, 1)
+        with open(os.path.join(self.tree, 'c', 'file2'), 'wb') as fh:
+            fh.write(b'x' * 8192)
+        # Make sure that mtime of the modified directory differs:
+        os.utime(os.path.join(self.tree, 'c'), ns=(1, 1))
+
+        with mock.patch.object(check_growth.DirectoryScanCache, '_scan_dir',
+                               wraps=check_growth.DirectoryScanCache._scan_dir) \
+                as scan_mock:
+            size = check_growth.DirectoryScanCache.scan(self.tree, 10, 1)
+
+        listed = [x[0][0] for x in scan_mock.call_args_list]
+        self.assertEqual(listed, [os.path.join(self.tree, 'c')])
+        self.assertEqual(size, self._du())
+
+    def test_removed_directories_are_forgotten(self):
+        check_growth.DirectoryScanCache.scan(self.tree, 10, 1)
+        shutil.rmtree(os.path.join(self.tree, 'a'))
+
+        size = check_growth.DirectoryScanCache.scan(self.tree, 10, 1)
+
+        self.assertEqual(size, self._du())
+        self.assertNotIn(os.path.join(self.tree, 'a', 'b'),
+                         check_growth.DirectoryScanCache._data[self.tree]['dirs'])
+
+    def test_scan_is_resumed_after_budget_is_exhausted(self):
+        # Let the scanner list two directories before the budget runs out:
+        with mock.patch('check_growth.dirscan.time.monotonic') as time_mock:
+            time_mock.side_effect = [0, 0, 0, 100]
+            size = check_growth.DirectoryScanCache.scan(self.tree, 10, 1)
+        self.assertIsNone(size)
+
+        # Cache survives betwean runs:
+        check_growth.DirectoryScanCache.save()
+        check_growth.DirectoryScanCache.init(paths.TEST_DIRSCAN_CACHE)
+
+        size = check_growth.DirectoryScanCache.scan(self.tree, 10, 1)
+        self.assertEqual(size, self._du())
+
+    def test_host_root_and_clock(self):
+        clock = mock.Mock(return_value=1000000000)
+        check_growth.Host.init(clock=clock, root=os.path.dirname(self.tree))
+        self.addCleanup(check_growth.Host.init)
+        root = '/' + os.path.basename(self.tree)
+
+        cur_u, _ = check_growth.fetch_directory_usage(root, 10, 1)
+        self.assertEqual(cur_u, round(self._du()/1024**2, 2))
+        state = check_growth.DirectoryScanCache._data[root]
+        self.assertEqual(state['dirs'][self.tree][4], 1000000000)
+
+        # Entries are re-listed once they are older than rescan_interval,
+        # according to the clock of the host:
+        clock.return_value += 2 * 3600 * 24
+        with mock.patch.object(check_growth.DirectoryScanCache, '_scan_dir',
+                               wraps=check_growth.DirectoryScanCache._scan_dir) \
+                as scan_mock:
+            check_growth.fetch_directory_usage(root, 10, 1)
+        self.assertEqual(scan_mock.call_count, 4)
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+
+    def test_results(self):
+        def build_table():
+            return [list(range(100)) for _ in range(100)]
+
+        with check_growth.profiling.profiled(self.profile_dir):
+            build_table()
+
+        prof_file = [x for x in os.listdir(self.profile_dir)
+                     if x.endswith('.prof')][0]
+        stats = pstats.Stats(os.path.join(self.profile_dir, prof_file))
+        self.assertTrue(any(x[2] == 'build_table' for x in stats.stats))
+
+        alloc_file = prof_file[:-len('.prof')] + '.alloc'
+        with open(os.path.join(self.profile_dir, alloc_file), 'r') as fh:
+            self.assertIn(__file__, fh.read())
+
+    def test_rotation(self):
+        for _ in range(4):
+            with self.assertRaises(SystemExit):
+                with check_growth.profiling.profiled(self.profile_dir, keep=2):
+                    sys.exit(0)
+        self.assertEqual(len(os.listdir(self.profile_dir)), 4)
+
+    def test_no_cost_when_disabled(self):
+        output = subprocess.check_output(
+            [sys.executable, '-c',
+             'import sys, check_growth; ' +
+             'print("cProfile" in sys.modules, "tracemalloc" in sys.modules)'],
+            cwd=os.path.abspath(pwd + '/../../../'))
+        self.assertEqual(output.decode().split(), ['False', 'False'])
+
+
+class TestPrometheusExport(unittest.TestCase):
+
+    def setUp(self):
+        self.results = [{'prefix': 'disk', 'path': '/tmp/"quoted"',
+                         'data_type': 'space', 'units': 'MB',
+                         'cur_usage': 1000, 'max_usage': 2000,
+                         'planned_growth': 5.48, 'days_to_full': float('inf'),
+                         'datapoints': 10, 'growth': {'main': -1.5,
+                                                      'short': None}},
+                        {'prefix': 'memory', 'path': None, 'data_type': None,
+                         'units': 'MB', 'cur_usage': 1000, 'max_usage': 2000,
+                         'planned_growth': 5.48, 'days_to_full': None,
+                         'datapoints': 1, 'growth': {}},
+                        ]
+
+        try:
+            os.unlink(paths.TEST_PROMETHEUS_FILE)
+        except (OSError, IOError):
+            pass
+
+    def test_textfile_contents(self):
+        check_growth.exporters.write_prometheus_textfile(
+            paths.TEST_PROMETHEUS_FILE, self.results, 0.25)
+
+        with open(paths.TEST_PROMETHEUS_FILE, 'r') as fh:
+            lines = fh.read().split('\n')
+
+        disk_labels = 'resource="disk",path="/tmp/\\"quoted\\"",' + \
+            'data_type="space",units="MB"'
+        mem_labels = 'resource="memory",path="",data_type="",units="MB"'
+        self.assertIn('# TYPE check_growth_usage gauge', lines)
+        self.assertIn('check_growth_usage{' + disk_labels + '} 1000.0', lines)
+        self.assertIn('check_growth_max_usage{' + mem_labels + '} 2000.0', lines)
+        self.assertIn('check_growth_days_to_full{' + disk_labels + '} +Inf',
+                      lines)
+        self.assertIn('check_growth_current_growth{' + disk_labels +
+                      ',window="main"} -1.5', lines)
+        self.assertIn('check_growth_run_duration_seconds 0.25', lines)
+        # Values which were not calculated are not exported:
+        self.assertNotIn('check_growth_days_to_full{' + mem_labels + '}',
+                         ' '.join(lines))
+        self.assertNotIn('window="short"', ' '.join(lines))
+
+    def test_textfile_is_replaced_atomically(self):
+        with mock.patch('check_growth.fsutils.os.rename',
+                        side_effect=OSError('rename failed')):
+            with self.assertRaises(OSError):
+                check_growth.exporters.write_prometheus_textfile(
+                    paths.TEST_PROMETHEUS_FILE, self.results, 0.25)
+
+        # Neither the target nor the temporary file is left behind:
+        fabric_dir = os.path.dirname(paths.TEST_PROMETHEUS_FILE)
+        self.assertEqual([x for x in os.listdir(fabric_dir)
+                          if x.startswith('check_growth.prom')], [])
+
+
+class TestStatusSummary(unittest.TestCase):
+
+    def setUp(self):
+        self.statuses = []
+        for i in range(200):
+            self.statuses.append({'status': 'ok',
+                                  'message': 'Series {0} is OK.'.format(i),
+                                  'series': 'disk:/mnt/{0}:space'.format(i),
+                                  'window': None,
+                                  'current_growth': 1,
+                                  'planned_growth': 5})
+        for i, status, growth in [(200, 'warn', 6), (201, 'crit', 8),
+                                  (202, 'warn', 7), (203, 'crit', 9),
+                                  (204, 'unknown', None)]:
+            self.statuses.append({'status': status,
+                                  'message': 'Series {0} msg.'.format(i),
+                                  'series': 'disk:/mnt/{0}:space'.format(i),
+                                  'window': None,
+                                  'current_growth': growth,
+                                  'planned_growth': 5})
+
+        try:
+            os.unlink(paths.TEST_STATUS_SIDECAR)
+        except (OSError, IOError):
+            pass
+
+    def test_worst_series_are_reported(self):
+        messages = check_growth.summarize_statuses(self.statuses, 3)
+
+        self.assertEqual(messages,
+                         [('crit', '205 series: 2 crit, 2 warn, 1 unknown, ' +
+                           '200 ok.'),
+                          ('crit', 'Series 203 msg.'),
+                          ('crit', 'Series 201 msg.'),
+                          ('warn', 'Series 202 msg.')])
+
+    def test_all_ok(self):
+        messages = check_growth.summarize_statuses(self.statuses[:200], 3)
+
+        self.assertEqual(messages,
+                         [('ok', '200 series: 0 crit, 0 warn, 0 unknown, ' +
+                           '200 ok.')])
+
+    def test_sidecar_contents(self):
+        check_growth.exporters.write_status_sidecar(paths.TEST_STATUS_SIDECAR,
+                                                    self.statuses)
+
+        with open(paths.TEST_STATUS_SIDECAR, 'r') as fh:
+            doc = json.load(fh)
+
+        self.assertEqual(doc['counts'], {'ok': 200, 'warn': 2, 'crit': 2,
+                                         'unknown': 1})
+        self.assertEqual(doc['series'], self.statuses)
+
+
+class TestEvaluationRun(unittest.TestCase):
+
+    def setUp(self):
+        series = [('disk', '/data1', 'space'), ('disk', '/data2', 'space'),
+                  ('group', 'data', None), ('group', 'logs', None)]
+        windows = {'week': {'averaging_window': 7,
+                            'min_averaging_window': 1}}
+        self.run = check_growth.EvaluationRun(
+            series, ([[20, 50]] * 4, [[40, 100]] * 4, [365] * 4),
+            windows=windows, config_name='team_a', perfdata_enabled=True)
+        for path, growth in [('/data1', {'main': 2, 'week': 1.5}),
+                             ('/data2', {'main': 3, 'week': None})]:
+            self.run.results.append({'prefix': 'disk', 'path': path,
+                                     'data_type': 'space', 'units': 'MB',
+                                     'cur_usage': 1000, 'max_usage': 2000,
+                                     'planned_growth': 2.74,
+                                     'days_to_full': None, 'datapoints': 10,
+                                     'growth': growth})
+
+    def test_group_evaluation(self):
+        check_growth.evaluate_group(self.run, 'data', {'resource': 'disk'})
+
+        result = self.run.results[-1]
+        self.assertEqual(result['growth'], {'main': 5})
+        self.assertEqual(result['days_to_full'], 400)
+        self.assertEqual(result['datapoints'], 20)
+        self.assertEqual(self.run.evaluations, [(2, 0, 5, 10.96, 'MB')])
+        self.assertEqual([(x['status'], x['window'])
+                          for x in self.run.statuses], [('unknown', 'week')])
+
+        check_growth.evaluate_group(self.run, 'logs',
+                                    {'resource': 'directory'})
+        self.assertEqual(self.run.statuses[-1]['message'],
+                         'Series group logs has no members.')
+
+    def test_threshold_check(self):
+        self.run.evaluations = [(0, 0, 3.5, 2.74, None),
+                                (0, 1, 6, 2.74, None),
+                                (1, 0, 4, 2.74, 'inodes')]
+        check_growth.check_thresholds(self.run)
+
+        self.assertEqual([x['status'] for x in self.run.statuses],
+                         ['warn', 'crit', 'crit'])
+        self.assertEqual(self.run.statuses[1]['window'], 'week')
+        self.assertIn('4 inodes/day', self.run.statuses[2]['message'])
+        self.assertEqual(self.run.perfdata[1],
+                         ('team_a:disk:/data1:space_growth_week', 6, 4.11,
+                          5.48))
+
+
+class TestSampleEvaluateModes(TestsBaseClass):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.history_file = os.path.join(self.tmpdir, 'history.yml')
+        self.cur_time = 1000000000
+
+        self.mocks = {}
+        for patched in ['check_growth.ScriptConfiguration',
+                        'check_growth.ScriptStatus',
+                        'check_growth.fetch_meminfo_usage',
+                        'check_growth.find_current_grow_ratio',
+                        'check_growth.logging',
+                        'check_growth.time.time',
+                        ]:
+            patcher = mock.patch(patched)
+            self.mocks[patched] = patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(history_file=self.history_file,
+                                      lockfile=self.history_file + '.lock',
+                                      disk_mon_enabled=False)
+        self.mocks['check_growth.ScriptStatus'].notify_agregated.side_effect = \
+            self._terminate_script
+        self.mocks['check_growth.fetch_meminfo_usage'].side_effect = \
+            lambda field_index, compiled: {
+                x: (1000 + self.mocks['check_growth.time.time'].return_value
+                    / 86400, 2000, 'MB') for x in compiled}
+        self.mocks['check_growth.find_current_grow_ratio'].return_value = 1
+
+    def _run(self, action, timestamp):
+        self.mocks['check_growth.time.time'].return_value = timestamp
+        self.mocks['check_growth.ScriptStatus'].update.reset_mock()
+        with self.assertRaises(SystemExit):
+            check_growth.main(config_file=paths.TEST_CONFIG_FILE,
+                              action=action)
+        return [x[0] for x in
+                self.mocks['check_growth.ScriptStatus'].update.call_args_list]
+
+    def test_sample_and_evaluate(self):
+        regression = self.mocks['check_growth.find_current_grow_ratio']
+
+        statuses = self._run('evaluate', self.cur_time)
+        self.assertEqual(statuses[0][0], 'unknown')
+        self.assertIn('No samples of memory usage growth', statuses[0][1])
+
+        for day in range(9):
+            statuses = self._run('sample', self.cur_time + day * 86400)
+            self.assertEqual(statuses, [('ok', '1 series sampled.')])
+        self.assertFalse(regression.called)
+        self.assertEqual(
+            self.mocks['check_growth.fetch_meminfo_usage'].call_count, 10 - 1)
+
+        # Evaluation does not sample the resources:
+        evaluated = self._run('evaluate', self.cur_time + 8 * 86400 + 600)
+        self.assertEqual(
+            self.mocks['check_growth.fetch_meminfo_usage'].call_count, 10 - 1)
+        self.assertEqual(regression.call_count, 1)
+        self.assertEqual(evaluated, [('ok', 'Memory usage growth is OK ' +
+                                      '(1 MB/day).')])
+
+        # No new data - cached results are used, without reading the
+        # datapoints:
+        with mock.patch.object(check_growth.HistoryFile, 'get_datapoints',
+                               wraps=check_growth.HistoryFile.get_datapoints
+                               ) as get_datapoints:
+            statuses = self._run('evaluate', self.cur_time + 8 * 86400 + 1200)
+        self.assertFalse(get_datapoints.called)
+        self.assertEqual(regression.call_count, 1)
+        self.assertEqual(statuses, evaluated)
+
+        # Changes of the estimation settings invalidate the cache as well:
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(history_file=self.history_file,
+                                      lockfile=self.history_file + '.lock',
+                                      disk_mon_enabled=False,
+                                      timeframe=3650)
+        statuses = self._run('evaluate', self.cur_time + 8 * 86400 + 1800)
+        self.assertEqual(regression.call_count, 2)
+        self.assertEqual(statuses[0][0], 'crit')
+        statuses = self._run('evaluate', self.cur_time + 8 * 86400 + 2400)
+        self.assertEqual(regression.call_count, 2)
+        self.assertEqual(statuses[0][0], 'crit')
+
+        for setting in [{'min_averaging_window': 2},
+                        {'memory_mon_outlier_filter': {'window': 10}},
+                        {'pure_python_max_datapoints': 100}]:
+            self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+                self._script_conf_factory(history_file=self.history_file,
+                                          lockfile=self.history_file + '.lock',
+                                          disk_mon_enabled=False,
+                                          timeframe=3650, **setting)
+            self._run('evaluate', self.cur_time + 8 * 86400 + 3000)
+        self.assertEqual(regression.call_count, 5)
+
+        # New sample invalidates the cache:
+        self._run('sample', self.cur_time + 9 * 86400)
+        self._run('evaluate', self.cur_time + 9 * 86400 + 600)
+        self.assertEqual(regression.call_count, 6)
+
+    def test_push(self):
+        receiver = check_growth.push.PushReceiver().start()
+        self.addCleanup(receiver.stop)
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(history_file=self.history_file,
+                                      lockfile=self.history_file + '.lock',
+                                      disk_mon_enabled=False,
+                                      push_url=receiver.url)
+
+        for day in range(3):
+            self._run('sample', self.cur_time + day * 86400)
+        self._run('evaluate', self.cur_time + 2 * 86400 + 600)
+
+        self.assertEqual([x['type'] for x in receiver.entries],
+                         ['sample'] * 3 + ['result'])
+        self.assertEqual(receiver.entries[2]['timestamp'],
+                         self.cur_time + 2 * 86400)
+        self.assertEqual(receiver.entries[2]['cur_usage'],
+                         1000 + (self.cur_time + 2 * 86400) / 86400)
+        self.assertEqual(receiver.entries[3]['series'], 'memory')
+        self.assertEqual(receiver.entries[3]['max_usage'], 2000)
+        self.assertEqual(receiver.entries[3]['host'], socket.gethostname())
+        self.assertEqual(
+            list(check_growth.read_records(self.history_file + '.spool')), [])
+
+    def test_series_groups(self):
+        regression = self.mocks['check_growth.find_current_grow_ratio']
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(
+                history_file=self.history_file,
+                lockfile=self.history_file + '.lock',
+                memory_mon_enabled=False,
+                disk_mon_enabled=False,
+                meminfo_mon_enabled=True,
+                series_groups={'meminfo': {'resource': 'meminfo'},
+                               'empty': {'resource': 'meminfo',
+                                         'match': 'foo*'}},
+                threshold_overrides=[{'resource': 'group',
+                                      'match': 'meminfo',
+                                      'timeframe': 3000}])
+
+        statuses = self._run('check', self.cur_time)
+        self.assertIn(('unknown', 'There is not enough data to calculate ' +
+                       'current combined usage growth of series group ' +
+                       'meminfo.'), statuses)
+
+        for day in range(1, 9):
+            statuses = self._run('check', self.cur_time + day * 86400)
+        # Group growth is the sum of the growths of the slab and swap series,
+        # which are not estimated again:
+        self.assertEqual(regression.call_count, 2 * 2)
+        self.assertEqual(statuses, [
+            ('unknown', 'Series group empty has no members.'),
+            ('ok', 'Meminfo series slab growth is OK (1 MB/day).'),
+            ('ok', 'Meminfo series swap growth is OK (1 MB/day).'),
+            ('crit', 'Combined usage growth of series group meminfo ' +
+             'exceeds planned growth - current: 2 MB/day, planned: 1.33 ' +
+             'MB/day.'),
+            ])
+
+        # Groups are evaluated from the cached results as well:
+        evaluated = self._run('evaluate', self.cur_time + 8 * 86400 + 600)
+        self.assertEqual(evaluated, statuses)
+
+    def test_series_groups_with_mixed_units(self):
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(
+                history_file=self.history_file,
+                lockfile=self.history_file + '.lock',
+                memory_mon_enabled=False,
+                disk_mon_enabled=False,
+                meminfo_mon_enabled=True,
+                series_groups={'meminfo': {'resource': 'meminfo'}})
+        self.mocks['check_growth.fetch_meminfo_usage'].side_effect = \
+            lambda field_index, compiled: {
+                x: (1000, 2000, 'MB' if x[-1] == 'slab' else 'pages')
+                for x in compiled}
+
+        for day in range(3):
+            statuses = self._run('check', self.cur_time + day * 86400)
+        self.assertIn(('unknown', 'Configuration of series group meminfo ' +
+                       'is invalid, its members have different units: ' +
+                       'MB, pages.'), statuses)
+
+    def test_adaptive_sampling(self):
+        self.mocks['check_growth.ScriptConfiguration'].get_val.side_effect = \
+            self._script_conf_factory(history_file=self.history_file,
+                                      lockfile=self.history_file + '.lock',
+                                      disk_mon_enabled=False,
+                                      adaptive_sampling={
+                                          'min_interval': 600,
+                                          'max_interval': 3600,
+                                          'resolution': 0.1})
+
+        # Memory usage grows slowly, so the interval keeps on doubling:
+        messages = [self._run('sample', self.cur_time + x * 600)[0][1]
+                    for x in range(8)]
+        self.assertEqual(messages, ['1 series sampled.'] * 3 +
+                         ['0 series sampled, 1 not due yet.'] +
+                         ['1 series sampled.'] +
+                         ['0 series sampled, 1 not due yet.'] * 3)
+
+        # Series which are not due are still evaluated:
+        statuses = self._run('check', self.cur_time + 7 * 600 + 60)
+        self.assertEqual(statuses[0][0], 'unknown')
+        self.assertIn('not enough data to calculate current memory usage',
+                      statuses[0][1])
+        self.assertEqual(len(check_growth.HistoryFile.get_datapoints(
+            'memory')), 4)
+
+
+class TestCollectors(TestsBaseClass):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.history_file = os.path.join(self.tmpdir, 'history.yml')
+
+        self.not_a_collector = mock.Mock()
+        self.entry_points = [fake_entry_point('fake', FakeCollector),
+                             fake_entry_point('other', FakeCollector),
+                             fake_entry_point('broken', self.not_a_collector)]
+        patcher = mock.patch.object(check_growth.CollectorRegistry,
+                                    '_entry_points',
+                                    {x.name: x for x in self.entry_points})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        check_growth.CollectorRegistry.init()
+
+    def test_run_collectors(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        ok = FakeCollector({})
+        collectors = {'ok': ok,
+                      'ok_again': ok,
+                      'failing': FakeCollector({'behaviour': 'fail'}),
+                      'hanging': FakeCollector({'behaviour': 'hang',
+                                                'release': release,
+                                                'timeout': 0.2})}
+
+        start = time.monotonic()
+        results = check_growth.run_collectors(collectors)
+        self.assertLess(time.monotonic() - start, 5)
+
+        self.assertEqual(results['ok'][0]['queue'], (10, 10**6))
+        self.assertIsNone(results['ok'][1])
+        self.assertEqual(results['ok'], results['ok_again'])
+        self.assertEqual(ok.calls, 1)
+        self.assertEqual(results['failing'],
+                         (None, 'collection failed: connection refused'))
+        self.assertEqual(results['hanging'], (None, 'timed out after 0.2s'))
+
+    def test_lazy_loading(self):
+        collector = check_growth.CollectorRegistry.get('fake', {'timeout': 3})
+        self.assertIsInstance(collector, FakeCollector)
+        self.assertEqual(collector.timeout, 3)
+        self.assertIs(check_growth.CollectorRegistry.get('fake',
+                                                         {'timeout': 3}),
+                      collector)
+        # Only the enabled plugins are imported:
+        self.assertEqual(self.entry_points[0].load.call_count, 1)
+        self.assertFalse(self.entry_points[1].load.called)
+
+        with self.assertRaisesRegex(ValueError, 'not installed'):
+            check_growth.CollectorRegistry.get('missing', None)
+        with self.assertRaisesRegex(ValueError, 'not a subclass'):
+            check_growth.CollectorRegistry.get('broken', None)
+        self.assertFalse(self.not_a_collector.called)
+
+    @mock.patch('check_growth.find_current_grow_ratio', return_value=1)
+    @mock.patch('check_growth.logging')
+    @mock.patch('check_growth.time.time')
+    @mock.patch('check_growth.ScriptStatus')
+    @mock.patch('check_growth.ScriptConfiguration')
+    def test_collector_series(self, config_mock, status_mock, time_mock, *_):
+        config_mock.get_val.side_effect = self._script_conf_factory(
+            history_file=self.history_file,
+            lockfile=self.history_file + '.lock',
+            memory_mon_enabled=False,
+            disk_mon_enabled=False,
+            collector_mon_enabled=True,
+            collectors={'fake': None, 'other': {'behaviour': 'partial'}})
+        status_mock.notify_agregated.side_effect = self._terminate_script
+
+        for day in range(9):
+            time_mock.return_value = 1000000000 + day * 86400
+            status_mock.update.reset_mock()
+            with self.assertRaises(SystemExit):
+                check_growth.main(config_file=paths.TEST_CONFIG_FILE)
+
+        statuses = [x[0] for x in status_mock.update.call_args_list]
+        self.assertEqual(statuses, [
+            ('unknown', 'Collector other: series connections was not ' +
+             'collected.'),
+            ('ok', 'Collector series fake/connections growth is OK ' +
+             '(1 conns/day).'),
+            ('ok', 'Collector series fake/queue growth is OK (1 jobs/day).'),
+            ('ok', 'Collector series other/queue growth is OK (1 jobs/day).'),
+        ])
+        self.assertEqual(
+            check_growth.get_config_series(),
+            [('collector', 'fake/connections', None),
+             ('collector', 'fake/queue', None),
+             ('collector', 'other/connections', None),
+             ('collector', 'other/queue', None)])
+
+
+class TestPush(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.spool = os.path.join(self.tmpdir, 'push.spool')
+        self.receiver = check_growth.push.PushReceiver().start()
+        self.addCleanup(self.receiver.stop)
+
+    def _spool_runs(self, runs, entries):
+        for run in range(runs):
+            check_growth.push.spool_entries(
+                self.spool, [{'run': run, 'entry': x} for x in range(entries)])
+
+    def test_batches_over_single_connection(self):
+        self._spool_runs(5, 3)
+
+        sent = check_growth.push.flush_spool(self.spool, self.receiver.url,
+                                             batch_size=4)
+        self.assertEqual(sent, 15)
+        self.assertEqual(self.receiver.entries,
+                         [{'run': x, 'entry': y}
+                          for x in range(5) for y in range(3)])
+        # Runs are never split between batches:
+        self.assertEqual(len(self.receiver.connections), 5)
+        self.assertEqual(len(set(self.receiver.connections)), 1)
+        self.assertEqual(list(check_growth.read_records(self.spool)), [])
+
+        # Nothing to send:
+        self.assertEqual(check_growth.push.flush_spool(self.spool,
+                                                       self.receiver.url), 0)
+        self.assertEqual(len(self.receiver.connections), 5)
+
+    def test_backoff(self):
+        self._spool_runs(2, 2)
+        self.receiver.status = 503
+        now = 1000000000
+
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(check_growth.push.flush_spool(
+                self.spool, self.receiver.url, now=now), 0)
+        self.assertEqual(len(list(check_growth.read_records(self.spool))), 2)
+        self.assertEqual(len(self.receiver.connections), 1)
+
+        # Collector is not contacted again until the backoff expires:
+        self.receiver.status = 200
+        self.assertEqual(check_growth.push.flush_spool(
+            self.spool, self.receiver.url, now=now + 10), 0)
+        self.assertEqual(len(self.receiver.connections), 1)
+
+        # ...which doubles after each failure:
+        self.receiver.status = 500
+        now += check_growth.push.PUSH_BACKOFF
+        with self.assertLogs(level='WARNING'):
+            check_growth.push.flush_spool(self.spool, self.receiver.url,
+                                          now=now)
+        self.receiver.status = 200
+        self.assertEqual(check_growth.push.flush_spool(
+            self.spool, self.receiver.url,
+            now=now + check_growth.push.PUSH_BACKOFF * 0.5), 0)
+        self.assertEqual(check_growth.push.flush_spool(
+            self.spool, self.receiver.url,
+            now=now + check_growth.push.PUSH_BACKOFF * 2), 4)
+        with open(self.spool + '.state') as fh:
+            self.assertEqual(json.load(fh)['failures'], 0)
+
+    def test_entries_spooled_during_flush_are_kept(self):
+        self._spool_runs(1, 1)
+        threads = []
+        handler = self.receiver._server.RequestHandlerClass
+        do_post = handler.do_POST
+
+        def spooling_post(request):
+            if not threads:
+                # A run which does not take the lock appends right away, the
+                # one which does waits for the flush to finish:
+                check_growth.append_record(self.spool, [{'run': 1}])
+                threads.append(threading.Thread(
+                    target=check_growth.push.spool_entries,
+                    args=(self.spool, [{'run': 2}])))
+                threads[0].start()
+            do_post(request)
+
+        with mock.patch.object(handler, 'do_POST', spooling_post):
+            self.assertEqual(check_growth.push.flush_spool(
+                self.spool, self.receiver.url), 1)
+        threads[0].join()
+
+        self.assertEqual(self.receiver.entries, [{'run': 0, 'entry': 0}])
+        self.assertEqual(list(check_growth.read_records(self.spool)),
+                         [[{'run': 1}], [{'run': 2}]])
+
+    def test_unreachable_collector(self):
+        self._spool_runs(1, 1)
+        stopped = check_growth.push.PushReceiver().start()
+        url = stopped.url
+        stopped.stop()
+
+        start = time.monotonic()
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(check_growth.push.flush_spool(
+                self.spool, url, timeout=1), 0)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(len(list(check_growth.read_records(self.spool))), 1)
+
+    def test_hanging_name_resolution(self):
+        self._spool_runs(1, 1)
+        resolving = threading.Event()
+        released = threading.Event()
+
+        def getaddrinfo(*unused, **unused_kw):
+            resolving.set()
+            released.wait()
+            raise socket.gaierror('Name or service not known')
+
+        with mock.patch('socket.getaddrinfo', getaddrinfo):
+            start = time.monotonic()
+            with self.assertLogs(level='WARNING'):
+                self.assertEqual(check_growth.push.flush_spool(
+                    self.spool, 'http://collector.example.com/',
+                    timeout=0.2), 0)
+            self.assertLess(time.monotonic() - start, 1)
+            self.assertTrue(resolving.is_set())
+
+            # The abandoned flush releases the lock once it fails:
+            with self.assertLogs(level='WARNING'):
+                released.set()
+                with check_growth.FileLock(self.spool + '.lock', timeout=5):
+                    pass
+        self.assertEqual(len(list(check_growth.read_records(self.spool))), 1)
+        with open(self.spool + '.state') as fh:
+            self.assertEqual(json.load(fh)['failures'], 1)
+
+
+@ddt
+class TestHistoryTransfer(TestsBaseClass):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.history_file = os.path.join(self.tmpdir, 'history.yml')
+        self.data_file = os.path.join(self.tmpdir, 'export')
+        self.cur_time = 1000000000
+
+        patcher = mock.patch('check_growth.ScriptConfiguration')
+        self.conf_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.conf_mock.get_val.side_effect = self._script_conf_factory(
+            history_file=self.history_file,
+            lockfile=self.history_file + '.lock')
+
+        patcher = mock.patch('check_growth.time.time')
+        patcher.start().return_value = self.cur_time
+        self.addCleanup(patcher.stop)
+
+        check_growth.HistoryFile.init(self.history_file, 14, 7)
+        for i in range(3):
+            timestamp = self.cur_time - 3600 * (2 - i)
+            check_growth.HistoryFile.import_datapoint(
+                'memory', None, None, timestamp, 100 + i)
+            check_growth.HistoryFile.import_datapoint(
+                'disk', '/srv', 'space', timestamp, 1000.5 + i)
+            check_growth.HistoryFile.import_datapoint(
+                'disk', '/var', 'inode', timestamp, 2000 + i)
+            check_growth.HistoryFile.import_datapoint(
+                'meminfo', 'slab', None, timestamp, 50 + i)
+        check_growth.HistoryFile.save()
+        self.all_datapoints = list(check_growth.HistoryFile.iter_datapoints())
+
+    @data('csv', 'ndjson')
+    def test_roundtrip(self, data_format):
+        count = check_growth.transfer_history('fake.yml', 'export',
+                                              data_format, self.data_file)
+        self.assertEqual(count, 12)
+
+        os.unlink(self.history_file + '.wal')
+        count = check_growth.transfer_history('fake.yml', 'import',
+                                              data_format, self.data_file)
+        self.assertEqual(count, 12)
+        self.assertTrue(os.path.exists(self.history_file))
+
+        check_growth.HistoryFile.init(self.history_file, 14, 7)
+        self.assertEqual(list(check_growth.HistoryFile.iter_datapoints()),
+                         self.all_datapoints)
+
+    def test_export_filters(self):
+        filters = {'resources': ['disk'], 'paths': ['/srv'],
+                   'since': self.cur_time - 3600, 'until': None}
+        check_growth.transfer_history('fake.yml', 'export', 'csv',
+                                      self.data_file, filters)
+        with open(self.data_file, 'r') as fh:
+            lines = fh.read().splitlines()
+        self.assertEqual(lines,
+                         ['resource,path,data_type,timestamp,value',
+                          'disk,/srv,space,{0},1001.5'.format(
+                              self.cur_time - 3600),
+                          'disk,/srv,space,{0},1002.5'.format(self.cur_time)])
+
+    def test_malformed_import(self):
+        with open(self.data_file, 'w') as fh:
+            fh.write('{"resource": "memory", "timestamp": 1000000000}\n')
+        with self.assertRaises(ValueError):
+            check_growth.transfer_history('fake.yml', 'import', 'ndjson',
+                                          self.data_file)
+
+        with open(self.data_file, 'w') as fh:
+            fh.write('{"resource": "disk", "path": "/srv", ' +
+                     '"timestamp": 1000000000, "value": 1}\n')
+        with self.assertRaises(ValueError):
+            check_growth.transfer_history('fake.yml', 'import', 'ndjson',
+                                          self.data_file)
+
+    def _write_legacy_history(self, count):
+        # History of a host which was sampled every 10 minutes for much longer
+        # than the averaging window:
+        import yaml
+        data = check_growth.HistoryFile._empty()
+        data['datapoints']['memory'] = {
+            self.cur_time - i * 600: 1000.5 + i for i in range(count)}
+        data['datapoints']['disk']['/srv'] = {
+            'space': {self.cur_time - i * 600: 5000 + i for i in range(count)},
+            'inode': {}}
+        data['limits'] = {'memory': [16000, None]}
+        with open(self.history_file, 'w') as fh:
+            yaml.dump(data, fh, default_flow_style=False)
+        # Datapoints written by setUp() are dropped:
+        if os.path.exists(self.history_file + '.wal'):
+            os.unlink(self.history_file + '.wal')
+
+    def test_stream_history(self):
+        self._write_legacy_history(10)
+        with open(self.history_file, 'r') as fh:
+            streamed = [(x, dict(y) if x[0] == 'datapoints' else y)
+                        for x, y in check_growth.stream_history(fh)]
+        self.assertIn((('limits',), {'memory': [16000, None]}), streamed)
+        self.assertIn((('datapoints', 'disk', '/srv', 'space'),
+                       {self.cur_time - i * 600: 5000 + i
+                        for i in range(10)}), streamed)
+        self.assertIn((('datapoints', 'memory'),
+                       {self.cur_time - i * 600: 1000.5 + i
+                        for i in range(10)}), streamed)
+
+        # Unconsumed series are skipped:
+        with open(self.history_file, 'r') as fh:
+            keys = [x for x, _ in check_growth.stream_history(fh)]
+        self.assertEqual(keys, [x for x, _ in streamed])
+
+        with open(self.history_file, 'w') as fh:
+            fh.write('datapoints:\n  memory:\n    foo: 1\n')
+        with open(self.history_file, 'r') as fh:
+            with self.assertRaises(ValueError):
+                list(check_growth.stream_history(fh))
+
+    def test_loading_memory_is_bounded(self):
+        import tracemalloc
+        peaks = []
+        for count in [500, 2000]:
+            self._write_legacy_history(count)
+            tracemalloc.start()
+            check_growth.HistoryFile.init(self.history_file, 1, 0.5)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            self.assertEqual(
+                len(check_growth.HistoryFile.get_datapoints('memory')), 144)
+        self.assertLess(peaks[1], peaks[0] * 1.5)
+
+    def test_export_memory_is_bounded(self):
+        import tracemalloc
+        peaks = []
+        for count in [500, 2000]:
+            self._write_legacy_history(count)
+            check_growth.HistoryFile.init(self.history_file, 14, 7)
+            check_growth.HistoryFile.add_datapoint('memory', 1)
+            check_growth.HistoryFile.save()
+            check_growth.HistoryFile.init(self.history_file, 14, 7)
+            tracemalloc.start()
+            exported = check_growth.transfer_history(
+                'fake.yml', 'export', 'csv', self.data_file)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            self.assertEqual(exported, 2 * count)
+        self.assertLess(peaks[1], peaks[0] * 1.5)
+
+        # The datapoint overwritten by the write-ahead log is exported once,
+        # with the new value:
+        with open(self.data_file, 'r') as fh:
+            lines = fh.read().splitlines()
+        self.assertEqual(len(lines), 1 + 2 * 2000)
+        self.assertNotIn('memory,,,{0},1000.5'.format(self.cur_time), lines)
+        self.assertEqual(lines[-1], 'memory,,,{0},1'.format(self.cur_time))
+
+    def test_migrate(self):
+        self._write_legacy_history(3000)
+        self.conf_mock.get_val.side_effect = self._script_conf_factory(
+            history_file=self.history_file,
+            lockfile=self.history_file + '.lock',
+            history_compact_storage=True)
+
+        count = check_growth.transfer_history('fake.yml', 'migrate', None,
+                                              None)
+        self.assertEqual(count, 2 * 14 * 144)
+        with open(self.history_file, 'r') as fh:
+            self.assertIn('offsets: !!binary', fh.read())
+        check_growth.HistoryFile.init(self.history_file, 14, 7, compact=True)
+        series = check_growth.HistoryFile.get_datapoints('disk', '/srv',
+                                                         'space')
+        self.assertEqual(min(series), self.cur_time - (14 * 144 - 1) * 600)
+        self.assertEqual(series[self.cur_time], 5000)
+
+
+class TestRollingMedianFilter(unittest.TestCase):
+
+    def test_initial_values(self):
+        rng = random.Random(1)
+        values = [rng.randint(0, 100) for _ in range(50)]
+        for window in [1, 10, 60]:
+            updated = check_growth.RollingMedianFilter(window, 5)
+            for value in values:
+                updated.update(value)
+            rfilter = check_growth.RollingMedianFilter(window, 5, values)
+
+            self.assertEqual(rfilter.values(), values[-window:])
+            self.assertEqual(rfilter.median(), updated.median())
+            self.assertEqual(rfilter.mad(), updated.mad())
+            self.assertEqual(rfilter.update(1000), updated.update(1000))
+
+    def test_median_and_mad(self):
+        rng = random.Random(2)
+        values = [rng.random() * 100 for _ in range(200)]
+        for window in [1, 2, 7, 30]:
+            rfilter = check_growth.RollingMedianFilter(window, 5)
+            for i, value in enumerate(values):
+                rfilter.update(value)
+                cur_window = values[max(0, i + 1 - window):i + 1]
+                median = numpy.median(cur_window)
+                deviations = sorted(abs(x - median) for x in cur_window)
+
+                self.assertEqual(rfilter.values(), cur_window)
+                self.assertAlmostEqual(rfilter.median(), median)
+                self.assertAlmostEqual(rfilter.mad(),
+                                       deviations[(len(deviations) - 1) // 2])
+
+    def test_spikes_are_flagged(self):
+        rng = random.Random(3)
+        rfilter = check_growth.RollingMedianFilter(30, 5)
+        flagged = [rfilter.update(1000 + i + rng.random() * 10)
+                   for i in range(100)]
+        self.assertFalse(any(flagged))
+
+        self.assertTrue(rfilter.update(5000))
+        self.assertFalse(rfilter.update(1100 + rng.random() * 10))
+
+    def test_level_shift_is_accepted(self):
+        rfilter = check_growth.RollingMedianFilter(10, 5)
+        for i in range(10):
+            rfilter.update(1000 + i % 3)
+        flagged = [rfilter.update(2000 + i % 3) for i in range(10)]
+
+        self.assertTrue(flagged[0])
+        self.assertFalse(flagged[-1])
+
+
 class TestHistFile(TestsBaseClass):
 
     def setUp(self):
@@ -448,14 +2206,20 @@ class TestHistFile(TestsBaseClass):
         self.addCleanup(patcher.stop)
         self.time_mock.return_value = self.cur_time
 
-        try:
-            os.unlink(self.history_file)
-        except (OSError, IOError):
-            pass
+        self._remove_history()
+        self.addCleanup(self._remove_history)
 
         check_growth.HistoryFile.init(self.history_file, self.max_averaging_window,
                                       self.min_averaging_window)
 
+    def _remove_history(self):
+        for location in [self.history_file, self.history_file + '.wal']:
+            try:
+                os.unlink(location)
+            except (OSError, IOError):
+                pass
+        shutil.rmtree(self.history_file + '.d', ignore_errors=True)
+
     def test_histfile_timespan_calculation(self):
         check_growth.HistoryFile.add_datapoint('memory', 1)
         check_growth.HistoryFile.add_datapoint('disk', 1, path='/tmp/',
@@ -515,6 +2279,143 @@ class TestHistFile(TestsBaseClass):
         self.assertGreater(check_growth.HistoryFile.verify_dataspan(
             'disk', '/tmp/', 'space'), 0)
 
+    def test_histfile_dataspan_ignores_outliers(self):
+        for i in range(3):
+            self.time_mock.return_value = self.cur_time + i * 3600 * 24
+            check_growth.HistoryFile.add_datapoint('memory', i)
+
+        self.assertEqual(check_growth.HistoryFile.get_dataspan('memory'), 2)
+        self.assertEqual(check_growth.HistoryFile.get_dataspan(
+            'memory', outliers=[self.cur_time]), 1)
+        self.assertEqual(check_growth.HistoryFile.get_dataspan(
+            'memory', outliers=[self.cur_time, self.cur_time + 3600 * 24]), 0)
+        self.assertLess(check_growth.HistoryFile.verify_dataspan(
+            'memory', outliers=[self.cur_time, self.cur_time + 3600 * 24]), 0)
+
+    def test_histfile_point_budget(self):
+        check_growth.HistoryFile.init(self.history_file,
+                                      self.max_averaging_window,
+                                      self.min_averaging_window,
+                                      max_datapoints=50)
+        # A week of datapoints every minute, with a burst of datapoints every
+        # second during the third day:
+        timestamps = list(range(self.cur_time, self.cur_time + 7 * 86400, 60))
+        timestamps += list(range(self.cur_time + 2 * 86400,
+                                 self.cur_time + 2 * 86400 + 3600))
+        timestamps = sorted(set(timestamps))
+        random.seed(0)
+        full = {}
+        for timestamp in timestamps:
+            self.time_mock.return_value = timestamp
+            full[timestamp] = 1000 + (timestamp - self.cur_time) / 864 + \
+                random.gauss(0, 5)
+            check_growth.HistoryFile.add_datapoint('memory', full[timestamp])
+
+        datapoints = check_growth.HistoryFile.get_datapoints('memory')
+        self.assertEqual(len(datapoints), 50)
+        # Endpoints are preserved:
+        self.assertEqual(min(datapoints), timestamps[0])
+        self.assertEqual(max(datapoints), timestamps[-1])
+        # Remaining datapoints cover the whole time span uniformly:
+        gaps = numpy.diff(sorted(datapoints))
+        self.assertLess(gaps.max(), 2.5 * 7 * 86400 / 49)
+        # Slope stays close to the one calculated from all the datapoints:
+        self.assertAlmostEqual(
+            check_growth.find_current_grow_ratio(datapoints),
+            check_growth.find_current_grow_ratio(full), delta=1)
+
+    def test_histfile_thinning_compact_series(self):
+        random.seed(0)
+        items = [(self.cur_time + random.randint(0, 86400), 1000 + i)
+                 for i in range(500)]
+        plain = dict(items)
+        compact = check_growth.CompactSeries(items)
+
+        removed = check_growth.HistoryFile._thin_series(plain, 50)
+        self.assertEqual(
+            check_growth.HistoryFile._thin_series(compact, 50), removed)
+        self.assertEqual(len(compact), 50)
+        self.assertEqual(dict(compact), plain)
+
+        # Series within the limit are left alone without sorting them:
+        with mock.patch('check_growth.sorted', create=True) as sorted_mock:
+            self.assertEqual(
+                check_growth.HistoryFile._thin_series(compact, 50), [])
+        sorted_mock.assert_not_called()
+
+    def test_histfile_outlier_flagging(self):
+        for i in range(20):
+            self.time_mock.return_value = self.cur_time + i * 3600
+            value = 1000 + i + (5000 if i == 15 else 0)
+            timestamp = check_growth.HistoryFile.add_datapoint('memory', value)
+            check_growth.HistoryFile.filter_datapoint('memory', value, timestamp,
+                                                      window=10, threshold=5)
+
+        # The filter keeps no state apart from the series itself, only the
+        # flags are logged:
+        self.assertEqual(set(x[0] for x in check_growth.HistoryFile._changes),
+                         set(['add', 'outlier']))
+
+        # Flags survive betwean runs:
+        check_growth.HistoryFile.save()
+        check_growth.HistoryFile.init(self.history_file, self.max_averaging_window,
+                                      self.min_averaging_window)
+
+        self.assertEqual(check_growth.HistoryFile.get_outliers('memory'),
+                         [self.cur_time + 15 * 3600])
+        # Flagged datapoints are not removed:
+        self.assertEqual(len(check_growth.HistoryFile.get_datapoints('memory')),
+                         20)
+
+        # Flags expire together with the datapoints, when the next run loads
+        # the history:
+        self.time_mock.return_value = self.cur_time + \
+            self.max_averaging_window * 3600 * 24 + 16 * 3600
+        check_growth.HistoryFile.init(self.history_file, self.max_averaging_window,
+                                      self.min_averaging_window)
+        self.assertEqual(check_growth.HistoryFile.get_outliers('memory'), [])
+        self.assertEqual(len(check_growth.HistoryFile.get_datapoints('memory')),
+                         3)
+
+    def test_histfile_expiry(self):
+        # Expired datapoints, i.e. imported ones, are not stored at all:
+        border = self.cur_time - self.max_averaging_window * 3600 * 24
+        check_growth.HistoryFile.import_datapoint('memory', None, None,
+                                                  border, 1)
+        check_growth.HistoryFile.import_datapoint('memory', None, None,
+                                                  border + 3600, 2)
+        series = check_growth.HistoryFile.get_datapoints('memory')
+        self.assertEqual(series, {border + 3600: 2})
+
+        # Stored series are returned as they are, without trimming them on
+        # every call:
+        self.time_mock.return_value = self.cur_time + 7200
+        self.assertIs(check_growth.HistoryFile.get_datapoints('memory'), series)
+        self.assertEqual(series, {border + 3600: 2})
+
+        # Datapoints expire when the next run loads the history:
+        check_growth.HistoryFile.save()
+        check_growth.HistoryFile.init(self.history_file, self.max_averaging_window,
+                                      self.min_averaging_window)
+        self.assertEqual(check_growth.HistoryFile.get_datapoints('memory'), {})
+
+    def test_histfile_legacy_filter_state(self):
+        # Windows of the outlier filters were kept in the history file and
+        # logged by older versions:
+        with open(self.history_file, 'w') as fh:
+            fh.write('datapoints: {{memory: {{{0}: 1}}}}\n'.format(self.cur_time) +
+                     'filters: {memory: [1, 2]}\n')
+        check_growth.append_record(self.history_file + '.wal',
+                                   [['filter', 'memory', [1, 2, 3]]])
+
+        check_growth.HistoryFile.init(self.history_file, self.max_averaging_window,
+                                      self.min_averaging_window)
+        self.assertEqual(check_growth.HistoryFile.get_datapoints('memory'),
+                         {self.cur_time: 1})
+        check_growth.HistoryFile.save(compact=True)
+        with open(self.history_file, 'r') as fh:
+            self.assertNotIn('filters', fh.read())
+
     def test_histfile_load(self):
         check_growth.HistoryFile.add_datapoint('memory', 10356)
         check_growth.HistoryFile.add_datapoint('disk', 134321, path='/tmp/',
@@ -562,6 +2463,379 @@ class TestHistFile(TestsBaseClass):
         self.assertEqual(disk_data_inode,
                          {1001296000: 234234367, 1001209601: 234321})
 
+    def test_histfile_corrupted(self):
+        check_growth.HistoryFile.add_datapoint('memory', 1)
+        check_growth.HistoryFile.save(compact=True)
+        for content in ['datapoints: {memory: {1000000000: 1}', 'foo',
+                        'datapoints: {floppy: {a: {1000000000: 1}}}']:
+            with open(self.history_file, 'w') as fh:
+                fh.write(content)
+
+            # Corrupted history is not replaced with an empty one:
+            with self.assertRaises(check_growth.RecoverableException):
+                check_growth.HistoryFile.init(self.history_file,
+                                              self.max_averaging_window,
+                                              self.min_averaging_window)
+            with open(self.history_file, 'r') as fh:
+                self.assertEqual(fh.read(), content)
+
+    def test_histfile_concurrent_save(self):
+        for compact in [False, True]:
+            self._remove_history()
+            check_growth.HistoryFile.init(self.history_file,
+                                          self.max_averaging_window,
+                                          self.min_averaging_window)
+            check_growth.HistoryFile.add_datapoint('memory', 1)
+
+            # Another run, checking a different resource, saves the history
+            # file - or appends to its log - in the meantime:
+            with mock.patch.multiple(check_growth.HistoryFile, _data={},
+                                     _changes=[]):
+                check_growth.HistoryFile.init(self.history_file,
+                                              self.max_averaging_window,
+                                              self.min_averaging_window)
+                check_growth.HistoryFile.add_datapoint(
+                    'disk', 2, path='/tmp/', data_type='space')
+                check_growth.HistoryFile.save(compact=compact)
+
+            # The first run writes the history file with its pending change,
+            # which has to be applied on top of the current content of the
+            # file:
+            check_growth.HistoryFile.save(compact=True)
+            self.assertFalse(os.path.exists(self.history_file + '.wal'))
+
+            # None of the updates is lost:
+            check_growth.HistoryFile.init(self.history_file,
+                                          self.max_averaging_window,
+                                          self.min_averaging_window)
+            self.assertEqual(
+                check_growth.HistoryFile.get_datapoints('memory'),
+                {self.cur_time: 1})
+            self.assertEqual(check_growth.HistoryFile.get_datapoints(
+                'disk', '/tmp/', 'space'), {self.cur_time: 2})
+
+    def test_histfile_lock_timeout(self):
+        check_growth.HistoryFile.add_datapoint('memory', 1)
+        with check_growth.fsutils.FileLock(self.history_file + '.lock'):
+            # flock() locks are per open file description, so the lock held
+            # above blocks the lock taken by save() even in the same process:
+            with mock.patch('check_growth.fsutils.LOCK_TIMEOUT', 0.05):
+                with self.assertRaises(check_growth.fsutils.FileLockTimeout):
+                    check_growth.HistoryFile.save()
+        check_growth.HistoryFile.save()
+        check_growth.HistoryFile.init(self.history_file,
+                                      self.max_averaging_window,
+                                      self.min_averaging_window)
+        self.assertEqual(check_growth.HistoryFile.get_datapoints('memory'),
+                         {self.cur_time: 1})
+
+    def test_histfile_load_lock(self):
+        with check_growth.fsutils.FileLock(self.history_file + '.lock'):
+            # Loading waits for the compaction holding the lock:
+            with mock.patch('check_growth.fsutils.LOCK_TIMEOUT', 0.05):
+                with self.assertRaises(check_growth.fsutils.FileLockTimeout):
+                    check_growth.HistoryFile.init(self.history_file,
+                                                  self.max_averaging_window,
+                                                  self.min_averaging_window)
+        # ...but not for other runs loading the history:
+        with check_growth.fsutils.FileLock(self.history_file + '.lock',
+                                           shared=True):
+            with mock.patch('check_growth.fsutils.LOCK_TIMEOUT', 0.05):
+                check_growth.HistoryFile.init(self.history_file,
+                                              self.max_averaging_window,
+                                              self.min_averaging_window)
+
+    def test_histfile_compaction_is_durable(self):
+        check_growth.HistoryFile.add_datapoint('memory', 1)
+        calls = []
+        fsync = os.fsync
+        rename = os.rename
+        unlink = os.unlink
+
+        def record(name, func):
+            def wrapper(*args):
+                if name == 'fsync':
+                    calls.append((name, os.path.isdir(
+                        '/proc/self/fd/{0}'.format(args[0]))))
+                else:
+                    calls.append((name, os.path.basename(args[-1])))
+                return func(*args)
+            return wrapper
+
+        with mock.patch('os.fsync', record('fsync', fsync)), \
+                mock.patch('os.rename', record('rename', rename)), \
+                mock.patch('os.unlink', record('unlink', unlink)):
+            check_growth.HistoryFile.save(compact=True)
+
+        # The content of the history file and then its directory entry reach
+        # the disk before the log is removed:
+        name = os.path.basename(self.history_file)
+        self.assertEqual(calls[-4:], [('fsync', False), ('rename', name),
+                                      ('fsync', True),
+                                      ('unlink', name + '.wal')])
+
+    def test_histfile_wal_recovery(self):
+        for value in range(3):
+            self.time_mock.return_value = self.cur_time + value * 60
+            check_growth.HistoryFile.add_datapoint('memory', value)
+            check_growth.HistoryFile.save()
+
+        # Runs only append to the log, the history file is not rewritten:
+        self.assertFalse(os.path.exists(self.history_file))
+
+        # Run killed in the middle of the append leaves a torn record, and
+        # a corrupted one is detected by its checksum:
+        with open(self.history_file + '.wal', 'r') as fh:
+            records = fh.readlines()
+        with open(self.history_file + '.wal', 'w') as fh:
+            fh.write(records[0])
+            fh.write(records[1].replace('[[', '[ ['))
+            fh.write(records[2][:-10])
+
+        with self.assertLogs(level='WARNING') as logs:
+            check_growth.HistoryFile.init(self.history_file,
+                                          self.max_averaging_window,
+                                          self.min_averaging_window)
+        self.assertEqual(len(logs.output), 2)
+        self.assertEqual(check_growth.HistoryFile.get_datapoints('memory'),
+                         {self.cur_time: 0})
+
+        # Record appended after the torn one is not damaged by it:
+        self.time_mock.return_value = self.cur_time + 300
+        check_growth.HistoryFile.add_datapoint('memory', 5)
+        with self.assertLogs(level='WARNING'):
+            check_growth.HistoryFile.save()
+            check_growth.HistoryFile.init(self.history_file,
+                                          self.max_averaging_window,
+                                          self.min_averaging_window)
+        self.assertEqual(check_growth.HistoryFile.get_datapoints('memory'),
+                         {self.cur_time: 0, self.cur_time + 300: 5})
+
+    def test_histfile_wal_compaction(self):
+        check_growth.HistoryFile.init(self.history_file,
+                                      self.max_averaging_window,
+                                      self.min_averaging_window,
+                                      wal_max_records=3)
+        expected = {}
+        for value in range(5):
+            self.time_mock.return_value = self.cur_time + value * 60
+            expected[self.cur_time + value * 60] = value
+            check_growth.HistoryFile.add_datapoint('memory', value)
+            check_growth.HistoryFile.save()
+            if value == 2:
+                # Third run has folded the log into the history file:
+                self.assertTrue(os.path.exists(self.history_file))
+                self.assertFalse(os.path.exists(self.history_file + '.wal'))
+
+        check_growth.HistoryFile.init(self.history_file,
+                                      self.max_averaging_window,
+                                      self.min_averaging_window)
+        self.assertEqual(check_growth.HistoryFile.get_datapoints('memory'),
+                         expected)
+
+        # Clearing the history is never deferred to the log:
+        check_growth.HistoryFile.clear_history()
+        check_growth.HistoryFile.save()
+        self.assertFalse(os.path.exists(self.history_file + '.wal'))
+        check_growth.HistoryFile.init(self.history_file,
+                                      self.max_averaging_window,
+                                      self.min_averaging_window)
+        self.assertEqual(check_growth.HistoryFile.get_datapoints('memory'), {})
+
+    def test_histfile_sharding(self):
+        # Datapoint saved before sharding was enabled:
+        check_growth.HistoryFile.add_datapoint('memory', 0)
+        check_growth.HistoryFile.save(compact=True)
+
+        shard_dir = self.history_file + '.d'
+        expected = {self.cur_time: 0}
+        for day in range(1, 17):
+            check_growth.HistoryFile.init(self.history_file,
+                                          self.max_averaging_window,
+                                          self.min_averaging_window,
+                                          wal_max_records=1, shard_period=1)
+            self.time_mock.return_value = self.cur_time + day * 3600 * 24
+            expected[self.time_mock.return_value] = day
+            check_growth.HistoryFile.add_datapoint('memory', day)
+            with mock.patch('check_growth.write_atomically',
+                            wraps=check_growth.write_atomically) as write_mock:
+                check_growth.HistoryFile.save()
+            if day > 1:
+                # Only the newest shard and the history file are written:
+                newest = check_growth.HistoryFile._shard_name(
+                    self.time_mock.return_value)
+                self.assertEqual([x[0][0] for x in write_mock.call_args_list],
+                                 [os.path.join(shard_dir, newest),
+                                  self.history_file])
+
+        # Shards older than the averaging window are removed as a whole, and
+        # so are the ones with expired datapoints only:
+        border = self.time_mock.return_value - \
+            self.max_averaging_window * 3600 * 24
+        shards = check_growth.HistoryFile._list_shards()
+        self.assertEqual(len(shards), 14)
+        self.assertTrue(all(end > border for _, end, _ in shards))
+        check_growth.HistoryFile.init(self.history_file,
+                                      self.max_averaging_window,
+                                      self.min_averaging_window,
+                                      shard_period=1)
+        self.assertEqual(check_growth.HistoryFile.get_datapoints('memory'),
+                         {x: y for x, y in expected.items() if x > border})
+
+        # History file itself keeps no datapoints:
+        shutil.rmtree(shard_dir)
+        check_growth.HistoryFile.init(self.history_file,
+                                      self.max_averaging_window,
+                                      self.min_averaging_window)
+        self.assertEqual(check_growth.HistoryFile.get_datapoints('memory'), {})
+
+    def test_histfile_sharding_migration(self):
+        values = {}
+        for day in range(4):
+            timestamp = self.cur_time + day * 3600 * 24
+            values[timestamp] = day
+            check_growth.HistoryFile.import_datapoint('memory', None, None,
+                                                      timestamp, day)
+        self.time_mock.return_value = self.cur_time + 4 * 3600 * 24
+        check_growth.HistoryFile.save(compact=True)
+
+        # Datapoints are moved to the shards, and between shards of different
+        # sizes:
+        for period, count in [(1, 4), (2, 2)]:
+            check_growth.HistoryFile.init(self.history_file,
+                                          self.max_averaging_window,
+                                          self.min_averaging_window,
+                                          shard_period=period)
+            check_growth.HistoryFile.save(compact=True)
+            self.assertEqual(len(check_growth.HistoryFile._list_shards()),
+                             count)
+            check_growth.HistoryFile.init(self.history_file,
+                                          self.max_averaging_window,
+                                          self.min_averaging_window,
+                                          shard_period=period)
+            self.assertEqual(
+                check_growth.HistoryFile.get_datapoints('memory'), values)
+
+        # ...and back to the history file:
+        check_growth.HistoryFile.init(self.history_file,
+                                      self.max_averaging_window,
+                                      self.min_averaging_window)
+        check_growth.HistoryFile.save(compact=True)
+        self.assertEqual(check_growth.HistoryFile._list_shards(), [])
+        check_growth.HistoryFile.init(self.history_file,
+                                      self.max_averaging_window,
+                                      self.min_averaging_window)
+        self.assertEqual(check_growth.HistoryFile.get_datapoints('memory'),
+                         values)
+
+        # Clearing the history removes all the shards:
+        check_growth.HistoryFile.init(self.history_file,
+                                      self.max_averaging_window,
+                                      self.min_averaging_window,
+                                      shard_period=1)
+        check_growth.HistoryFile.save(compact=True)
+        self.assertNotEqual(check_growth.HistoryFile._list_shards(), [])
+        check_growth.HistoryFile.clear_history()
+        check_growth.HistoryFile.save()
+        self.assertEqual(check_growth.HistoryFile._list_shards(), [])
+
+    def test_histfile_adaptive_sampling(self):
+        def sample(value, step=300):
+            self.time_mock.return_value += step
+            check_growth.HistoryFile.add_datapoint('memory', value)
+            return check_growth.HistoryFile.adapt_sampling_interval(
+                'memory', 1000, 300, 3600, 0.01)
+
+        # Until the rate of change can be estimated, the series is sampled as
+        # often as possible:
+        self.assertTrue(check_growth.HistoryFile.is_sample_due('memory'))
+        self.assertEqual([sample(100), sample(100)], [300, 300])
+
+        # Interval of an idle series grows twofold at a time:
+        self.assertEqual([sample(100) for _ in range(5)],
+                         [600, 1200, 2400, 3600, 3600])
+        last = self.time_mock.return_value
+        self.time_mock.return_value = last + 3599
+        self.assertFalse(check_growth.HistoryFile.is_sample_due('memory'))
+        self.assertTrue(check_growth.HistoryFile.is_sample_due('memory',
+                                                               tolerance=1))
+        self.time_mock.return_value = last
+
+        # Intervals are persisted:
+        check_growth.HistoryFile.save()
+        check_growth.HistoryFile.init(self.history_file,
+                                      self.max_averaging_window,
+                                      self.min_averaging_window)
+        self.assertFalse(check_growth.HistoryFile.is_sample_due('memory'))
+
+        # Growth shortens the interval at once:
+        self.assertEqual(sample(200, step=3600), 300)
+
+        # ...and so does the noise:
+        check_growth.HistoryFile.clear_history()
+        self.assertEqual([sample(100 + 30 * (x % 2)) for x in range(5)][-1],
+                         300)
+
+        # Steady, slow growth settles on the time needed to grow by 1% of the
+        # max usage:
+        check_growth.HistoryFile.clear_history()
+        self.assertEqual([sample(100 + 1.5 * x) for x in range(6)],
+                         [300, 300, 600, 1200, 2000, 2000])
+
+    def test_histfile_compact_storage(self):
+        values = {}
+        for i in range(2000):
+            timestamp = self.cur_time - 2000 * 300 + i * 300
+            values[timestamp] = 1200000 + i * 2.95
+            check_growth.HistoryFile.import_datapoint('memory', None, None,
+                                                      timestamp,
+                                                      values[timestamp])
+        check_growth.HistoryFile.save(compact=True)
+        plain_size = os.path.getsize(self.history_file)
+
+        # Plain history is converted on load:
+        check_growth.HistoryFile.init(self.history_file,
+                                      self.max_averaging_window,
+                                      self.min_averaging_window, compact=True)
+        series = check_growth.HistoryFile.get_datapoints('memory')
+        self.assertIsInstance(series, check_growth.CompactSeries)
+        self.assertEqual(list(series), sorted(values))
+        for timestamp, value in values.items():
+            self.assertAlmostEqual(series[timestamp], value, places=1)
+        check_growth.HistoryFile.add_datapoint('memory', 1206000)
+        values[self.cur_time] = 1206000
+        check_growth.HistoryFile.save(compact=True)
+        self.assertLess(os.path.getsize(self.history_file), plain_size / 2)
+
+        # ...and so is the compact one, in both modes, with and without
+        # shards:
+        for compact, shard_period in [(True, None), (True, 1), (False, 1),
+                                      (False, None)]:
+            check_growth.HistoryFile.init(self.history_file,
+                                          self.max_averaging_window,
+                                          self.min_averaging_window,
+                                          shard_period=shard_period,
+                                          compact=compact)
+            series = check_growth.HistoryFile.get_datapoints('memory')
+            self.assertEqual(isinstance(series, check_growth.CompactSeries),
+                             compact)
+            self.assertEqual(len(series), 2001)
+            self.assertEqual(series[self.cur_time], 1206000)
+            self.assertEqual(
+                check_growth.find_current_grow_ratio(series),
+                check_growth.find_current_grow_ratio(values))
+            check_growth.HistoryFile.save(compact=True)
+
+        # Old datapoints are removed from the columns as well:
+        self.time_mock.return_value = self.cur_time + \
+            self.max_averaging_window * 3600 * 24 - 300
+        check_growth.HistoryFile.init(self.history_file,
+                                      self.max_averaging_window,
+                                      self.min_averaging_window, compact=True)
+        self.assertEqual(
+            list(check_growth.HistoryFile.get_datapoints('memory')),
+            [self.cur_time])
+
 
 if __name__ == '__main__':
     unittest.main()